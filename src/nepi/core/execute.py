@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 
 from nepi.core.attributes import Attribute, AttributesMap
-from nepi.util import validation
+from nepi.util import validation, rpcstats, defer, server
+from nepi.util.journal import Journal
+from nepi.util.timeline import Timeline, to_trace_events
+from nepi.util.parallel import TaskGraph, WorkerPool
 from nepi.util.constants import ApplicationStatus as AS, TestbedStatus as TS, TIME_NOW, DeploymentConfiguration as DC
-from nepi.util.parser._xml import XmlExperimentParser
+from nepi.util.parser._xml import XmlExperimentParser, IncrementalXmlWriter
 import sys
 import re
 import threading
@@ -11,7 +14,10 @@ import ConfigParser
 import os
 import collections
 import functools
+import hashlib
+import json
 import time
+import traceback
 import logging
 logging.basicConfig()
 
@@ -19,12 +25,82 @@ ATTRIBUTE_PATTERN_BASE = re.compile(r"\{#\[(?P<label>[-a-zA-Z0-9._]*)\](?P<expr>
 ATTRIBUTE_PATTERN_GUID_SUB = r"{#[%(guid)s]%(expr)s#}"
 COMPONENT_PATTERN = re.compile(r"(?P<kind>[a-z]*)\[(?P<index>.*)\]")
 
+class Netref(collections.namedtuple("Netref", 
+        "text guid component component_index attribute")):
+    """
+    A reference to another element's attribute, address, route or trace, 
+    as parsed from an attribute value: text is the whole reference, 
+    to be replaced by the value it refers to.
+    """
+    __slots__ = ()
+    
+    @staticmethod
+    def make_key(guid, attribute, component = '', component_index = None):
+        return (guid, component, component_index, attribute)
+    
+    @property
+    def key(self):
+        return self.make_key(self.guid, self.attribute, self.component, 
+            self.component_index)
+
 def _undefer(deferred):
     if hasattr(deferred, '_get'):
         return deferred._get()
     else:
         return deferred
 
+class MulticallError(RuntimeError):
+    """
+    Raised when flushing a multicall in which some of the queued calls
+    failed. Calls are performed regardless of previous failures, so
+    both the results and the errors of the whole batch are available:
+    
+        results: list with one entry per queued call, None for failed ones
+        errors: list of (call index, method name, error text) tuples
+    """
+    def __init__(self, errors, results):
+        self.errors = errors
+        self.results = results
+        msg = "%d of %d batched calls failed:\n%s" % (
+            len(errors), len(results),
+            "\n".join([ "  call %d (%s): %s" % error for error in errors ]) )
+        super(MulticallError, self).__init__(msg)
+
+class DirectMulticall(object):
+    """
+    Multicall envelope for controllers living in this same process.
+    Calls are queued and performed in order upon flush(), just like
+    proxies would do with their multicall envelopes.
+    """
+    def __init__(self, target):
+        self._target = target
+        self._calls = []
+    
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError, name
+        meth = getattr(self._target, name)
+        def queue(*p, **kw):
+            self._calls.append((name, meth, p, kw))
+        queue.__name__ = name
+        return queue
+    
+    def __len__(self):
+        return len(self._calls)
+    
+    def flush(self):
+        calls, self._calls = self._calls, []
+        results = []
+        errors = []
+        for index, (name, meth, p, kw) in enumerate(calls):
+            try:
+                results.append(meth(*p, **kw))
+            except:
+                results.append(None)
+                errors.append((index, name, traceback.format_exc()))
+        if errors:
+            raise MulticallError(errors, results)
+        return results
 
 class TestbedController(object):
     def __init__(self, testbed_id, testbed_version):
@@ -43,6 +119,15 @@ class TestbedController(object):
     def guids(self):
         raise NotImplementedError
 
+    def multicall(self):
+        """
+        Returns an envelope on which calls to this controller can be 
+        queued, to be performed as a batch when its flush() method is
+        called. flush() returns the list of results, or raises 
+        MulticallError if any of the calls failed.
+        """
+        return DirectMulticall(self)
+
     def defer_configure(self, name, value):
         """Instructs setting a configuartion attribute for the testbed instance"""
         raise NotImplementedError
@@ -171,6 +256,13 @@ class TestbedController(object):
 
     def get(self, guid, name, time = TIME_NOW):
         raise NotImplementedError
+
+    def get_many(self, guid, names, time = TIME_NOW):
+        """
+        Returns a list with the values of the given attributes of 
+        element guid, in the same order.
+        """
+        raise NotImplementedError
     
     def get_route(self, guid, index, attribute):
         """
@@ -195,19 +287,70 @@ class TestbedController(object):
     def get_attribute_list(self, guid, filter_flags = None, exclude = False):
         raise NotImplementedError
 
+    def snapshot_attributes(self, filter_flags = None, exclude = False):
+        """
+        Returns the current values of the attributes of all elements,
+        filtered like get_attribute_list does, as a dict mapping
+        each element's guid to a dict of its non-None values.
+        """
+        raise NotImplementedError
+
     def get_factory_id(self, guid):
         raise NotImplementedError
 
+    def timeline(self):
+        """
+        Returns the (name, category, start, end, tid, args) events of 
+        the factory steps and element actions performed so far 
+        (see nepi.util.timeline).
+        """
+        raise NotImplementedError
+
     def action(self, time, guid, action):
         raise NotImplementedError
 
     def status(self, guid):
         raise NotImplementedError
+
+    def status_many(self, guids):
+        """
+        Returns a list with the status of each of the given elements,
+        in the same order.
+        """
+        raise NotImplementedError
+
+    def is_finished_all(self, guids):
+        """
+        Returns True if all the given elements have finished.
+        """
+        raise NotImplementedError
+    
+    def wait_for(self, guids, state, timeout = None):
+        """
+        Blocks until all the given elements are in the given state
+        (an ApplicationStatus), and returns True, or returns False if
+        timeout seconds elapse first, or if the testbed stops.
+        """
+        raise NotImplementedError
     
     def testbed_status(self):
         raise NotImplementedError
 
     def trace(self, guid, trace_id, attribute='value'):
+        """
+        Returns information about a trace, as a string, according 
+        to attribute: 'value' for the whole content, 'path' for its
+        location, 'size' for its size in bytes and 'mtime' for its 
+        last modification time.
+        """
+        raise NotImplementedError
+
+    def read_trace(self, guid, trace_id, offset, length):
+        """
+        Returns at most length bytes of the trace's content, starting
+        at offset, or an empty string past its end. Allows retrieving 
+        big traces in bounded-size chunks.
+        """
         raise NotImplementedError
 
     def traces_info(self):
@@ -227,6 +370,35 @@ class TestbedController(object):
         raise NotImplementedError
 
 class ExperimentController(object):
+    # Maximum number of testbed controllers bootstrapped concurrently
+    # on any one host
+    MAX_BOOTSTRAP_PER_HOST = 8
+    
+    # Maximum number of tasks (deployment steps, bootstraps, shutdowns...)
+    # the controller runs concurrently, and how long (in seconds) any 
+    # one of them may take before it's considered failed (None: forever)
+    MAX_PARALLEL = int(os.environ.get("NEPI_MAX_PARALLEL", 32))
+    TASK_TIMEOUT = os.environ.get("NEPI_TASK_TIMEOUT")
+    if TASK_TIMEOUT:
+        TASK_TIMEOUT = float(TASK_TIMEOUT)
+    else:
+        TASK_TIMEOUT = None
+    
+    # Longest single wait on a testbed controller (in seconds), 
+    # so that waits don't tie up its workers indefinitely. Longer
+    # waits take a call to each testbed every WAIT_SLICE seconds.
+    WAIT_SLICE = 30
+    
+    # Run cross-connection steps one at a time, in a fixed order, 
+    # for debugging
+    DETERMINISTIC_CROSS_CONNECT = os.environ.get(
+        "NEPI_DETERMINISTIC_CROSS_CONNECT", "").lower() in ("1", "true", "on")
+    
+    # Dump the deployment timeline after every start or recovery, 
+    # successful or not (see dump_timeline)
+    DUMP_TIMELINE = os.environ.get(
+        "NEPI_TIMELINE", "").lower() in ("1", "true", "on")
+    
     def __init__(self, experiment_xml, root_dir):
         self._experiment_design_xml = experiment_xml
         self._experiment_execute_xml = None
@@ -242,6 +414,22 @@ class ExperimentController(object):
         self._started_time = None
         self._stopped_time = None
         self._testbed_order = []
+        self._phase_graph = None
+        self._execute_data = None
+        self._execute_writer = IncrementalXmlWriter()
+        self._execute_snapshot = dict()
+        self._persisted_execute_xml = None
+        self._netref_parse_cache = dict()
+        self._netref_values = dict()
+        self._parsed_data = dict()
+        self._parsed_data_lock = threading.Lock()
+        # netrefs of different testbeds are resolved concurrently
+        self._netrefs_lock = threading.RLock()
+        self._timeline = Timeline()
+        self._pool = WorkerPool(self.MAX_PARALLEL)
+        self._journal = Journal(os.path.join(root_dir, "experiment-journal.log"))
+        self._completed_phases = dict()
+        self._journaled_netrefs = dict()
       
         self._logger = logging.getLogger('nepi.core.execute')
         level = logging.ERROR
@@ -276,6 +464,7 @@ class ExperimentController(object):
     @property
     def guids(self):
         guids = list()
+        self._fetch_guids_in_testbeds()
         for testbed_guid in self._testbeds.keys():
             _guids = self._guids_in_testbed(testbed_guid)
             if _guids:
@@ -289,10 +478,14 @@ class ExperimentController(object):
         f.close()
 
     def persist_execute_xml(self):
+        if self._experiment_execute_xml is self._persisted_execute_xml:
+            # nothing changed since it was last written
+            return
         xml_path = os.path.join(self._root_dir, "experiment-execute.xml")
         f = open(xml_path, "w")
         f.write(self._experiment_execute_xml)
         f.close()
+        self._persisted_execute_xml = self._experiment_execute_xml
 
     def load_experiment_xml(self):
         xml_path = os.path.join(self._root_dir, "experiment-design.xml")
@@ -312,54 +505,91 @@ class ExperimentController(object):
             return testbed.trace(guid, trace_id, attribute)
         raise RuntimeError("No element exists with guid %d" % guid)    
 
+    def read_trace(self, guid, trace_id, offset, length):
+        testbed = self._testbed_for_guid(guid)
+        if testbed != None:
+            return testbed.read_trace(guid, trace_id, offset, length)
+        raise RuntimeError("No element exists with guid %d" % guid)    
+
     def traces_info(self):
+        # ask all testbeds at once
+        testbeds = self._testbeds.items()
+        tinfos = defer.gather([ testbed.traces_info_deferred() 
+            for guid, testbed in testbeds ])
         traces_info = dict()
-        for guid, testbed in self._testbeds.iteritems():
-            tinfo = testbed.traces_info()
+        for (guid, testbed), tinfo in zip(testbeds, tinfos):
             if tinfo:
-                traces_info[guid] = testbed.traces_info()
+                traces_info[guid] = tinfo
         return traces_info
 
-    @staticmethod
-    def _parallel(callables):
-        excs = []
-        def wrap(callable):
-            def wrapped(*p, **kw):
-                try:
-                    callable(*p, **kw)
-                except:
-                    logging.exception("Exception occurred in asynchronous thread:")
-                    excs.append(sys.exc_info())
-            try:
-                wrapped = functools.wraps(callable)(wrapped)
-            except:
-                # functools.partial not wrappable
-                pass
-            return wrapped
-        threads = [ threading.Thread(target=wrap(callable)) for callable in callables ]
-        for thread in threads:
-            thread.start()
-        for thread in threads:
-            thread.join()
-        for exc in excs:
-            eTyp, eVal, eLoc = exc
-            raise eTyp, eVal, eLoc
+    def _parallel(self, callables, cancel_on_error = True):
+        # Runs in the controller's worker pool, which bounds concurrency
+        # and records each task's wall time (see task_times)
+        return self._pool.run_all(callables, self.TASK_TIMEOUT, 
+            cancel_on_error)
+
+    def task_times(self):
+        """
+        Returns the (name, start, end) times of the latest tasks run
+        concurrently by the controller, in completion order.
+        """
+        return list(self._pool.times)
 
     def start(self):
         self._started_time = time.time() 
         self._start()
 
+    def _experiment_data(self, xml):
+        """
+        Returns a copy-on-write view of the data of the given experiment 
+        xml, which is only parsed the first time it's seen.
+        """
+        if isinstance(xml, unicode):
+            key = hashlib.sha1(xml.encode("utf-8")).digest()
+        else:
+            key = hashlib.sha1(xml).digest()
+        with self._parsed_data_lock:
+            data = self._parsed_data.get(key)
+            if data is None:
+                parser = XmlExperimentParser()
+                data = self._parsed_data[key] = parser.from_xml_to_data(xml)
+        return data.copy()
+
     def _start(self, recover = False):
-        parser = XmlExperimentParser()
-        
+        start = time.time()
+        try:
+            self._start_phases(recover)
+        finally:
+            self._timeline.record("recover" if recover else "deploy", 
+                "experiment", start, time.time(), 0)
+            if self.DUMP_TIMELINE:
+                try:
+                    self.dump_timeline()
+                except:
+                    self._logger.exception("Dumping the deployment timeline")
+
+    def _start_phases(self, recover):
         if recover:
             xml = self._experiment_execute_xml
         else:
             xml = self._experiment_design_xml
-        data = parser.from_xml_to_data(xml)
+        data = self._experiment_data(xml)
+        
+        # netref values are memoized for the whole deployment, 
+        # but not from one deployment to the next
+        self._netref_values = dict()
+        
+        if recover:
+            # skip whatever the journal says was already done
+            self._load_journal(data)
+        else:
+            self._journal.reset()
+            self._completed_phases.clear()
+            self._journaled_netrefs.clear()
 
         # instantiate testbed controllers
         to_recover, to_restart = self._init_testbed_controllers(data, recover)
+        self._skip_journaled(to_recover, to_restart)
         all_restart = set(to_restart)
         
         if not recover:
@@ -367,141 +597,367 @@ class ExperimentController(object):
             self._persist_testbed_proxies()
         else:
             # recover recoverable controllers
-            for guid in to_recover:
-                try:
-                    self._testbeds[guid].do_setup()
-                    self._testbeds[guid].recover()
-                except:
-                    self._logger.exception("During recovery of testbed %s", guid)
-                    
-                    # Mark failed
-                    self._failed_testbeds.add(guid)
-    
-        def steps_to_configure(self, allowed_guids):
-            # perform setup in parallel for all test beds,
-            # wait for all threads to finish
-
-            self._logger.debug("ExperimentController: Starting parallel do_setup")
-            self._parallel([testbed.do_setup 
-                            for guid,testbed in self._testbeds.iteritems()
-                            if guid in allowed_guids])
-       
-            # perform create-connect in parallel, wait
-            # (internal connections only)
-            self._logger.debug("ExperimentController: Starting parallel do_create")
-            self._parallel([testbed.do_create
-                            for guid,testbed in self._testbeds.iteritems()
-                            if guid in allowed_guids])
-
-            self._logger.debug("ExperimentController: Starting parallel do_connect_init")
-            self._parallel([testbed.do_connect_init
-                            for guid,testbed in self._testbeds.iteritems()
-                            if guid in allowed_guids])
-
-            self._logger.debug("ExperimentController: Starting parallel do_connect_fin")
-            self._parallel([testbed.do_connect_compl
-                            for guid,testbed in self._testbeds.iteritems()
-                            if guid in allowed_guids])
-
-            self._logger.debug("ExperimentController: Starting parallel do_preconfigure")
-            self._parallel([testbed.do_preconfigure
-                            for guid,testbed in self._testbeds.iteritems()
-                            if guid in allowed_guids])
-            self._clear_caches()
-            
-            # Store testbed order
-            self._testbed_order.append(allowed_guids)
+            self._recover_testbed_controllers(to_recover)
+        
+        # Each testbed advances through its phases on its own, waiting
+        # only for those it depends upon (see _start_graph)
+        graph = self._start_graph(data, recover, to_restart, all_restart)
+        try:
+            graph.run(pool = self._pool, timeout = self.TASK_TIMEOUT)
+        finally:
+            self._log_start_graph(graph)
 
-        steps_to_configure(self, to_restart)
+    def _recover_testbed_controllers(self, to_recover):
+        for guid in to_recover:
+            try:
+                self._testbeds[guid].do_setup()
+                self._testbeds[guid].recover()
+            except:
+                self._logger.exception("During recovery of testbed %s", guid)
+                
+                # Mark failed
+                self._failed_testbeds.add(guid)
 
-        if self._netreffed_testbeds:
-            self._logger.debug("ExperimentController: Resolving netreffed testbeds")
-            # initally resolve netrefs
-            self.do_netrefs(data, fail_if_undefined=False)
+    def _load_journal(self, data):
+        """
+        Loads the phases each testbed completed and the netref values
+        resolved before recovery, and injects those of testbed attributes
+        into data, so that testbeds whose deployment configuration depends
+        on them can be reconnected to right away.
+        """
+        self._completed_phases.clear()
+        self._journaled_netrefs.clear()
+        for record in self._journal.load():
+            kind = record[0]
+            if kind == "phase":
+                (testbed_guid, step) = record[1:]
+                self._completed_phases.setdefault(testbed_guid, set()).add(step)
+            elif kind == "netref":
+                (testbed_guid, guid, name, value) = record[1:]
+                self._journaled_netrefs[(testbed_guid, guid, name)] = value
+            elif kind == "reset":
+                testbed_guid = record[1]
+                self._completed_phases.pop(testbed_guid, None)
+                for node in self._journaled_netrefs.keys():
+                    if node[0] == testbed_guid:
+                        del self._journaled_netrefs[node]
+        
+        for (testbed_guid, guid, name), value in self._journaled_netrefs.iteritems():
+            if guid is None:
+                data.set_attribute_data(testbed_guid, name, value)
+
+    def _skip_journaled(self, to_recover, to_restart):
+        # Testbeds that couldn't be reconnected to start over
+        for guid in to_recover | to_restart:
+            if self._completed_phases.pop(guid, None) is not None:
+                self._journal.record("reset", guid)
+        
+        # Netreffed attributes of reconnected testbeds are already set
+        for (testbed_guid, guid, name) in self._journaled_netrefs:
+            if (guid is not None and testbed_guid in self._testbeds 
+                    and testbed_guid in self._completed_phases):
+                attrs = self._netrefs.get((testbed_guid, guid))
+                if attrs is not None:
+                    attrs.discard(name)
+                    if not attrs:
+                        del self._netrefs[(testbed_guid, guid)]
+
+    def _phase_pending(self, guid, step, allowed_guids = None):
+        # Testbeds the journal knows about replay only the phases they 
+        # hadn't completed, others only run those of allowed_guids
+        done = self._completed_phases.get(guid)
+        if done is None:
+            return allowed_guids is None or guid in allowed_guids
+        return step not in done
+
+    def _start_graph(self, data, recover, to_restart, all_restart):
+        """
+        Returns a TaskGraph with the deployment phases of all testbeds:
+        
+            - do_setup through do_preconfigure, per testbed
+            - for testbeds whose deployment configuration depends on 
+              netrefs, their creation once all others are preconfigured, 
+              and then their own do_setup through do_preconfigure
+            - netref resolution and programming of cross connections, 
+              per testbed, once it, the testbeds its netrefs refer to 
+              and those it's cross-connected with are preconfigured
+            - do_configure, per testbed
+            - do_cross_connect_init, per testbed, once it and the testbeds
+              it's cross-connected with are configured
+            - do_cross_connect_compl, per testbed, once it and its 
+              cross-connected testbeds have done their init
+            - do_prestart, per testbed, once it and its cross-connected
+              testbeds are cross-connected
+            - final netref resolution, per testbed, once it and the 
+              testbeds it refers to or is cross-connected with are 
+              prestarted
+            - start, per testbed, right after its final netref resolution
+            - execute xml persistence, once all netrefs are resolved, 
+              alongside the starts
+        
+        See _add_cross_connect_steps for the ordering of cross-connection
+        steps.
+        
+        Each testbed phase is journaled once done, and when recovering, 
+        testbeds that could be reconnected to only run the phases missing 
+        from the journal (see _phase_pending).
+        """
+        graph = TaskGraph()
+        testbed_guids = sorted([ guid for guid in data.guids 
+            if data.is_testbed_data(guid) ])
+        cross_peers = self._cross_testbed_peers(data)
+        netref_deps = self._netref_testbed_deps(data)
+        
+        def related(guid):
+            # testbeds guid's phases may depend upon
+            return sorted(netref_deps.get(guid, set([guid])) 
+                | cross_peers[guid] | set([guid]))
+        
+        def testbed_step(guid, step, allowed_guids):
+            def run():
+                if guid in self._testbeds and self._phase_pending(
+                        guid, step, allowed_guids):
+                    getattr(self._testbeds[guid], step)()
+                    self._journal.record("phase", guid, step)
+            return run
+        
+        def add_steps_to_configure(allowed_guids, candidates, deps = ()):
+            # allowed_guids may still grow until the tasks run
+            last = []
+            for guid in candidates:
+                prev = list(deps)
+                for step in ("do_setup", "do_create", "do_connect_init", 
+                        "do_connect_compl", "do_preconfigure"):
+                    prev = [ graph.add("%s[%d]" % (step, guid), 
+                        testbed_step(guid, step, allowed_guids), prev) ]
+                last.extend(prev)
+            return last
+        
+        # netreffed testbeds are in to_restart, but not created yet
+        restart_first = set(to_restart) - self._netreffed_testbeds
+        self._testbed_order.append(restart_first)
+        configured = add_steps_to_configure(restart_first, sorted(restart_first))
+        
+        netreffed_testbeds = sorted(self._netreffed_testbeds)
+        if netreffed_testbeds:
+            restart_netreffed = set()
             
-            # rinse and repeat, for netreffed testbeds
-            netreffed_testbeds = set(self._netreffed_testbeds)
-
-            to_recover, to_restart = self._init_testbed_controllers(data, recover)
-            all_restart.update(to_restart)
+            def init_netreffed_testbeds():
+                self._clear_caches()
+                self._logger.debug("ExperimentController: Resolving netreffed testbeds")
+                # initally resolve netrefs
+                self.do_netrefs(data, fail_if_undefined=False)
+                
+                # rinse and repeat, for netreffed testbeds
+                to_recover, to_restart = self._init_testbed_controllers(data, recover)
+                self._skip_journaled(to_recover, to_restart)
+                all_restart.update(to_restart)
+                restart_netreffed.update(to_restart)
+                
+                if not recover:
+                    # persist testbed connection data, for potential recovery
+                    self._persist_testbed_proxies()
+                else:
+                    # recover recoverable controllers
+                    self._recover_testbed_controllers(to_recover)
+                
+                self._testbed_order.append(restart_netreffed)
             
-            if not recover:
-                # persist testbed connection data, for potential recovery
-                self._persist_testbed_proxies()
-            else:
-                # recover recoverable controllers
-                for guid in to_recover:
-                    try:
-                        self._testbeds[guid].do_setup()
-                        self._testbeds[guid].recover()
-                    except:
-                        self._logger.exception("During recovery of testbed %s", guid)
-
-                        # Mark failed
-                        self._failed_testbeds.add(guid)
-
-            # configure dependant testbeds
-            steps_to_configure(self, to_restart)
+            init = graph.add("init_netreffed_testbeds", 
+                init_netreffed_testbeds, configured)
+            add_steps_to_configure(restart_netreffed, netreffed_testbeds, [init])
+        
+        def configured_deps(guids):
+            # testbeds that aren't restarted were configured already,
+            # but netreffed ones only exist after init_netreffed_testbeds
+            deps = set()
+            for guid in guids:
+                name = "do_preconfigure[%d]" % (guid,)
+                if name in graph:
+                    deps.add(name)
+                elif guid in self._netreffed_testbeds \
+                        and "init_netreffed_testbeds" in graph:
+                    deps.add("init_netreffed_testbeds")
+            return sorted(deps)
+        
+        def program_cross_connections(guid):
+            def run():
+                self._clear_caches()
+                
+                self._logger.debug("ExperimentController: Resolving do_netrefs "
+                    "for testbed %d", guid)
+                self.do_netrefs(data, fail_if_undefined=False, 
+                    testbed_guids=netref_deps.get(guid))
+               
+                # Only now, that netref dependencies have been solve, it is safe to
+                # program cross_connections, unless the testbed was already
+                # cross-connected before recovery
+                if any([ self._phase_pending(guid, step) 
+                        for step in ("do_cross_connect_init", "do_cross_connect_compl") ]):
+                    self._logger.debug("ExperimentController: Programming "
+                        "testbed %d cross-connections", guid)
+                    self._program_testbed_cross_connections(data, [guid])
+            return run
         
-        all_restart = [ self._testbeds[guid] for guid in all_restart ]
+        # do_configure is internal configuration for each testbed
+        for guid in testbed_guids:
+            cross_program = graph.add("program_cross_connections[%d]" % (guid,), 
+                program_cross_connections(guid), configured_deps(related(guid)))
+            graph.add("do_configure[%d]" % (guid,),
+                testbed_step(guid, "do_configure", all_restart), 
+                [cross_program])
+        
+        # cross-connect, all testbeds take part
+        self._add_cross_connect_steps(graph, testbed_guids, cross_peers)
+        
+        # Last chance to configure
+        for guid in testbed_guids:
+            graph.add("do_prestart[%d]" % (guid,),
+                testbed_step(guid, "do_prestart", all_restart),
+                [ "do_cross_connect_compl[%d]" % (peer,) 
+                  for peer in [guid] + sorted(cross_peers[guid]) ])
+        
+        def resolve_netrefs(guid):
+            def run():
+                # final netref step, fail if anything's left unresolved
+                self.do_netrefs(data, fail_if_undefined=True, 
+                    testbed_guids=netref_deps.get(guid))
+            return run
+        
+        # start experiment, each testbed once those it relates to are 
+        # ready to go too
+        resolved = []
+        for guid in testbed_guids:
+            resolved.append(graph.add("resolve_netrefs[%d]" % (guid,),
+                resolve_netrefs(guid), 
+                [ "do_prestart[%d]" % (peer,) for peer in related(guid) ]))
+            graph.add("start[%d]" % (guid,),
+                testbed_step(guid, "start", all_restart), [resolved[-1]])
+        
+        def persist_execute_data():
+            self._clear_caches()
             
-        # final netref step, fail if anything's left unresolved
-        self._logger.debug("ExperimentController: Resolving do_netrefs")
-        self.do_netrefs(data, fail_if_undefined=False)
-       
-        # Only now, that netref dependencies have been solve, it is safe to
-        # program cross_connections
-        self._logger.debug("ExperimentController: Programming testbed cross-connections")
-        self._program_testbed_cross_connections(data)
- 
-        # perform do_configure in parallel for al testbeds
-        # (it's internal configuration for each)
-        self._logger.debug("ExperimentController: Starting parallel do_configure")
-        self._parallel([testbed.do_configure
-                        for testbed in all_restart])
-
-        self._clear_caches()
-
-        #print >>sys.stderr, "DO IT"
-        #import time
-        #time.sleep(60)
+            if not recover:
+                # update execution xml with execution-specific values
+                # TODO: BUG! BUggy code! cant stand all serializing all attribute values (ej: tun_key which is non ascci)"
+                self._update_execute_xml()
+                self.persist_execute_xml()
         
-        # cross-connect (cannot be done in parallel)
-        self._logger.debug("ExperimentController: Starting cross-connect")
-        for guid, testbed in self._testbeds.iteritems():
-            cross_data = self._get_cross_data(guid)
-            testbed.do_cross_connect_init(cross_data)
-        for guid, testbed in self._testbeds.iteritems():
-            cross_data = self._get_cross_data(guid)
-            testbed.do_cross_connect_compl(cross_data)
-       
-        self._clear_caches()
-
-        # Last chance to configure (parallel on all testbeds)
-        self._logger.debug("ExperimentController: Starting parallel do_prestart")
-        self._parallel([testbed.do_prestart
-                        for testbed in all_restart])
-
-        # final netref step, fail if anything's left unresolved
-        self.do_netrefs(data, fail_if_undefined=True)
- 
-        self._clear_caches()
+        # off the critical path, starts don't wait for it
+        graph.add("persist_execute_data", persist_execute_data, resolved)
         
-        if not recover:
-            # update execution xml with execution-specific values
-            # TODO: BUG! BUggy code! cant stand all serializing all attribute values (ej: tun_key which is non ascci)"
-            self._update_execute_xml()
-            self.persist_execute_xml()
-
-        # start experiment (parallel start on all testbeds)
-        self._logger.debug("ExperimentController: Starting parallel do_start")
-        self._parallel([testbed.start
-                        for testbed in all_restart])
-
+        return graph
+
+    def _add_cross_connect_steps(self, graph, testbed_guids, cross_peers):
+        # Cross-connection steps read their peers' attributes, which their 
+        # peers' own steps may change, so within each pair of 
+        # cross-connected testbeds they run in guid order, as they did when 
+        # all of them ran one after the other. Pairs that share no testbed 
+        # don't wait for each other, unless DETERMINISTIC_CROSS_CONNECT is
+        # set, which orders all of them as a single sequence: every
+        # do_cross_connect_init first, and then every do_cross_connect_compl.
+        def cross_connect_step(guid, step):
+            def run():
+                testbed = self._testbeds.get(guid)
+                if testbed is not None and self._phase_pending(guid, step):
+                    cross_data = self._get_cross_data(guid)
+                    getattr(testbed, step)(cross_data)
+                    self._journal.record("phase", guid, step)
+            return run
+        
+        prev = None
+        for step, prev_step in (
+                ("do_cross_connect_init", "do_configure"),
+                ("do_cross_connect_compl", "do_cross_connect_init")):
+            for guid in testbed_guids:
+                peers = sorted(cross_peers[guid])
+                deps = [ "%s[%d]" % (prev_step, peer) for peer in [guid] + peers ]
+                if self.DETERMINISTIC_CROSS_CONNECT:
+                    if prev is not None and prev not in deps:
+                        deps.append(prev)
+                else:
+                    deps.extend([ "%s[%d]" % (step, peer) 
+                        for peer in peers if peer < guid ])
+                prev = graph.add("%s[%d]" % (step, guid),
+                    cross_connect_step(guid, step), deps)
+
+    def _log_start_graph(self, graph):
         self._clear_caches()
+        # kept for inspection
+        self._phase_graph = graph
+        for name, (start, end) in graph.times.iteritems():
+            # per-testbed phases go in the testbed's track
+            match = re.match(r".*\[(\d+)\]$", name)
+            tid = int(match.group(1)) if match else 0
+            self._timeline.record(name, "phase", start, end, tid)
+        self._logger.debug("ExperimentController: phase graph:\n%s", 
+            graph.describe())
+        path = graph.critical_path()
+        if path:
+            self._logger.debug("ExperimentController: critical path "
+                "(%.3fs): %s", path[-1][2] - path[0][1], 
+                " -> ".join([ "%s (%.3fs)" % (name, end - start)
+                              for name, start, end in path ]))
+
+    def _netref_testbed_deps(self, data):
+        """
+        Returns a dict mapping each testbed guid to the guids of the 
+        testbeds its netreffed attributes refer to, directly or through
+        other netreffed attributes, itself included.
+        """
+        refs = collections.defaultdict(set)
+        for guid in data.guids:
+            if data.is_testbed_data(guid):
+                testbed_guid = guid
+            else:
+                (testbed_guid, factory_id) = data.get_box_data(guid)
+            for name, value in data.get_attribute_data(guid):
+                if not isinstance(value, basestring):
+                    continue
+                try:
+                    netrefs = self._parse_netrefs(value)
+                except ValueError:
+                    # malformed, reported when resolving it
+                    continue
+                for ref in netrefs:
+                    if data.is_testbed_data(ref.guid):
+                        refs[testbed_guid].add(ref.guid)
+                    else:
+                        box_data = data.get_box_data(ref.guid)
+                        if box_data is not None:
+                            refs[testbed_guid].add(box_data[0])
+        
+        deps = dict()
+        for guid in data.guids:
+            if data.is_testbed_data(guid):
+                closure = set([guid])
+                pending = [guid]
+                while pending:
+                    for ref in refs[pending.pop()] - closure:
+                        closure.add(ref)
+                        pending.append(ref)
+                deps[guid] = closure
+        return deps
+
+    def _cross_testbed_peers(self, data):
+        # testbed guid -> guids of testbeds it has cross connections with
+        peers = collections.defaultdict(set)
+        for guid in data.guids:
+            if not data.is_testbed_data(guid):
+                (testbed_guid, factory_id) = data.get_box_data(guid)
+                for (connector_type_name, cross_guid, cross_connector_type_name) \
+                        in data.get_connection_data(guid):
+                    (cross_testbed_guid, cross_factory_id) = data.get_box_data(
+                            cross_guid)
+                    if testbed_guid != cross_testbed_guid:
+                        peers[testbed_guid].add(cross_testbed_guid)
+                        peers[cross_testbed_guid].add(testbed_guid)
+        return peers
 
     def _clear_caches(self):
         # Cleaning cache for safety.
+        # Netref values aren't, the ones that get written are 
+        # updated or forgotten as that happens.
         self._guids_in_testbed_cache = dict()
 
     def _persist_testbed_proxies(self):
@@ -563,58 +1019,36 @@ class ExperimentController(object):
             self._logger.exception("Loading testbed configuration")
 
     def _update_execute_xml(self):
-        # For all testbeds,
-        #   For all elements in testbed,
-        #       - gather immutable execute-readable attribuets lists
-        #         asynchronously
-        # Generate new design description from design xml
-        # (Wait for attributes lists - implicit syncpoint)
-        # For all testbeds,
-        #   For all elements in testbed,
-        #       - gather all immutable execute-readable attribute
-        #         values, asynchronously
-        # (Wait for attribute values - implicit syncpoint)
-        # For all testbeds,
-        #   For all elements in testbed,
-        #       - inject non-None values into new design
-        # Generate execute xml from new design
-
-        attribute_lists = dict(
-            (testbed_guid, collections.defaultdict(dict))
-            for testbed_guid in self._testbeds
-        )
-        
-        for testbed_guid, testbed in self._testbeds.iteritems():
-            guids = self._guids_in_testbed(testbed_guid)
-            for guid in guids:
-                attribute_lists[testbed_guid][guid] = \
-                    testbed.get_attribute_list_deferred(guid, Attribute.ExecImmutable)
+        # Gather the values of all immutable execute-readable attributes
+        # with a single call to each testbed, all testbeds at once, and
+        # inject them into the design description. Only the sections of 
+        # elements whose values changed since the last update are 
+        # serialized again.
+        testbeds = self._testbeds.items()
+        snapshots = defer.gather([ 
+            testbed.snapshot_attributes_deferred(Attribute.ExecImmutable)
+            for testbed_guid, testbed in testbeds ])
         
-        parser = XmlExperimentParser()
-        execute_data = parser.from_xml_to_data(self._experiment_design_xml)
-
-        attribute_values = dict(
-            (testbed_guid, collections.defaultdict(dict))
-            for testbed_guid in self._testbeds
-        )
-        
-        for testbed_guid, testbed_attribute_lists in attribute_lists.iteritems():
-            testbed = self._testbeds[testbed_guid]
-            for guid, attribute_list in testbed_attribute_lists.iteritems():
-                attribute_list = _undefer(attribute_list)
-                attribute_values[testbed_guid][guid] = dict(
-                    (attribute, testbed.get_deferred(guid, attribute))
-                    for attribute in attribute_list
-                )
-        
-        for testbed_guid, testbed_attribute_values in attribute_values.iteritems():
-            for guid, attribute_values in testbed_attribute_values.iteritems():
-                for attribute, value in attribute_values.iteritems():
-                    value = _undefer(value)
-                    if value is not None:
+        if self._execute_data is None:
+            self._execute_data = self._experiment_data(
+                self._experiment_design_xml)
+            self._execute_writer.invalidate()
+            self._execute_snapshot.clear()
+        execute_data = self._execute_data
+        
+        changed = set()
+        for snapshot in snapshots:
+            for guid, attribute_values in snapshot.iteritems():
+                if attribute_values != self._execute_snapshot.get(guid):
+                    for attribute, value in attribute_values.iteritems():
                         execute_data.add_attribute_data(guid, attribute, value)
+                    self._execute_snapshot[guid] = attribute_values
+                    changed.add(guid)
         
-        self._experiment_execute_xml = parser.to_xml(data=execute_data)
+        if changed or self._experiment_execute_xml is None:
+            self._execute_writer.invalidate(changed)
+            self._experiment_execute_xml = self._execute_writer.to_xml(
+                execute_data)
 
     def stop(self):
        for testbed in self._testbeds.values():
@@ -635,11 +1069,65 @@ class ExperimentController(object):
         if testbed != None:
             return testbed.status(guid) == AS.STATUS_FINISHED
         raise RuntimeError("No element exists with guid %d" % guid)    
+
+    def is_finished_all(self, guids):
+        """
+        Returns True if all the given elements have finished, asking
+        each testbed about all of its elements at once.
+        """
+        by_testbed, unknown = self._guids_by_testbed(guids)
+        unknown.extend([ guid
+            for testbed_guid in by_testbed.viewkeys() & self._failed_testbeds
+            for guid in by_testbed[testbed_guid] ])
+        if unknown:
+            raise RuntimeError("No element exists with guid %d" % unknown[0])
+        return all(defer.gather([ 
+            self._testbeds[testbed_guid].is_finished_all_deferred(testbed_guids)
+            for testbed_guid, testbed_guids in by_testbed.iteritems() ]))
+    
+    def wait_for(self, guids, state = AS.STATUS_FINISHED, timeout = None):
+        """
+        Blocks until all the given elements are in the given state,
+        and returns True, or returns False if timeout seconds elapse 
+        first, or if a testbed holding any of them fails or stops.
+        
+        Statuses are polled on the testbeds' side: each testbed 
+        involved is asked to wait for all of its elements at once, 
+        and replies as soon as it sees them done, so this takes one
+        call per testbed (per WAIT_SLICE), rather than one per element
+        and poll.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        
+        pending, unknown = self._guids_by_testbed(guids)
+        if unknown:
+            raise RuntimeError("No element exists with guid %d" % unknown[0])
+        
+        while pending:
+            if pending.viewkeys() & self._failed_testbeds:
+                return False
+            wait = self.WAIT_SLICE
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return False
+            
+            testbed_guids = pending.keys()
+            done = defer.gather([ 
+                self._testbeds[testbed_guid].wait_for_deferred(
+                    pending[testbed_guid], state, wait)
+                for testbed_guid in testbed_guids ])
+            for testbed_guid, testbed_done in zip(testbed_guids, done):
+                if testbed_done:
+                    del pending[testbed_guid]
+                elif (self._testbeds[testbed_guid].testbed_status() 
+                        == TS.STATUS_STOPPED):
+                    return False
+        return True
     
     def _testbed_recovery_policy(self, guid, data = None):
         if data is None:
-            parser = XmlExperimentParser()
-            data = parser.from_xml_to_data(self._experiment_design_xml)
+            data = self._experiment_data(self._experiment_design_xml)
         
         return data.get_attribute_data(guid, DC.RECOVERY_POLICY)
 
@@ -662,10 +1150,41 @@ class ExperimentController(object):
             else:
                 return AS.STATUS_UNDETERMINED
 
+    def status_many(self, guids):
+        """
+        Returns a list with the status of each of the given elements
+        or testbeds, like status does, in the same order, asking each
+        testbed about all of its elements at once.
+        """
+        statuses = dict()
+        element_guids = []
+        for guid in guids:
+            if guid in self._testbeds:
+                statuses[guid] = self.status(guid)
+            else:
+                element_guids.append(guid)
+        
+        by_testbed, unknown = self._guids_by_testbed(element_guids)
+        for testbed_guid in by_testbed.keys():
+            if testbed_guid in self._failed_testbeds:
+                unknown.extend(by_testbed.pop(testbed_guid))
+        for guid in unknown:
+            statuses[guid] = AS.STATUS_UNDETERMINED
+        
+        testbed_guids = by_testbed.keys()
+        replies = defer.gather([ 
+            self._testbeds[testbed_guid].status_many_deferred(
+                by_testbed[testbed_guid])
+            for testbed_guid in testbed_guids ])
+        for testbed_guid, reply in zip(testbed_guids, replies):
+            statuses.update(zip(by_testbed[testbed_guid], reply))
+        return [ statuses[guid] for guid in guids ]
+
     def set(self, guid, name, value, time = TIME_NOW):
         testbed = self._testbed_for_guid(guid)
         if testbed != None:
             testbed.set(guid, name, value, time)
+            self._netref_values.pop(Netref.make_key(guid, name), None)
         else:
             raise RuntimeError("No element exists with guid %d" % guid)    
 
@@ -675,6 +1194,12 @@ class ExperimentController(object):
             return testbed.get(guid, name, time)
         raise RuntimeError("No element exists with guid %d" % guid)    
 
+    def get_many(self, guid, names, time = TIME_NOW):
+        testbed = self._testbed_for_guid(guid)
+        if testbed != None:
+            return testbed.get_many(guid, names, time)
+        raise RuntimeError("No element exists with guid %d" % guid)    
+
     def get_deferred(self, guid, name, time = TIME_NOW):
         testbed = self._testbed_for_guid(guid)
         if testbed != None:
@@ -699,6 +1224,81 @@ class ExperimentController(object):
             return testbed.testbed_version
         raise RuntimeError("No element exists with guid %d" % guid)    
 
+    def rpc_stats(self):
+        """
+        Returns the RPC statistics (see nepi.util.rpcstats) of the
+        testbed controllers running as servers, by testbed guid, 
+        as measured by this controller (client) and by the testbed
+        controller itself (server).
+        """
+        stats = dict()
+        for guid, testbed in self._testbeds.iteritems():
+            if hasattr(testbed, 'client_stats'):
+                stats[guid] = dict(
+                    client = testbed.client_stats(),
+                    server = testbed.stats())
+        return dict(
+            enabled = rpcstats.ENABLED,
+            testbeds = stats)
+
+    def dump_rpc_stats(self, path = None):
+        """
+        Dumps rpc_stats() as JSON into path, rpc-stats.json in the
+        root directory by default, and returns the path.
+        """
+        if path is None:
+            path = os.path.join(self._root_dir, "rpc-stats.json")
+        f = open(path, "w")
+        try:
+            json.dump(self.rpc_stats(), f, indent = 1, sort_keys = True)
+        finally:
+            f.close()
+        return path
+
+    def timeline(self):
+        """
+        Returns the deployment timeline as a trace event document (see 
+        nepi.util.timeline): the phases run by this controller, with a 
+        track per testbed, and the factory steps and element actions 
+        of each testbed, in a process of their own.
+        """
+        timelines = dict()
+        def fetch(guid, testbed):
+            try:
+                timelines[guid] = testbed.timeline()
+            except:
+                self._logger.exception("Fetching the timeline of testbed %s", 
+                    guid)
+        self._parallel([ functools.partial(fetch, guid, testbed)
+            for guid, testbed in self._testbeds.items() ], 
+            cancel_on_error = False)
+        
+        thread_names = dict([ (guid, "testbed %d" % (guid,)) 
+            for guid in self._testbeds ])
+        thread_names[0] = "controller"
+        processes = [ (0, "experiment controller", thread_names, 
+            self._timeline.events()) ]
+        for guid, events in sorted(timelines.iteritems()):
+            processes.append((guid, "testbed %d (%s)" % (
+                guid, self._testbeds[guid].testbed_id), dict(), events))
+        return to_trace_events(processes)
+
+    def dump_timeline(self, path = None):
+        """
+        Dumps timeline() as JSON into path, experiment-timeline.json in 
+        the root directory by default, next to the execute xml, and 
+        returns the path. It's done after every start or recovery if 
+        DUMP_TIMELINE is set.
+        """
+        if path is None:
+            path = os.path.join(self._root_dir, "experiment-timeline.json")
+        f = open(path, "w")
+        try:
+            json.dump(self.timeline(), f)
+        finally:
+            f.close()
+        return path
+
     def shutdown(self):
         exceptions = list()
         ordered_testbeds = set()
@@ -711,24 +1311,36 @@ class ExperimentController(object):
             except:
                 exceptions.append(sys.exc_info())
                 
+        def shutdown_testbeds(guids):
+            # a testbed taking too long mustn't keep the rest running
+            try:
+                self._parallel([functools.partial(shutdown_testbed, guid)
+                                for guid in guids], False)
+            except:
+                exceptions.append(sys.exc_info())
+                
         self._logger.debug("ExperimentController: Starting parallel shutdown")
         
         for testbed_guids in reversed(self._testbed_order):
             testbed_guids = set(testbed_guids) - ordered_testbeds
             self._logger.debug("ExperimentController: Shutting down %r", testbed_guids)
-            self._parallel([functools.partial(shutdown_testbed, guid)
-                            for guid in testbed_guids])
+            shutdown_testbeds(testbed_guids)
         remaining_guids = set(self._testbeds) - ordered_testbeds
         if remaining_guids:
             self._logger.debug("ExperimentController: Shutted down %r", ordered_testbeds)
             self._logger.debug("ExperimentController: Shutting down %r", remaining_guids)
-            self._parallel([functools.partial(shutdown_testbed, guid)
-                            for guid in remaining_guids])
+            shutdown_testbeds(remaining_guids)
+        
+        # let idle workers go, and zygotes that launched testbeds
+        self._pool.close(self.TASK_TIMEOUT)
+        self._journal.close()
+        server.close_zygotes()
             
         for exc_info in exceptions:
             raise exc_info[0], exc_info[1], exc_info[2]
 
     def _testbed_for_guid(self, guid):
+        self._fetch_guids_in_testbeds()
         for testbed_guid in self._testbeds.keys():
             if guid in self._guids_in_testbed(testbed_guid):
                 if testbed_guid in self._failed_testbeds:
@@ -736,13 +1348,45 @@ class ExperimentController(object):
                 return self._testbeds[testbed_guid]
         return None
 
+    def _guids_by_testbed(self, guids):
+        """
+        Returns a dict mapping testbed guids to the given guids of their 
+        elements, in the given order, and a list of those not found in 
+        any testbed.
+        """
+        self._fetch_guids_in_testbeds()
+        by_testbed = collections.defaultdict(list)
+        unknown = []
+        for guid in guids:
+            for testbed_guid in self._testbeds.keys():
+                if guid in self._guids_in_testbed(testbed_guid):
+                    by_testbed[testbed_guid].append(guid)
+                    break
+            else:
+                unknown.append(guid)
+        return by_testbed, unknown
+
+    def _fetch_guids_in_testbeds(self):
+        # fill the guid cache for all testbeds with their requests in flight
+        # at once, rather than one round trip after the other
+        testbed_guids = [ testbed_guid 
+            for testbed_guid in self._testbeds.keys()
+            if testbed_guid not in self._guids_in_testbed_cache ]
+        if len(testbed_guids) > 1:
+            guids = defer.gather([ 
+                self._testbeds[testbed_guid].guids_deferred
+                for testbed_guid in testbed_guids ])
+            for testbed_guid, guid_list in zip(testbed_guids, guids):
+                self._guids_in_testbed_cache[testbed_guid] = set(guid_list)
+
     def _guids_in_testbed(self, testbed_guid):
         if testbed_guid not in self._testbeds:
             return set()
-        if testbed_guid not in self._guids_in_testbed_cache:
-            self._guids_in_testbed_cache[testbed_guid] = \
-                set(self._testbeds[testbed_guid].guids)
-        return self._guids_in_testbed_cache[testbed_guid]
+        # the cache may be cleared meanwhile
+        cache = self._guids_in_testbed_cache
+        if testbed_guid not in cache:
+            cache[testbed_guid] = set(self._testbeds[testbed_guid].guids)
+        return cache[testbed_guid]
 
     @staticmethod
     def _netref_component_split(component):
@@ -752,90 +1396,270 @@ class ExperimentController(object):
         else:
             return component, None
 
-    _NETREF_COMPONENT_GETTERS = {
+    # Testbed controller method and arguments that look up each kind
+    # of netref component
+    _NETREF_COMPONENT_CALLS = {
         'addr':
-            lambda testbed, guid, index, name: 
-                testbed.get_address(guid, int(index), name),
+            lambda guid, index, name: 
+                ('get_address', (guid, int(index), name)),
         'route' :
-            lambda testbed, guid, index, name: 
-                testbed.get_route(guid, int(index), name),
+            lambda guid, index, name: 
+                ('get_route', (guid, int(index), name)),
         'trace' :
-            lambda testbed, guid, index, name: 
-                testbed.trace(guid, index, attribute = name),
+            lambda guid, index, name: 
+                ('trace', (guid, index, name)),
         '' : 
-            lambda testbed, guid, index, name: 
-                testbed.get(guid, name),
+            lambda guid, index, name: 
+                ('get', (guid, name, TIME_NOW)),
     }
     
-    def resolve_netref_value(self, value, failval = None):
-        rv = failval
-        while True:
+    # Netrefs whose values contain further netrefs are followed 
+    # up to this depth
+    MAX_NETREF_DEPTH = 16
+    
+    def _parse_netrefs(self, value):
+        """
+        Returns the guid netrefs in value, as a tuple of Netref. 
+        Each distinct value is only parsed once.
+        """
+        refs = self._netref_parse_cache.get(value)
+        if refs is None:
+            refs = []
             for match in ATTRIBUTE_PATTERN_BASE.finditer(value):
                 label = match.group("label")
                 if label.startswith('GUID-'):
                     ref_guid = int(label[5:])
                     if ref_guid:
-                        expr = match.group("expr")
                         component = (match.group("component") or "")[1:] # skip the dot
-                        attribute = match.group("attribute")
                         
                         # split compound components into component kind and index
                         # eg: 'addr[0]' -> ('addr', '0')
                         component, component_index = self._netref_component_split(component)
+                        if component not in self._NETREF_COMPONENT_CALLS:
+                            raise ValueError, "Malformed netref: %r - unknown component" % (
+                                match.group("expr"),)
+                        
+                        refs.append(Netref(match.group(), ref_guid, component, 
+                            component_index, match.group("attribute")))
+            refs = self._netref_parse_cache[value] = tuple(refs)
+        return refs
 
-                        # find object and resolve expression
-                        for ref_testbed_guid, ref_testbed in self._testbeds.iteritems():
-                            if component not in self._NETREF_COMPONENT_GETTERS:
-                                raise ValueError, "Malformed netref: %r - unknown component" % (expr,)
-                            elif ref_guid not in self._guids_in_testbed(ref_testbed_guid):
-                                pass
-                            else:
-                                ref_value = self._NETREF_COMPONENT_GETTERS[component](
-                                    ref_testbed, ref_guid, component_index, attribute)
-                                if ref_value:
-                                    value = rv = value.replace(match.group(), ref_value)
-                                    break
-                        else:
-                            # unresolvable netref
-                            return failval
-                        break
-            else:
+    def _lookup_netrefs(self, keys):
+        """
+        Fetches the values netref keys refer to, if not already known,
+        with a single batch of calls to each testbed holding any of them.
+        Lookups that fail raise MulticallError, once the rest are done.
+        Values found are memoized for the rest of the deployment, 
+        attributes set through the controller are looked up again.
+        """
+        values = self._netref_values
+        by_testbed = collections.defaultdict(list)
+        keys = set(keys) - set(values)
+        if not keys:
+            return
+        
+        self._fetch_guids_in_testbeds()
+        for key in keys:
+            ref_guid = key[0]
+            for testbed_guid in self._testbeds.keys():
+                if ref_guid in self._guids_in_testbed(testbed_guid):
+                    by_testbed[testbed_guid].append(key)
+                    break
+        
+        def lookup(testbed_guid, keys):
+            multicall = self._testbeds[testbed_guid].multicall()
+            for ref_guid, component, component_index, attribute in keys:
+                methname, args = self._NETREF_COMPONENT_CALLS[component](
+                    ref_guid, component_index, attribute)
+                getattr(multicall, methname)(*args)
+            try:
+                results = multicall.flush()
+            except MulticallError, e:
+                # keep what was found, but don't hide the failures
+                results = e.results
+                errors.append(sys.exc_info())
+            for key, value in zip(keys, results):
+                if value:
+                    values[key] = value
+        
+        # raised here rather than from the tasks, which would log them, 
+        # callers may expect lookups to fail (see resolve_create_netref)
+        errors = []
+        self._parallel([ functools.partial(lookup, testbed_guid, keys)
+            for testbed_guid, keys in by_testbed.iteritems() ])
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def _resolve_netref_values(self, values):
+        """
+        Resolves the netrefs in each of the given values, all of them
+        at once, and returns the list of resolved values, with None
+        for those with unresolvable netrefs (or no netrefs at all).
+        """
+        results = list(values)
+        replaced = [False] * len(results)
+        pending = set(xrange(len(results)))
+        for depth in xrange(self.MAX_NETREF_DEPTH):
+            pending = set([ i for i in pending 
+                if self._parse_netrefs(results[i]) ])
+            if not pending:
                 break
+            
+            self._lookup_netrefs([ ref.key 
+                for i in pending 
+                for ref in self._parse_netrefs(results[i]) ])
+            
+            for i in list(pending):
+                value = results[i]
+                for ref in self._parse_netrefs(value):
+                    ref_value = self._netref_values.get(ref.key)
+                    if not ref_value:
+                        # unresolvable netref
+                        results[i] = None
+                        pending.discard(i)
+                        break
+                    value = value.replace(ref.text, ref_value)
+                else:
+                    results[i] = value
+                    replaced[i] = True
+        else:
+            # too deep, probably circular
+            for i in pending:
+                results[i] = None
+        
+        return [ value if done else None
+            for value, done in zip(results, replaced) ]
+    
+    def resolve_netref_value(self, value, failval = None):
+        rv = self._resolve_netref_values([value])[0]
+        if rv is None:
+            return failval
         return rv
     
-    def do_netrefs(self, data, fail_if_undefined = False):
-        # element netrefs
+    def _netref_graph(self, data, testbed_guids = None):
+        """
+        Returns the pending netreffed attributes, as a dict mapping
+        (testbed_guid, guid, name) to their current value, guid being
+        None for testbed attributes, and a dict mapping them to the 
+        pending attributes their value refers to.
+        
+        Only attributes of the given testbeds are included, if given.
+        """
+        values = dict()
+        
+        # element attributes, fetched with one batch per testbed
+        by_testbed = collections.defaultdict(list)
         for (testbed_guid, guid), attrs in self._netrefs.items():
-            testbed = self._testbeds.get(testbed_guid)
-            if testbed is not None:
-                for name in set(attrs):
-                    value = testbed.get(guid, name)
-                    if isinstance(value, basestring):
-                        ref_value = self.resolve_netref_value(value)
-                        if ref_value is not None:
-                            testbed.set(guid, name, ref_value)
-                            attrs.remove(name)
-                        elif fail_if_undefined:
-                            raise ValueError, "Unresolvable netref in: %r=%r" % (name,value,)
-                if not attrs:
-                    del self._netrefs[(testbed_guid, guid)]
-        
-        # testbed netrefs
+            if testbed_guids is not None and testbed_guid not in testbed_guids:
+                continue
+            if testbed_guid in self._testbeds:
+                for name in attrs:
+                    by_testbed[testbed_guid].append((guid, name))
+        
+        def fetch(testbed_guid, attrs):
+            multicall = self._testbeds[testbed_guid].multicall()
+            for guid, name in attrs:
+                multicall.get(guid, name, TIME_NOW)
+            for (guid, name), value in zip(attrs, multicall.flush()):
+                values[(testbed_guid, guid, name)] = value
+        
+        self._parallel([ functools.partial(fetch, testbed_guid, attrs)
+            for testbed_guid, attrs in by_testbed.iteritems() ])
+        
+        # testbed attributes
         for testbed_guid, attrs in self._testbed_netrefs.items():
+            if testbed_guids is not None and testbed_guid not in testbed_guids:
+                continue
             tb_data = dict(data.get_attribute_data(testbed_guid))
             if data:
-                for name in set(attrs):
-                    value = tb_data.get(name)
-                    if isinstance(value, basestring):
-                        ref_value = self.resolve_netref_value(value)
-                        if ref_value is not None:
-                            data.set_attribute_data(testbed_guid, name, ref_value)
-                            attrs.remove(name)
-                        elif fail_if_undefined:
-                            raise ValueError, "Unresolvable netref in: %r" % (value,)
-                if not attrs:
-                    del self._testbed_netrefs[testbed_guid]
+                for name in attrs:
+                    values[(testbed_guid, None, name)] = tb_data.get(name)
         
+        element_nodes = dict([ ((guid, name), node)
+            for node in values 
+            for testbed_guid, guid, name in (node,)
+            if guid is not None ])
+        deps = dict()
+        for node, value in values.iteritems():
+            deps[node] = set()
+            if isinstance(value, basestring):
+                for ref in self._parse_netrefs(value):
+                    if not ref.component:
+                        dep = element_nodes.get((ref.guid, ref.attribute))
+                        if dep is not None and dep != node:
+                            deps[node].add(dep)
+        return values, deps
+
+    def do_netrefs(self, data, fail_if_undefined = False, 
+            testbed_guids = None):
+        """
+        Resolves the pending netreffed attributes, of the given testbeds
+        only if given, which must then include all testbeds these refer
+        to, directly or not (see _netref_testbed_deps).
+        """
+        with self._netrefs_lock:
+            self._do_netrefs(data, fail_if_undefined, testbed_guids)
+    
+    def _do_netrefs(self, data, fail_if_undefined, testbed_guids):
+        # Netreffed attributes are resolved in dependency order, those
+        # only referring to already resolved ones all at once
+        values, deps = self._netref_graph(data, testbed_guids)
+        remaining = set(values)
+        while remaining:
+            level = [ node for node in remaining 
+                if not (deps[node] & remaining) ]
+            if not level:
+                # circular references, just try
+                level = list(remaining)
+            remaining.difference_update(level)
+            
+            level = [ node for node in level 
+                if isinstance(values[node], basestring) ]
+            resolved = self._resolve_netref_values([ values[node] 
+                for node in level ])
+            
+            multicalls = dict()
+            unresolved = None
+            journaled = []
+            for node, ref_value in zip(level, resolved):
+                testbed_guid, guid, name = node
+                if ref_value is None:
+                    if fail_if_undefined and unresolved is None:
+                        unresolved = node
+                    continue
+                
+                journaled.append(node + (ref_value,))
+                if guid is not None:
+                    if testbed_guid not in multicalls:
+                        multicalls[testbed_guid] = \
+                            self._testbeds[testbed_guid].multicall()
+                    multicalls[testbed_guid].set(guid, name, ref_value, 
+                        TIME_NOW)
+                    # others may refer to it
+                    self._netref_values[Netref.make_key(guid, name)] = ref_value
+                    attrs = self._netrefs[(testbed_guid, guid)]
+                    attrs.discard(name)
+                    if not attrs:
+                        del self._netrefs[(testbed_guid, guid)]
+                else:
+                    data.set_attribute_data(testbed_guid, name, ref_value)
+                    attrs = self._testbed_netrefs[testbed_guid]
+                    attrs.discard(name)
+                    if not attrs:
+                        del self._testbed_netrefs[testbed_guid]
+            
+            self._parallel([ mc.flush for mc in multicalls.values() ])
+            for record in journaled:
+                self._journal.record("netref", *record)
+            
+            if unresolved is not None:
+                testbed_guid, guid, name = unresolved
+                if guid is not None:
+                    raise ValueError, "Unresolvable netref in: %r=%r" % (
+                        name, values[unresolved])
+                else:
+                    raise ValueError, "Unresolvable netref in: %r" % (
+                        values[unresolved],)
 
     def _init_testbed_controllers(self, data, recover = False):
         blacklist_testbeds = set(self._testbeds)
@@ -856,33 +1680,40 @@ class ExperimentController(object):
                     label_guids[label] = guid
 
         # create testbed controllers
-        for guid in data_guids:
-            if data.is_testbed_data(guid):
-                if guid not in self._testbeds:
-                    try:
+        def create_testbed_controller(guid):
+            start = time.time()
+            try:
+                self._create_testbed_controller(
+                    guid, data, element_guids, recover)
+                if recover:
+                    # Already programmed
+                    blacklist_testbeds.add(guid)
+                else:
+                    to_restart.add(guid)
+            except:
+                if recover:
+                    policy = self._testbed_recovery_policy(guid, data=data)
+                    if policy == DC.POLICY_RECOVER:
                         self._create_testbed_controller(
-                            guid, data, element_guids, recover)
-                        if recover:
-                            # Already programmed
-                            blacklist_testbeds.add(guid)
-                        else:
-                            to_restart.add(guid)
-                    except:
-                        if recover:
-                            policy = self._testbed_recovery_policy(guid, data=data)
-                            if policy == DC.POLICY_RECOVER:
-                                self._create_testbed_controller(
-                                    guid, data, element_guids, False)
-                                to_recover.add(guid)
-                            elif policy == DC.POLICY_RESTART:
-                                self._create_testbed_controller(
-                                    guid, data, element_guids, False)
-                                to_restart.add(guid)
-                            else:
-                                # Mark failed
-                                self._failed_testbeds.add(guid)
-                        else:
-                            raise
+                            guid, data, element_guids, False)
+                        to_recover.add(guid)
+                    elif policy == DC.POLICY_RESTART:
+                        self._create_testbed_controller(
+                            guid, data, element_guids, False)
+                        to_restart.add(guid)
+                    else:
+                        # Mark failed
+                        self._failed_testbeds.add(guid)
+                else:
+                    raise
+            finally:
+                self._timeline.record("bootstrap[%d]" % (guid,), "phase", 
+                    start, time.time(), guid)
+        
+        self._bootstrap_testbed_controllers(
+            [ guid for guid in data_guids
+              if data.is_testbed_data(guid) and guid not in self._testbeds ],
+            data, create_testbed_controller)
         
         # queue programmable elements
         #  - that have not been programmed already (blacklist_testbeds)
@@ -903,6 +1734,44 @@ class ExperimentController(object):
         
         return to_recover, to_restart
 
+    def _bootstrap_testbed_controllers(self, guids, data, create):
+        # Each testbed controller is launched, connected to and configured
+        # in its own task, so that slow launches don't hold back others,
+        # but only up to MAX_BOOTSTRAP_PER_HOST at once on each host
+        if len(guids) <= 1:
+            map(create, guids)
+            return
+        
+        # proxy has to be imported before threads need it
+        import nepi.util.proxy
+        
+        host_slots = dict()
+        for guid in guids:
+            host = self._bootstrap_host(guid, data)
+            if host not in host_slots:
+                host_slots[host] = threading.Semaphore(
+                    self.MAX_BOOTSTRAP_PER_HOST)
+        
+        def bootstrap(guid, slots):
+            slots.acquire()
+            try:
+                start = time.time()
+                create(guid)
+                self._logger.debug("ExperimentController: testbed %d "
+                    "controller ready in %.3fs", guid, time.time() - start)
+            finally:
+                slots.release()
+        
+        self._parallel([ functools.partial(bootstrap, guid,
+                host_slots[self._bootstrap_host(guid, data)])
+            for guid in guids ])
+
+    def _bootstrap_host(self, guid, data):
+        deployment_config = self._deployment_config.get(guid)
+        if deployment_config is not None:
+            return deployment_config.get_attribute_value(DC.DEPLOYMENT_HOST)
+        return dict(data.get_attribute_data(guid)).get(DC.DEPLOYMENT_HOST)
+
     def _resolve_labels(self, data, data_guids, label_guids):
         netrefs = self._netrefs
         testbed_netrefs = self._testbed_netrefs
@@ -971,16 +1840,34 @@ class ExperimentController(object):
         
         testbed = proxy.create_testbed_controller(testbed_id, testbed_version,
                 deployment_config)
+        multicall = testbed.multicall()
         for (name, value) in data.get_attribute_data(guid):
-            testbed.defer_configure(name, value)
+            multicall.defer_configure(name, value)
+        multicall.flush()
+        if rpcstats.ENABLED and hasattr(testbed, 'stats'):
+            # make the testbed's server record calls too
+            testbed.stats(True)
         self._testbeds[guid] = testbed
         if guid in self._netreffed_testbeds:
             self._netreffed_testbeds.remove(guid)
 
     def _program_testbed_controllers(self, element_guids, data):
+        # Programming calls are queued per testbed, and sent 
+        # in a single batch to each of them
+        multicalls = dict()
+        def multicall(testbed_guid):
+            if testbed_guid not in multicalls:
+                multicalls[testbed_guid] = self._testbeds[testbed_guid].multicall()
+            return multicalls[testbed_guid]
+        
+        def flush():
+            self._parallel([ mc.flush for mc in multicalls.values() if len(mc) ])
+        
         def resolve_create_netref(data, guid, name, value): 
             # Try to resolve create-time netrefs, if possible
             if isinstance(value, basestring) and ATTRIBUTE_PATTERN_BASE.search(value):
+                # Netrefs may refer to elements still in the queue
+                flush()
                 try:
                     nuvalue = self.resolve_netref_value(value)
                 except:
@@ -996,8 +1883,8 @@ class ExperimentController(object):
 
         for guid in element_guids:
             (testbed_guid, factory_id) = data.get_box_data(guid)
-            testbed = self._testbeds.get(testbed_guid)
-            if testbed is not None:
+            if testbed_guid in self._testbeds:
+                testbed = multicall(testbed_guid)
                 # create
                 testbed.defer_create(guid, factory_id)
                 # set attributes
@@ -1007,8 +1894,8 @@ class ExperimentController(object):
 
         for guid in element_guids:
             (testbed_guid, factory_id) = data.get_box_data(guid)
-            testbed = self._testbeds.get(testbed_guid)
-            if testbed is not None:
+            if testbed_guid in self._testbeds:
+                testbed = multicall(testbed_guid)
                 # traces
                 for trace_id in data.get_trace_data(guid):
                     testbed.defer_add_trace(guid, trace_id)
@@ -1034,11 +1921,15 @@ class ExperimentController(object):
                         testbed.defer_connect(guid, connector_type_name, 
                                 other_guid, other_connector_type_name)
 
-    def _program_testbed_cross_connections(self, data):
+        flush()
+
+    def _program_testbed_cross_connections(self, data, testbed_guids = None):
         data_guids = data.guids
         for guid in data_guids: 
             if not data.is_testbed_data(guid):
                 (testbed_guid, factory_id) = data.get_box_data(guid)
+                if testbed_guids is not None and testbed_guid not in testbed_guids:
+                    continue
                 testbed = self._testbeds.get(testbed_guid)
                 if testbed is not None:
                     for (connector_type_name, cross_guid, cross_connector_type_name) \
@@ -1105,8 +1996,29 @@ class ExperimentController(object):
         return cross_data
 
 class ExperimentSuite(object):
+    # Maximum number of repetitions running at once
+    MAX_PARALLEL = 4
+    
+    # Maximum number of repetitions using the same resource of a kind
+    # of testbed at once (see _testbed_resources), no limit if missing
+    TESTBED_CAPACITY = dict(
+        planetlab = 1,
+        omf = 1,
+    )
+    
+    # Testbed attribute identifying the resource repetitions compete for,
+    # when it's not the deployment host
+    RESOURCE_ATTRIBUTES = dict(
+        planetlab = "slice",
+    )
+    
+    # Launch local controller daemons through a zygote, so that
+    # repetitions after the first one don't pay for a cold start
+    REUSE_DAEMONS = False
+    
     def __init__(self, experiment_xml, access_config, repetitions = None,
-            duration = None, wait_guids = None):
+            duration = None, wait_guids = None, max_parallel = None,
+            capacity = None):
         self._experiment_xml = experiment_xml
         self._access_config = access_config
         self._controllers = dict()
@@ -1114,12 +2026,29 @@ class ExperimentSuite(object):
         self._repetitions = 1 if not repetitions else repetitions
         self._duration = duration
         self._wait_guids = wait_guids
-        self._current = None
+        self._max_parallel = max_parallel or self.MAX_PARALLEL
+        self._capacity = dict(self.TESTBED_CAPACITY)
+        if capacity:
+            self._capacity.update(capacity)
+        for testbed_id, limit in self._capacity.iteritems():
+            if limit is not None and (not isinstance(limit, (int, long)) 
+                    or limit < 1):
+                raise ValueError("Invalid capacity for %s: %r, must be "
+                    "a positive integer or None" % (testbed_id, limit))
+        self._running = set()
         self._status = TS.STATUS_ZERO
         self._thread = None
+        self._metrics = dict()
+        self._resources_cond = threading.Condition()
+        self._resources_in_use = collections.defaultdict(int)
+        self._logger = logging.getLogger('nepi.core.execute')
 
     def current(self):
-        return self._current
+        """
+        Returns the numbers of the repetitions running at the moment,
+        in ascending order.
+        """
+        return sorted(self._running)
 
     def status(self):
         return self._status
@@ -1130,6 +2059,16 @@ class ExperimentSuite(object):
     def get_access_configurations(self):
         return self._access_configs.values()
 
+    def metrics(self):
+        """
+        Returns a list with a dictionary for each repetition started 
+        so far, with its number (repetition), how long it waited for a 
+        free slot (queued), how long it ran (wall_time, None while 
+        running) and the error it failed with (error), if any.
+        """
+        return [ dict(metrics) 
+            for repetition, metrics in sorted(self._metrics.items()) ]
+
     def start(self):
         self._status  = TS.STATUS_STARTED
         self._thread = threading.Thread(target = self._run_experiment_suite)
@@ -1141,40 +2080,118 @@ class ExperimentSuite(object):
             self._thread = None
         for controller in self._controllers.values():
             controller.shutdown()
+        server.close_zygotes()
 
     def get_current_access_config(self):
-        return self._access_configs[self._current]
+        """
+        Returns the access configurations of the repetitions running
+        at the moment, in the same order as current().
+        """
+        return [ self._access_configs[repetition] 
+            for repetition in self.current() ]
 
     def _run_experiment_suite(self):
-        for i in xrange(1, self._repetitions):
-            self._current = i
-            self._run_one_experiment()
-        self._status = TS.STATUS_STOPPED
-
-    def _run_one_experiment(self):
+        # Up to max_parallel repetitions run at once, as long as the 
+        # resources they need have spare capacity
+        resources = self._testbed_resources()
+        queued_at = time.time()
+        pool = WorkerPool(self._max_parallel)
+        try:
+            pool.run_all([ 
+                functools.partial(self._run_repetition, repetition, 
+                    resources, queued_at)
+                for repetition in xrange(1, self._repetitions + 1) ],
+                cancel_on_error = False)
+        finally:
+            pool.close()
+            self._status = TS.STATUS_STOPPED
+
+    def _run_repetition(self, repetition, resources, queued_at):
+        self._acquire_resources(resources)
+        try:
+            started = time.time()
+            metrics = self._metrics[repetition] = dict(
+                repetition = repetition,
+                queued = started - queued_at,
+                wall_time = None,
+                error = None)
+            try:
+                self._run_one_experiment(repetition)
+            except:
+                self._logger.exception("ExperimentSuite: repetition %d failed", 
+                    repetition)
+                metrics['error'] = str(sys.exc_info()[1])
+            metrics['wall_time'] = time.time() - started
+            self._logger.debug("ExperimentSuite: repetition %d ran in %.3fs, "
+                "after waiting %.3fs", repetition, metrics['wall_time'], 
+                metrics['queued'])
+        finally:
+            self._running.discard(repetition)
+            self._release_resources(resources)
+
+    def _testbed_resources(self):
+        """
+        Returns the resources with limited capacity (see TESTBED_CAPACITY)
+        each repetition uses, as (testbed_id, resource) tuples, resource
+        being the value of the testbed's RESOURCE_ATTRIBUTES attribute, or
+        its deployment host.
+        """
+        parser = XmlExperimentParser()
+        data = parser.from_xml_to_data(self._experiment_xml)
+        resources = set()
+        for guid in data.guids:
+            if data.is_testbed_data(guid):
+                (testbed_id, testbed_version) = data.get_testbed_data(guid)
+                if self._capacity.get(testbed_id) is not None:
+                    attributes = dict(data.get_attribute_data(guid))
+                    attribute = self.RESOURCE_ATTRIBUTES.get(testbed_id, 
+                        DC.DEPLOYMENT_HOST)
+                    resources.add((testbed_id, attributes.get(attribute)))
+        return sorted(resources)
+
+    def _acquire_resources(self, resources):
+        with self._resources_cond:
+            while not all(
+                    self._resources_in_use[resource] < self._capacity[resource[0]]
+                    for resource in resources):
+                self._resources_cond.wait()
+            for resource in resources:
+                self._resources_in_use[resource] += 1
+
+    def _release_resources(self, resources):
+        with self._resources_cond:
+            for resource in resources:
+                self._resources_in_use[resource] -= 1
+            self._resources_cond.notifyAll()
+
+    def _run_one_experiment(self, repetition):
         from nepi.util import proxy
         access_config = proxy.AccessConfiguration()
         for attr in self._access_config.attributes:
             if attr.value:
                 access_config.set_attribute_value(attr.name, attr.value)
         access_config.set_attribute_value(DC.DEPLOYMENT_MODE, DC.MODE_DAEMON)
+        if self.REUSE_DAEMONS and access_config.get_attribute_value(
+                DC.DEPLOYMENT_COMMUNICATION) == DC.ACCESS_LOCAL:
+            access_config.set_attribute_value(DC.USE_ZYGOTE, True)
         root_dir = "%s_%d" % (
                 access_config.get_attribute_value(DC.ROOT_DIRECTORY), 
-                self._current)
+                repetition)
         access_config.set_attribute_value(DC.ROOT_DIRECTORY, root_dir)
         controller = proxy.create_experiment_controller(self._experiment_xml,
                 access_config)
-        self._access_configs[self._current] = access_config
-        self._controllers[self._current] = controller
+        self._access_configs[repetition] = access_config
+        self._controllers[repetition] = controller
+        self._running.add(repetition)
         controller.start()
         started_at = time.time()
         # wait until all specified guids have finished execution
         if self._wait_guids:
-            while all(itertools.imap(controller.is_finished, self._wait_guids)):
-                time.sleep(0.5)
+            controller.wait_for(self._wait_guids, AS.STATUS_FINISHED)
         # wait until the minimum experiment duration time has elapsed 
         if self._duration:
-            while (time.time() - started_at) < self._duration:
-                time.sleep(0.5)
+            left = self._duration - (time.time() - started_at)
+            if left > 0:
+                time.sleep(left)
         controller.stop()
 
@@ -275,6 +275,23 @@ class Metadata(object):
             "validation_function" : validation.is_enum,
             "category" : AC.CATEGORY_DEPLOYMENT,
             }),
+        DC.DEPLOYMENT_CODEC : dict({
+            "name" : DC.DEPLOYMENT_CODEC,
+            "help" : "Encoding of the messages exchanged with the instance: "
+                     "TEXT for the classic base64 encoded format, BINARY "
+                     "for a compact typed binary encoding",
+            "type" : Attribute.ENUM,
+            "value" : DC.CODEC_TEXT,
+            "allowed" : [
+                    DC.CODEC_TEXT,
+                    DC.CODEC_BINARY
+                ],
+            "flags" : Attribute.ExecReadOnly |\
+                    Attribute.ExecImmutable |\
+                    Attribute.Metadata,
+            "validation_function" : validation.is_enum,
+            "category" : AC.CATEGORY_DEPLOYMENT,
+            }),
         DC.DEPLOYMENT_HOST : dict({
             "name" : DC.DEPLOYMENT_HOST,
             "help" : "Host where the testbed will be executed",
@@ -351,6 +368,17 @@ class Metadata(object):
             "validation_function" : validation.is_bool,
             "category" : AC.CATEGORY_DEPLOYMENT,
             }),
+        DC.USE_ZYGOTE : dict({
+            "name" : DC.USE_ZYGOTE,
+            "help" : "Launch daemon processes by forking a pre-started interpreter, shared by all instances deployed with the same access parameters, instead of starting a new one each time. This option only takes place when the server runs in daemon mode.", 
+            "type" : Attribute.BOOL,
+            "value" : False,
+            "flags" : Attribute.ExecReadOnly |\
+                    Attribute.ExecImmutable |\
+                    Attribute.Metadata,
+            "validation_function" : validation.is_bool,
+            "category" : AC.CATEGORY_DEPLOYMENT,
+            }),
         DC.CLEAN_ROOT : dict({
             "name" : DC.CLEAN_ROOT,
             "help" : "Clean server root directory (Warning: This will erase previous data).", 
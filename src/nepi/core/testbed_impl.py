@@ -8,15 +8,30 @@ from nepi.util.constants import TIME_NOW, \
         TestbedStatus as TS, \
         CONNECTION_DELAY
 from nepi.util.parallel import ParallelRun
+from nepi.util.timeline import Timeline
 
 import collections
 import copy
+import functools
 import logging
+import os
+import threading
+import time
 
 class TestbedController(execute.TestbedController):
+    # Longest interval (in seconds) between checks of element statuses
+    # while waiting for them, see wait_for
+    STATUS_POLL_INTERVAL = 1.0
+    
     def __init__(self, testbed_id, testbed_version):
         super(TestbedController, self).__init__(testbed_id, testbed_version)
-        self._status = TS.STATUS_ZERO
+        # the control server holds it while running state-changing
+        # commands, the testbed's own threads may take it to keep out
+        # of their way (queries don't take it)
+        self._lock = threading.RLock()
+        # notified on testbed status changes, see wait_for
+        self._status_cond = threading.Condition()
+        self._set_status(TS.STATUS_ZERO)
         # testbed attributes for validation
         self._attributes = None
         # element factories for validation
@@ -41,6 +56,9 @@ class TestbedController(execute.TestbedController):
         # testbed element instances
         self._elements = dict()
 
+        # start and end times of factory steps and element actions
+        self._timeline = Timeline()
+
         self._metadata = Metadata(self._testbed_id)
         if self._metadata.testbed_version != testbed_version:
             raise RuntimeError("Bad testbed version on testbed %s. Asked for %s, got %s" % \
@@ -162,7 +180,7 @@ class TestbedController(execute.TestbedController):
     def do_setup(self):
         self._root_directory = self._attributes.\
             get_attribute_value("rootDirectory")
-        self._status = TS.STATUS_SETUP
+        self._set_status(TS.STATUS_SETUP)
 
     def do_create(self):
         def set_params(self, guid):
@@ -174,7 +192,7 @@ class TestbedController(execute.TestbedController):
             'create_function',
             self._metadata.create_order,
             postaction = set_params )
-        self._status = TS.STATUS_CREATED
+        self._set_status(TS.STATUS_CREATED)
 
     def _do_connect(self, init = True):
         unconnected = copy.deepcopy(self._connect)
@@ -215,10 +233,17 @@ class TestbedController(execute.TestbedController):
 
     def do_connect_compl(self):
         self._do_connect(init = False)
-        self._status = TS.STATUS_CONNECTED
+        self._set_status(TS.STATUS_CONNECTED)
 
     def _do_in_factory_order(self, action, order, postaction = None, poststep = None):
         logger = self._logger
+        timeline = self._timeline
+        if isinstance(action, basestring):
+            action_name = action
+        elif isinstance(action, functools.partial):
+            action_name = "%s%r" % (action.func.__name__, action.args)
+        else:
+            action_name = action.__name__
         
         guids = collections.defaultdict(list)
         # order guids (elements) according to factory_id
@@ -242,12 +267,23 @@ class TestbedController(execute.TestbedController):
             if isinstance(action, basestring) and not getattr(factory, action):
                 continue
             def perform_action(guid):
-                if isinstance(action, basestring):
-                    getattr(factory, action)(self, guid)
-                else:
-                    action(self, guid)
-                if postaction:
-                    postaction(self, guid)
+                start = time.time()
+                try:
+                    if isinstance(action, basestring):
+                        getattr(factory, action)(self, guid)
+                    else:
+                        action(self, guid)
+                    if postaction:
+                        postaction(self, guid)
+                finally:
+                    timeline.record("%s[%d]" % (factory_id, guid), action_name,
+                        start, time.time(), args = dict(guid = guid))
+            
+            def perform_poststep(self, guid):
+                timeline.span("%s[%d]" % (factory_id, guid), 
+                    "post-" + action_name, poststep, self, guid)
+            
+            step_start = time.time()
 
             # perform the action on all elements, in parallel if so requested
             if runner:
@@ -271,15 +307,19 @@ class TestbedController(execute.TestbedController):
                 for guid in guids[factory_id]:
                     if runner:
                         logger.debug("TestbedController: Scheduling post-%s on %s", action, guid)
-                        runner.put(poststep, self, guid)
+                        runner.put(perform_poststep, self, guid)
                     else:
                         logger.debug("TestbedController: Performing post-%s on %s", action, guid)
-                        poststep(self, guid)
+                        perform_poststep(self, guid)
 
             # sync
             if runner:
                 runner.join()
                 logger.debug("TestbedController: Finished parallel %s", action)
+            
+            timeline.record(factory_id, action_name, step_start, time.time(),
+                args = dict(elements = len(guids[factory_id]), 
+                    parallel = runner is not None))
 
     @staticmethod
     def do_poststep_preconfigure(self, guid):
@@ -304,7 +344,7 @@ class TestbedController(execute.TestbedController):
             'configure_function',
             self._metadata.configure_order,
             poststep = self.do_poststep_configure )
-        self._status = TS.STATUS_CONFIGURED
+        self._set_status(TS.STATUS_CONFIGURED)
 
     def do_prestart(self):
         self._do_in_factory_order(
@@ -346,7 +386,7 @@ class TestbedController(execute.TestbedController):
 
     def do_cross_connect_compl(self, cross_data):
         self._do_cross_connect(cross_data, init = False)
-        self._status = TS.STATUS_CROSS_CONNECTED
+        self._set_status(TS.STATUS_CROSS_CONNECTED)
 
     def set(self, guid, name, value, time = TIME_NOW):
         self._validate_guid(guid)
@@ -378,6 +418,9 @@ class TestbedController(execute.TestbedController):
         factory = self._get_factory(guid)
         return factory.box_attributes.get_attribute_value(name)
 
+    def get_many(self, guid, names, time = TIME_NOW):
+        return [ self.get(guid, name, time) for name in names ]
+
     def get_route(self, guid, index, attribute):
         """
         returns information given to defer_add_route.
@@ -439,15 +482,30 @@ class TestbedController(execute.TestbedController):
         attribute_list = list()
         return factory.box_attributes.get_attribute_list(filter_flags, exclude)
 
+    def snapshot_attributes(self, filter_flags = None, exclude = False):
+        snapshot = dict()
+        for guid in self._create:
+            values = dict()
+            for name in self.get_attribute_list(guid, filter_flags, exclude):
+                value = self.get(guid, name)
+                if value is not None:
+                    values[name] = value
+            if values:
+                snapshot[guid] = values
+        return snapshot
+
     def get_factory_id(self, guid):
         factory = self._get_factory(guid)
         return factory.factory_id
 
+    def timeline(self):
+        return self._timeline.events()
+
     def start(self, time = TIME_NOW):
         self._do_in_factory_order(
             'start_function',
             self._metadata.start_order )
-        self._status = TS.STATUS_STARTED
+        self._set_status(TS.STATUS_STARTED)
 
     #action: NotImplementedError
 
@@ -455,7 +513,7 @@ class TestbedController(execute.TestbedController):
         self._do_in_factory_order(
             'stop_function',
             reversed(self._metadata.start_order) )
-        self._status = TS.STATUS_STOPPED
+        self._set_status(TS.STATUS_STOPPED)
 
     def status(self, guid = None):
         if not guid:
@@ -464,12 +522,56 @@ class TestbedController(execute.TestbedController):
         factory = self._get_factory(guid)
         status_function = factory.status_function
         if status_function:
-            return status_function(self, guid)
-        return AS.STATUS_UNDETERMINED
+            status = status_function(self, guid)
+        else:
+            status = AS.STATUS_UNDETERMINED
+        return status
+
+    def status_many(self, guids):
+        return [ self.status(guid) for guid in guids ]
+
+    def is_finished_all(self, guids):
+        for guid in guids:
+            if self.status(guid) != AS.STATUS_FINISHED:
+                return False
+        return True
+
+    def wait_for(self, guids, state, timeout = None):
+        """
+        Polls the given elements' statuses until all of them are in 
+        the given state, backing off up to STATUS_POLL_INTERVAL between
+        checks. Stopping the testbed wakes waiters up right away.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        interval = self.STATUS_POLL_INTERVAL / 16
+        pending = set(guids)
+        while True:
+            pending = set([ guid for guid in pending 
+                if self.status(guid) != state ])
+            if not pending:
+                return True
+            if self._status == TS.STATUS_STOPPED:
+                # nothing will change anymore
+                return False
+            
+            wait = interval
+            interval = min(interval * 2, self.STATUS_POLL_INTERVAL)
+            if deadline is not None:
+                left = deadline - time.time()
+                if left <= 0:
+                    return False
+                wait = min(wait, left)
+            with self._status_cond:
+                self._status_cond.wait(wait)
     
     def testbed_status(self):
         return self._status
 
+    def _set_status(self, status):
+        with self._status_cond:
+            self._status = status
+            self._status_cond.notifyAll()
+
     def trace(self, guid, trace_id, attribute='value'):
         if attribute == 'value':
             fd = open("%s" % self.trace_filepath(guid, trace_id), "r")
@@ -479,10 +581,22 @@ class TestbedController(execute.TestbedController):
             content = self.trace_filepath(guid, trace_id)
         elif attribute == 'filename':
             content = self.trace_filename(guid, trace_id)
+        elif attribute == 'size':
+            content = str(os.path.getsize(self.trace_filepath(guid, trace_id)))
+        elif attribute == 'mtime':
+            content = repr(os.path.getmtime(self.trace_filepath(guid, trace_id)))
         else:
             content = None
         return content
 
+    def read_trace(self, guid, trace_id, offset, length):
+        fd = open(self.trace_filepath(guid, trace_id), "r")
+        try:
+            fd.seek(offset)
+            return fd.read(length)
+        finally:
+            fd.close()
+
     def traces_info(self):
         traces_info = dict()
         host = self._attributes.get_attribute_value("deployment_host")
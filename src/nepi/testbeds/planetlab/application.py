@@ -542,11 +542,7 @@ class Dependency(object):
 
             # Copy all other sources
             try:
-                self._popen_scp(
-                    sources,
-                    "%s@%s:%s" % (self.node.slicename, self.node.hostname, 
-                        os.path.join(self.home_path,'.'),)
-                    )
+                self._push_files(sources, self.home_path)
             except RuntimeError, e:
                 raise RuntimeError, "Failed upload source file %r: %s %s" \
                         % (sources, e.args[0], e.args[1],)
@@ -619,22 +615,12 @@ class Dependency(object):
         puk = self._master_puk
        
         try:
-            self._popen_scp(
-                [ prk.name, puk.name ],
-                '%s@%s:%s' % (self.node.slicename, self.node.hostname, self.home_path )
-                )
-        except RuntimeError, e:
-            raise RuntimeError, "Failed to set up application deployment keys: %s %s" \
-                    % (e.args[0], e.args[1],)
-
-        try:
-            self._popen_scp(
-                cStringIO.StringIO('%s,%s %s\n' % (
+            self._push_files(
+                [ prk.name, puk.name, 
+                  ("master_known_hosts", cStringIO.StringIO('%s,%s %s\n' % (
                     self._master.node.hostname, self._master.node.hostip, 
-                    self._master.node.server_key)),
-                '%s@%s:%s' % (self.node.slicename, self.node.hostname, 
-                    os.path.join(self.home_path,"master_known_hosts") )
-                )
+                    self._master.node.server_key))) ],
+                self.home_path)
         except RuntimeError, e:
             raise RuntimeError, "Failed to set up application deployment keys: %s %s" \
                     % (e.args[0], e.args[1],)
@@ -671,6 +657,29 @@ class Dependency(object):
                     retry -= 1
   
 
+    @server.eintr_retry
+    def _push_files(self, sources, dst_dir, retry = 3):
+        while 1:
+            try:
+                return server.push_files(
+                    sources,
+                    [ '%s@%s:%s' % (self.node.slicename, self.node.hostname, 
+                        dst_dir) ],
+                    port = None,
+                    agent = None,
+                    ident_key = self.node.ident_path,
+                    server_key = self.node.server_key
+                    )
+            except:
+                if retry <= 0:
+                    raise
+                else:
+                    retry -= 1
+                    # file-like sources were consumed, rewind them
+                    for source in sources:
+                        if isinstance(source, tuple) and hasattr(source[1], 'seek'):
+                            source[1].seek(0)
+
     @server.eintr_retry
     def _popen_ssh_command(self, command, retry = 0, noerrors=False, timeout=None):
         (out,err),proc = server.popen_ssh_command(
@@ -38,6 +38,7 @@ class TestbedController(testbed_impl.TestbedController):
         self._home_directory = None
         self.slicename = None
         self._traces = dict()
+        self._synced_traces = dict()
 
         import node, interfaces, application, multicast
         self._node = node
@@ -349,6 +350,15 @@ class TestbedController(testbed_impl.TestbedController):
                     
                     self._logger.info("READY Node %s at %s", guid, node.hostname)
                     
+                    # Open the node's ssh master connection now, every 
+                    # later step multiplexes its sessions through it
+                    server.ssh_sessions.control_path(
+                        host = node.hostip,
+                        port = None,
+                        user = node.slicename,
+                        ident_key = node.ident_path,
+                        server_key = node.server_key)
+                    
                     # Prepare dependency installer now
                     node.prepare_dependencies()
                 except:
@@ -362,6 +372,8 @@ class TestbedController(testbed_impl.TestbedController):
                     self._logger.info("Waiting for Node %s configured at %s", guid, node.hostname)
                     runner.put(waitforit, guid, node)
             runner.join()
+            
+            self._logger.info("SSH sessions: %r", server.ssh_sessions.stats())
                     
         except self._node.UnresponsiveNodeError:
             # Uh... 
@@ -622,10 +634,68 @@ class TestbedController(testbed_impl.TestbedController):
             content = elem.remote_trace_path(trace_id)
         elif attribute == 'name':
             content = elem.remote_trace_name(trace_id)
+        elif attribute in ('size', 'mtime'):
+            content = self._trace_stat(elem, trace_id, attribute)
         else:
             content = None
         return content
 
+    def _trace_stat(self, elem, trace_id, attribute):
+        """
+        Returns the size or mtime of a trace, as reported by stat on the
+        node that holds it, sparing the download of the whole trace.
+        Traces without a remote file of their own are synchronized.
+        """
+        node = getattr(elem, 'node', None)
+        path = None
+        if node is not None and hasattr(elem, 'remote_trace_path'):
+            path = elem.remote_trace_path(trace_id)
+        if not path:
+            path = elem.sync_trace(self.home_directory, trace_id)
+            if not path:
+                return None
+            elif attribute == 'size':
+                return str(os.path.getsize(path))
+            else:
+                return repr(os.path.getmtime(path))
+        
+        (out,err),proc = server.popen_ssh_command(
+            "stat -c %s %s" % (
+                '%s' if attribute == 'size' else '%Y',
+                server.shell_escape(path)),
+            host = node.hostname,
+            port = None,
+            user = node.slicename,
+            agent = None,
+            ident_key = node.ident_path,
+            server_key = node.server_key
+            )
+        if proc.wait():
+            raise RuntimeError, "Failed to stat trace %s: %s %s" % (
+                trace_id, out, err,)
+        if attribute == 'size':
+            return str(int(out))
+        else:
+            return repr(float(out))
+
+    def read_trace(self, guid, trace_id, offset, length):
+        key = (guid, trace_id)
+        path = self._synced_traces.get(key)
+        if offset == 0 or path is None:
+            # Synchronize the local copy once per sequential read, 
+            # further chunks are read from it
+            elem = self._elements[guid]
+            path = self._synced_traces[key] = \
+                elem.sync_trace(self.home_directory, trace_id)
+            if not path:
+                return ""
+        fd = open(path, "r")
+        try:
+            fd.seek(offset)
+            return fd.read(length)
+        finally:
+            fd.close()
+
     def follow_trace(self, trace_id, trace):
         self._traces[trace_id] = trace
 
@@ -116,16 +116,16 @@ class TunProtoBase(object):
             filter_sources = None
         dest = "%s@%s:%s" % (
             local.node.slicename, local.node.hostname, 
-            os.path.join(self.home_path,'.'),)
-        (out,err),proc = server.eintr_retry(server.popen_scp)(
-            sources,
-            dest,
-            ident_key = local.node.ident_path,
-            server_key = local.node.server_key
-            )
-    
-        if proc.wait():
-            raise RuntimeError, "Failed upload TUN connect script %r: %s %s" % (sources, out,err,)
+            self.home_path,)
+        try:
+            server.eintr_retry(server.push_files)(
+                sources,
+                [dest],
+                ident_key = local.node.ident_path,
+                server_key = local.node.server_key
+                )
+        except RuntimeError, e:
+            raise RuntimeError, "Failed upload TUN connect script %r: %s %s" % (sources, e.args[0], e.args[1],)
         
         # Make sure all dependencies are satisfied
         local.node.wait_dependencies()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compact binary codec for control messages.
+
+Values made only of plain data (None, bools, numbers, strings, and lists,
+tuples, sets and dicts thereof) are encoded with the marshal format:
+one-byte type tags, binary numbers and length-prefixed strings, with
+a fast C implementation. Any other value gets pickled instead.
+Either way, the encoded value is prefixed with a one-byte tag telling
+which format follows:
+
+    M   marshal data (format version 2, readable since python 2.5)
+    P   pickle data (highest protocol)
+
+Messages are the MAGIC byte, followed by a 16-bit big-endian command
+(or reply) code and a single encoded value. Since MAGIC can't be the
+first byte of '|'-separated text messages, servers can tell them apart.
+
+Like pickle, this must only be used to talk to trusted peers.
+"""
+
+import cPickle
+import marshal
+import struct
+
+MAGIC = "\xb7"
+
+MARSHAL_VERSION = 2
+
+_CODE = struct.Struct("!H")
+
+def dumps(value):
+    try:
+        return "M" + marshal.dumps(value, MARSHAL_VERSION)
+    except ValueError:
+        # unmarshallable object somewhere in there
+        return "P" + cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+
+def loads(data, pos = 0):
+    tag = data[pos:pos+1]
+    try:
+        if tag == "M":
+            return marshal.loads(data[pos+1:])
+        elif tag == "P":
+            return cPickle.loads(data[pos+1:])
+    except Exception, e:
+        raise ValueError, "Malformed data: %s" % (e,)
+    raise ValueError, "Unknown format tag %r at offset %d" % (tag, pos)
+
+def is_message(msg):
+    return msg[:1] == MAGIC
+
+def encode_message(code, value):
+    return MAGIC + _CODE.pack(code) + dumps(value)
+
+def message_code(msg):
+    if not is_message(msg) or len(msg) < 1 + _CODE.size:
+        raise ValueError, "Not a binary message"
+    return _CODE.unpack_from(msg, 1)[0]
+
+def decode_message(msg):
+    """ Returns a (code, value) tuple """
+    code = message_code(msg)
+    return code, loads(msg, 1 + _CODE.size)
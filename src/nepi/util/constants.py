@@ -54,6 +54,8 @@ class DeploymentConfiguration:
     MODE_DAEMON = "DAEMON"
     ACCESS_SSH = "SSH"
     ACCESS_LOCAL = "LOCAL"
+    CODEC_TEXT = "TEXT"
+    CODEC_BINARY = "BINARY"
     ERROR_LEVEL = "Error"
     DEBUG_LEVEL = "Debug"
     POLICY_FAIL = "Fail"
@@ -67,12 +69,14 @@ class DeploymentConfiguration:
     DEPLOYMENT_USER = "deployment_user"
     DEPLOYMENT_PORT = "deployment_port"
     DEPLOYMENT_KEY  = "deployment_key"
+    DEPLOYMENT_CODEC = "deployment_codec"
     
     DEPLOYMENT_ENVIRONMENT_SETUP = "deployment_environment_setup"
     
     ROOT_DIRECTORY = "rootDirectory"
     USE_AGENT = "useAgent"
     USE_SUDO = "useSudo"
+    USE_ZYGOTE = "useZygote"
     LOG_LEVEL = "logLevel"
     RECOVER = "recover"
     RECOVERY_POLICY = "recoveryPolicy"
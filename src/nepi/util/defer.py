@@ -1,3 +1,9 @@
+import errno
+import select
+import sys
+import threading
+import time
+
 class Defer:
     class NONE:
         pass
@@ -31,3 +37,203 @@ class Defer:
     def __nonzero__(self):
         return bool(self._get())
     
+
+class Future(Defer):
+    """
+    A Defer that can be checked for completion without blocking, waited
+    upon along with others (see gather and wait_any), chained (_then), 
+    and given callbacks to run once it's resolved.
+    
+    Like Defer, it stands for its value, so its own methods are all
+    underscore-prefixed, not to hide the value's attributes.
+    
+    poll, if given, must return whether the value can be fetched without
+    blocking, and fileno, a descriptor that becomes readable when it may.
+    
+    Errors raised while fetching the value are kept, and raised again
+    each time the value is requested. Callbacks run in the thread that 
+    resolves the future, and receive the future itself.
+    """
+    _STATE = ('_Defer__ojet', '_Defer__ojetwait', '_Future__poll', 
+        '_Future__fileno', '_Future__error', '_Future__callbacks',
+        '_Future__lock')
+    
+    def __init__(self, ojetwait, poll = None, fileno = None):
+        Defer.__init__(self, ojetwait)
+        self.__poll = poll
+        self.__fileno = fileno
+        self.__error = None
+        self.__callbacks = []
+        self.__lock = threading.RLock()
+    def __getattr__(self, attr):
+        if attr in Future._STATE:
+            raise AttributeError, attr
+        return getattr(self._get(), attr)
+    def __setattr__(self, attr, value):
+        if attr in Future._STATE:
+            self.__dict__[attr] = value
+        else:
+            setattr(self._get(), attr, value)
+    def _get(self):
+        if not self._resolved():
+            self.__lock.acquire()
+            try:
+                if not self._resolved():
+                    try:
+                        self._Defer__ojet = self._Defer__ojetwait()
+                    except:
+                        self.__error = sys.exc_info()
+                    self._Defer__ojetwait = None
+                    callbacks, self.__callbacks = self.__callbacks, []
+                    for callback in callbacks:
+                        callback(self)
+            finally:
+                self.__lock.release()
+        if self.__error is not None:
+            raise self.__error[0], self.__error[1], self.__error[2]
+        return self._Defer__ojet
+    
+    def _resolved(self):
+        """ Returns True if the value (or error) has already been fetched """
+        return self._Defer__ojet is not Defer.NONE or self.__error is not None
+    
+    def _can_poll(self):
+        """ Returns True if _done can tell, without blocking """
+        return self._resolved() or self.__poll is not None
+    
+    def _done(self):
+        """ Returns True if the value can be fetched without blocking """
+        return self._resolved() or (self.__poll is not None and self.__poll())
+    
+    def _fileno(self):
+        if self.__fileno is None:
+            return None
+        elif callable(self.__fileno):
+            return self.__fileno()
+        else:
+            return self.__fileno
+    
+    def _result(self):
+        return self._get()
+    
+    def _exception(self):
+        """ Returns the error raised while fetching the value, or None """
+        try:
+            self._get()
+        except Exception, e:
+            return e
+        return None
+    
+    def _add_done_callback(self, callback):
+        self.__lock.acquire()
+        try:
+            if not self._resolved():
+                self.__callbacks.append(callback)
+                return
+        finally:
+            self.__lock.release()
+        callback(self)
+    
+    def _then(self, transform):
+        """
+        Returns a Future for transform(value), with value being this
+        future's value.
+        """
+        return Future(lambda : transform(self._get()), 
+            poll = self._done, 
+            fileno = self._fileno)
+
+def resolved(value):
+    """ Returns an already resolved Future for value """
+    future = Future(None)
+    future._Defer__ojet = value
+    return future
+
+def gather(futures, return_exceptions = False):
+    """
+    Waits for all of the given futures (anything with _get, plain values
+    are taken as they are), and returns the list of their values, in order.
+    
+    If any of them fails, the first error is raised after all the others 
+    are resolved, unless return_exceptions is set, in which case errors 
+    are returned in place of values.
+    """
+    results = []
+    error = None
+    for future in futures:
+        if hasattr(future, '_get'):
+            try:
+                future = future._get()
+            except Exception, e:
+                if error is None:
+                    error = sys.exc_info()
+                future = e
+        results.append(future)
+    if error is not None and not return_exceptions:
+        raise error[0], error[1], error[2]
+    return results
+
+# Longest interval (in seconds) between checks of futures that can be
+# polled, but not selected on, in wait_any
+POLL_INTERVAL = 0.1
+
+def wait_any(futures, timeout = None):
+    """
+    Waits until at least one of the given futures can be fetched without
+    blocking, or timeout seconds have passed, and returns a (done, pending)
+    tuple of lists.
+    
+    Futures with a fileno are waited upon with select, and those that can
+    only be polled are checked every now and then (see POLL_INTERVAL).
+    Futures that can't even be polled are simply resolved, one by one,
+    when none of the others is done: that blocks for as long as fetching 
+    them takes, regardless of timeout.
+    """
+    futures = list(futures)
+    if timeout is not None:
+        deadline = time.time() + timeout
+    interval = POLL_INTERVAL / 16
+    while True:
+        done = []
+        pending = []
+        for future in futures:
+            if not isinstance(future, Future) or future._done():
+                done.append(future)
+            else:
+                pending.append(future)
+        if done or not pending:
+            return done, pending
+        
+        unpollable = [ future for future in pending 
+                       if not future._can_poll() ]
+        if unpollable:
+            # nothing but fetching it tells when it's done
+            try:
+                unpollable[0]._get()
+            except Exception:
+                pass
+            continue
+        
+        if timeout is None:
+            remaining = None
+        else:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return done, pending
+        
+        fds = set([ future._fileno() for future in pending ])
+        if None in fds:
+            # some can't be selected on, check them again in a while
+            fds.discard(None)
+            if remaining is None or remaining > interval:
+                remaining = interval
+            interval = min(interval * 2, POLL_INTERVAL)
+        
+        if not fds:
+            time.sleep(remaining)
+            continue
+        try:
+            select.select(list(fds), [], [], remaining)
+        except select.error, e:
+            if e[0] != errno.EINTR:
+                raise
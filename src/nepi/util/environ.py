@@ -71,10 +71,12 @@ def homepath(path, app='.nepi', mode = 0500, directory = False):
     
     return path
 
-def find_testbed(testbed_id):
-    mod_name = None
-    
-    # look for environment-specified testbeds
+def testbed_map():
+    """
+    Returns the testbed modules specified in the environment 
+    (NEPI_TESTBEDS), by testbed id.
+    """
+    testbed_map = {}
     if 'NEPI_TESTBEDS' in os.environ:
         try:
             # parse testbed map
@@ -88,8 +90,11 @@ def find_testbed(testbed_id):
             
             # ignore malformed environment
             testbed_map = {}
-        
-        mod_name = testbed_map.get(testbed_id)
+    return testbed_map
+
+def find_testbed(testbed_id):
+    # look for environment-specified testbeds
+    mod_name = testbed_map().get(testbed_id)
     
     if mod_name is None:
         # no explicit map, load built-in testbeds
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""
+Append-only journal of deployment progress, used to speed up recovery.
+
+Each record is a tuple, encoded with nepi.util.codec and written as a
+single base64 line, so that a record is either fully written or, if the
+writer died halfway through, a torn last line that gets ignored when
+loading. Records are flushed as soon as they're written, so they survive
+the death of the writing process (though not necessarily that of the
+host).
+"""
+
+import base64
+import binascii
+import os
+import threading
+
+from nepi.util import codec
+
+class Journal(object):
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def record(self, *record):
+        line = base64.b64encode(codec.dumps(record)) + "\n"
+        self._lock.acquire()
+        try:
+            if self._file is None:
+                self._file = open(self.path, "a")
+            self._file.write(line)
+            self._file.flush()
+        finally:
+            self._lock.release()
+
+    def load(self):
+        """
+        Returns all the records in the journal, in the order they
+        were written, or an empty list if there is no journal.
+        """
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        f = open(self.path, "r")
+        try:
+            for line in f:
+                if not line.endswith("\n"):
+                    # torn write
+                    break
+                try:
+                    records.append(codec.loads(base64.b64decode(line)))
+                except (ValueError, TypeError, binascii.Error):
+                    break
+        finally:
+            f.close()
+        return records
+
+    def reset(self):
+        """
+        Discards all records.
+        """
+        self._lock.acquire()
+        try:
+            self.close()
+            open(self.path, "w").close()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -1,10 +1,30 @@
 # -*- coding: utf-8 -*-
 
+"""
+Two kinds of executors live here:
+
+    ParallelMap (and ParallelRun, ParallelFilter, pmap, pfilter) runs 
+    a batch of calls with up to maxthreads threads, taken from a 
+    process-wide thread cache, and is done with once the batch is. 
+    Testbeds use it for their per-step fan-outs, each with the 
+    concurrency that suits the resource it hits (the PLC API, nodes...).
+    
+    WorkerPool is a long-lived pool shared by everything a controller 
+    does, which bounds the total number of tasks running at once, 
+    supports nested waits without deadlocking, task timeouts, 
+    cancellation and timing (see TaskGraph). It must be closed by 
+    its owner.
+"""
+
+import collections
+import functools
+import logging
 import threading
 import Queue
 import traceback
 import sys
 import os
+import time
 
 N_PROCS = None
 
@@ -235,6 +255,160 @@ class ParallelRun(ParallelMap):
         super(ParallelRun, self).put_nowait(self.__filter, (what, args, kwargs))
 
 
+class TaskGraph(object):
+    """
+    Runs named tasks as soon as all the tasks they depend upon are done,
+    each in its own thread, up to maxthreads at once (no limit if None),
+    or in the given WorkerPool.
+    
+    Tasks must be added after their dependencies, which keeps the
+    graph acyclic. When a task fails, no further tasks are started, and 
+    run() raises the first failure once running tasks are done. Tasks 
+    running for longer than timeout seconds fail with TaskTimeout.
+    
+    After run(), times holds the (start, end) times of each task that ran.
+    """
+    def __init__(self):
+        self._tasks = collections.OrderedDict()
+        self.times = dict()
+    
+    def add(self, name, task, deps = ()):
+        if name in self._tasks:
+            raise ValueError, "Duplicate task %r" % (name,)
+        for dep in deps:
+            if dep not in self._tasks:
+                raise ValueError, "Task %r depends on unknown task %r" % (name, dep)
+        self._tasks[name] = (task, tuple(deps))
+        return name
+    
+    def __contains__(self, name):
+        return name in self._tasks
+    
+    def __len__(self):
+        return len(self._tasks)
+    
+    def deps(self, name):
+        return self._tasks[name][1]
+    
+    def run(self, maxthreads = None, pool = None, timeout = None):
+        cond = threading.Condition()
+        pending = collections.OrderedDict(
+            (name, set(deps)) for name, (task, deps) in self._tasks.iteritems() )
+        running = dict()
+        done = set()
+        errors = []
+        
+        def worker(name):
+            task = self._tasks[name][0]
+            start = time.time()
+            with cond:
+                if errors:
+                    # queued in the pool before the failure, skip it
+                    running.pop(name, None)
+                    cond.notify()
+                    return
+                running[name] = start
+            try:
+                task()
+            except:
+                logging.exception("Exception occurred in task %s:", name)
+                errors.append(sys.exc_info())
+            end = time.time()
+            with cond:
+                self.times[name] = (start, end)
+                running.pop(name, None)
+                done.add(name)
+                cond.notify()
+        
+        if pool is not None:
+            pool._begin_wait()
+        try:
+            with cond:
+                while True:
+                    if not errors:
+                        for name, deps in pending.items():
+                            if maxthreads is not None and len(running) >= maxthreads:
+                                break
+                            if deps <= done:
+                                del pending[name]
+                                # not started yet, but counts as running
+                                running[name] = None
+                                if pool is not None:
+                                    pool.put(PoolTask(worker, (name,), {}, name))
+                                else:
+                                    thread = threading.Thread(target = worker, args = (name,))
+                                    thread.start()
+                    if not running:
+                        break
+                    wait = None
+                    if timeout is not None:
+                        now = time.time()
+                        for name, start in running.items():
+                            if start is None:
+                                continue
+                            if now - start >= timeout:
+                                # can't be stopped, just not waited for
+                                del running[name]
+                                logging.error("Task %s timed out after %ss", 
+                                    name, timeout)
+                                errors.append((TaskTimeout, 
+                                    TaskTimeout("Task %s timed out after %ss" % (
+                                        name, timeout)), None))
+                            else:
+                                left = timeout - (now - start)
+                                wait = left if wait is None else min(wait, left)
+                        if not running:
+                            break
+                        if wait is None:
+                            # some task hasn't started yet
+                            wait = min(timeout, 1.0)
+                    cond.wait(wait)
+        finally:
+            if pool is not None:
+                pool._end_wait()
+        
+        if errors:
+            typ, val, loc = errors[0]
+            raise typ, val, loc
+    
+    def critical_path(self):
+        """
+        Returns the chain of tasks that determined the total run time,
+        as a list of (name, start, end) tuples, in order: starting from 
+        the last task to finish, each step goes back to the dependency 
+        that finished last.
+        """
+        if not self.times:
+            return []
+        name = max(self.times, key = lambda name : self.times[name][1])
+        path = []
+        while name is not None:
+            start, end = self.times[name]
+            path.append((name, start, end))
+            deps = [ dep for dep in self.deps(name) if dep in self.times ]
+            if deps:
+                name = max(deps, key = lambda dep : self.times[dep][1])
+            else:
+                name = None
+        path.reverse()
+        return path
+    
+    def describe(self):
+        """ Returns a human-readable listing of the tasks and their dependencies """
+        lines = []
+        for name, (task, deps) in self._tasks.iteritems():
+            if name in self.times:
+                start, end = self.times[name]
+                timing = " (%.3fs)" % (end - start,)
+            else:
+                timing = ""
+            if deps:
+                lines.append("%s%s <- %s" % (name, timing, ", ".join(deps)))
+            else:
+                lines.append("%s%s" % (name, timing))
+        return "\n".join(lines)
+
+
 def pmap(mapping, iterable, maxthreads = None, maxqueue = None):
     mapper = ParallelMap(
         maxthreads = maxthreads,
@@ -259,3 +433,302 @@ def pfilter(condition, iterable, maxthreads = None, maxqueue = None):
     filtrer.join()
     return rv
 
+
+class TaskTimeout(RuntimeError):
+    pass
+
+class TaskCancelled(RuntimeError):
+    pass
+
+class PoolTask(object):
+    """
+    A callable submitted to a WorkerPool. Records when it started 
+    and finished running, and its outcome.
+    """
+    def __init__(self, callable, args, kwargs, name = None):
+        self.callable = callable
+        self.args = args
+        self.kwargs = kwargs
+        self.name = name or _task_name(callable)
+        self.start = None
+        self.end = None
+        self.cancelled = False
+        self._result = None
+        self._exc_info = None
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+    
+    @property
+    def wall_time(self):
+        if self.start is None:
+            return None
+        return (self.end or time.time()) - self.start
+    
+    def done(self):
+        return self._done.isSet()
+    
+    def failed(self):
+        return self._exc_info is not None
+    
+    def cancel(self):
+        """
+        Prevents the task from running, if it hasn't started yet.
+        Returns whether it was cancelled.
+        """
+        with self._lock:
+            if self.start is not None:
+                return False
+            self.cancelled = True
+            self._exc_info = (TaskCancelled, 
+                TaskCancelled("Task %s cancelled" % (self.name,)), None)
+        self._finish()
+        return True
+    
+    def result(self, timeout = None):
+        self._done.wait(timeout)
+        if not self._done.isSet():
+            raise TaskTimeout("Task %s still running after %ss" % (
+                self.name, timeout))
+        if self._exc_info is not None:
+            typ, val, loc = self._exc_info
+            raise typ, val, loc
+        return self._result
+    
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._done.isSet():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+    
+    def _run(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.start = time.time()
+        try:
+            self._result = self.callable(*self.args, **self.kwargs)
+        except:
+            logging.exception("Exception occurred in task %s:", self.name)
+            self._exc_info = sys.exc_info()
+        self.end = time.time()
+        self._finish()
+    
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+def _task_name(callable):
+    while isinstance(callable, functools.partial):
+        callable = callable.func
+    return getattr(callable, '__name__', None) or repr(callable)
+
+class WorkerPool(object):
+    """
+    A reusable pool of worker threads, meant to be shared by everything 
+    a controller does concurrently, so that the overall number of tasks 
+    running at once stays bounded by maxthreads.
+    
+    Worker threads are started on demand and exit after idling for 
+    idle_timeout seconds (if given), or when the pool is closed. A 
+    worker may itself wait on other tasks (see run_all): while it waits
+    it doesn't count against maxthreads, so nested use of the same pool
+    doesn't deadlock.
+    
+    The start and end times of finished tasks are kept in times, as 
+    (name, start, end) tuples, up to the last history tasks.
+    """
+    def __init__(self, maxthreads = None, idle_timeout = None, history = 1000):
+        self.maxthreads = maxthreads
+        self.idle_timeout = idle_timeout
+        self.times = collections.deque(maxlen = history)
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = 0
+        self._workers = set()
+        self._idle = 0
+        self._waiting = 0
+        self._stopping = 0
+        self._local = threading.local()
+        self._pid = os.getpid()
+    
+    def submit(self, callable, *args, **kwargs):
+        """
+        Queues the callable for execution and returns its PoolTask.
+        """
+        task = PoolTask(callable, args, kwargs)
+        self.put(task)
+        return task
+    
+    def put(self, task):
+        self._queue.put(task)
+        self._spawn()
+    
+    def run_all(self, callables, timeout = None, cancel_on_error = True):
+        """
+        Runs the given callables in the pool and returns their results,
+        in order, once all have finished.
+        
+        If any task takes longer than timeout seconds to run, it fails
+        with TaskTimeout (it can't be stopped, but isn't waited for 
+        anymore). With cancel_on_error, the first failure cancels 
+        all sibling tasks that haven't started yet. Either way, the 
+        first error is raised after the remaining tasks are done.
+        """
+        cond = threading.Condition()
+        def notify(task):
+            # cancel siblings right away, before the failed task's 
+            # worker moves on to the next one
+            if cancel_on_error and task.failed() and not task.cancelled:
+                for sibling in tasks:
+                    if sibling is not task:
+                        sibling.cancel()
+            with cond:
+                cond.notify()
+        
+        tasks = [ PoolTask(callable, (), {}) for callable in callables ]
+        for task in tasks:
+            task.add_done_callback(notify)
+            self.put(task)
+        
+        errors = []
+        pending = list(tasks)
+        self._begin_wait()
+        try:
+            with cond:
+                while pending:
+                    now = time.time()
+                    wait = None
+                    for task in list(pending):
+                        if task.done():
+                            pending.remove(task)
+                            if task.failed() and not task.cancelled:
+                                errors.append(task._exc_info)
+                        elif (timeout is not None and task.start is not None
+                                and now - task.start >= timeout):
+                            pending.remove(task)
+                            logging.error("Task %s timed out after %ss", 
+                                task.name, timeout)
+                            errors.append((TaskTimeout, 
+                                TaskTimeout("Task %s timed out after %ss" % (
+                                    task.name, timeout)), None))
+                        elif timeout is not None:
+                            left = timeout - (now - (task.start or now))
+                            wait = left if wait is None else min(wait, left)
+                    if errors and cancel_on_error:
+                        for task in pending:
+                            task.cancel()
+                    if pending:
+                        cond.wait(wait)
+        finally:
+            self._end_wait()
+        
+        if errors:
+            typ, val, loc = errors[0]
+            raise typ, val, loc
+        return [ task._result for task in tasks ]
+    
+    def close(self, timeout = None):
+        """
+        Cancels queued tasks and waits for worker threads to exit once 
+        they're done with the tasks they're running, for up to timeout
+        seconds (as long as it takes if None). The pool may still be 
+        used afterwards, new workers are started as needed.
+        """
+        while True:
+            try:
+                task = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            task.cancel()
+        with self._lock:
+            workers = list(self._workers)
+            # one stop sentinel per worker
+            for i in xrange(self._threads):
+                self._queue.put(None)
+            self._stopping += self._threads
+        
+        if timeout is not None:
+            deadline = time.time() + timeout
+        current = threading.currentThread()
+        for worker in workers:
+            if worker is current:
+                continue
+            if timeout is None:
+                worker.join()
+            else:
+                worker.join(max(0, deadline - time.time()))
+    
+    def _is_worker(self):
+        return getattr(self._local, 'worker', False)
+    
+    def _begin_wait(self):
+        if self._is_worker():
+            with self._lock:
+                self._waiting += 1
+            self._spawn()
+    
+    def _end_wait(self):
+        if self._is_worker():
+            with self._lock:
+                self._waiting -= 1
+    
+    def _spawn(self):
+        if self._pid != os.getpid():
+            # forked: threads aren't inherited
+            with self._lock:
+                self._threads = self._idle = self._waiting = 0
+                self._stopping = 0
+                self._workers = set()
+                self._pid = os.getpid()
+        with self._lock:
+            if self._idle >= self._queue.qsize() - self._stopping:
+                return
+            if (self.maxthreads is not None 
+                    and self._threads >= self.maxthreads + self._waiting):
+                return
+            self._threads += 1
+            self._idle += 1
+            thread = threading.Thread(target = self._worker)
+            thread.setDaemon(True)
+            self._workers.add(thread)
+        thread.start()
+    
+    def _worker(self):
+        self._local.worker = True
+        try:
+            while True:
+                try:
+                    task = self._queue.get(True, self.idle_timeout)
+                except Queue.Empty:
+                    break
+                if task is None:
+                    with self._lock:
+                        self._stopping -= 1
+                    break
+                with self._lock:
+                    self._idle -= 1
+                try:
+                    task._run()
+                    if task.start is not None:
+                        self.times.append((task.name, task.start, task.end))
+                finally:
+                    with self._lock:
+                        self._idle += 1
+                        excess = (self.maxthreads is not None 
+                            and self._threads > self.maxthreads + self._waiting)
+                if excess:
+                    break
+        finally:
+            with self._lock:
+                self._threads -= 1
+                self._idle -= 1
+                self._workers.discard(threading.currentThread())
+        # tasks queued while this thread was exiting
+        if self._queue.qsize() > self._stopping:
+            self._spawn()
@@ -4,6 +4,8 @@ from nepi.core.attributes import Attribute
 from nepi.util.parser.base import ExperimentData, ExperimentParser
 from xml.dom import minidom
 
+import StringIO
+import codecs
 import sys
 
 def xmlencode(s):
@@ -325,3 +327,74 @@ class XmlExperimentParser(ExperimentParser):
         if type == Attribute.DOUBLE:
             return float(value)
 
+
+class IncrementalXmlWriter(object):
+    """
+    Generates the same XML as XmlExperimentParser.to_xml, but keeps the 
+    serialized section of each element, so that after changing a few 
+    elements (see invalidate) only those are serialized again.
+    """
+    INDENT = "    "
+    PLACEHOLDER = "@@elements-%d@@"
+    
+    def __init__(self, parser = None):
+        if parser is None:
+            parser = XmlExperimentParser()
+        self.parser = parser
+        self._sections = dict()
+    
+    def invalidate(self, guids = None):
+        """
+        Forgets the sections of the given elements, or all of them.
+        """
+        if guids is None:
+            self._sections.clear()
+        else:
+            for guid in guids:
+                self._sections.pop(guid, None)
+    
+    def to_xml(self, data):
+        doc = minidom.Document()
+        exp_tag = doc.createElement("experiment")
+        testbeds_tag = doc.createElement("testbeds")
+        exp_tag.appendChild(testbeds_tag)
+        
+        # testbeds are serialized every time, with a placeholder 
+        # where their elements' sections go
+        sections = dict()
+        for guid in sorted(data.guids):
+            if data.is_testbed_data(guid):
+                elements_tag = self.parser.testbed_data_to_xml(doc, 
+                    testbeds_tag, guid, data)
+                elements_tag.appendChild(doc.createTextNode(
+                    self.PLACEHOLDER % guid))
+                sections[guid] = []
+            else:
+                (testbed_guid, factory_id) = data.get_box_data(guid)
+                sections[testbed_guid].append(self._section(doc, guid, data))
+        doc.appendChild(exp_tag)
+        
+        xml = doc.toprettyxml(indent = self.INDENT, encoding = "UTF-8")
+        for testbed_guid, testbed_sections in sections.iteritems():
+            placeholder = "<elements>%s</elements>" % (
+                self.PLACEHOLDER % testbed_guid)
+            if testbed_sections:
+                elements = "<elements>\n%s%s</elements>" % (
+                    "".join(testbed_sections), self.INDENT * 3)
+            else:
+                elements = "<elements/>"
+            xml = xml.replace(placeholder, elements, 1)
+        return xml
+    
+    def _section(self, doc, guid, data):
+        section = self._sections.get(guid)
+        if section is None:
+            (testbed_guid, factory_id) = data.get_box_data(guid)
+            parent_tag = doc.createElement("elements")
+            self.parser.box_data_to_xml(doc, {testbed_guid : parent_tag}, 
+                guid, data)
+            writer = codecs.getwriter("UTF-8")(StringIO.StringIO())
+            parent_tag.firstChild.writexml(writer, self.INDENT * 4, 
+                self.INDENT, "\n")
+            section = self._sections[guid] = writer.getvalue()
+        return section
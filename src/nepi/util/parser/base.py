@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import copy
 import sys
 
 class ExperimentData(object):
@@ -17,6 +18,17 @@ class ExperimentData(object):
     def guids(self):
         return self.data.keys()
 
+    def copy(self):
+        """
+        Returns a copy-on-write view of this data, that can be freely
+        modified without affecting it, as long as this data isn't
+        itself modified afterwards.
+        """
+        return ExperimentDataView(self)
+
+    def _writable(self, guid):
+        return self.data[guid]
+
     def add_testbed_data(self, guid, testbed_id, testbed_version):
         testbed_data = dict()
         testbed_data["testbed_id"] = testbed_id
@@ -30,7 +42,7 @@ class ExperimentData(object):
         self.data[guid] = box_data
 
     def add_graphical_info_data(self, guid, x, y, width, height):
-        data = self.data[guid]
+        data = self._writable(guid)
         if not "graphical_info" in data:
             data["graphical_info"] = dict()
         graphical_info_data = data["graphical_info"]
@@ -40,21 +52,21 @@ class ExperimentData(object):
         graphical_info_data["height"] = height
 
     def add_factory_attribute_data(self, guid, name, value):
-        data = self.data[guid]
+        data = self._writable(guid)
         if not "factory_attributes" in data:
             data["factory_attributes"] = dict()
         factory_attributes_data = data["factory_attributes"]
         factory_attributes_data[name] = value
 
     def add_attribute_data(self, guid, name, value):
-        data = self.data[guid]
+        data = self._writable(guid)
         if not "attributes" in data:
             data["attributes"] = dict()
         attributes_data = data["attributes"]
         attributes_data[name] = value
 
     def add_trace_data(self, guid, trace_name):
-        data = self.data[guid]
+        data = self._writable(guid)
         if not "traces" in data:
             data["traces"] = list()
         traces_data = data["traces"]
@@ -62,7 +74,7 @@ class ExperimentData(object):
 
     def add_connection_data(self, guid, connector_type_name, other_guid,
             other_connector_type_name):
-        data = self.data[guid]
+        data = self._writable(guid)
         if not "connections" in data:
             data["connections"] = dict()
         connections_data = data["connections"]
@@ -73,7 +85,7 @@ class ExperimentData(object):
 
     def add_address_data(self, guid, address, netprefix, 
             broadcast):
-        data = self.data[guid]
+        data = self._writable(guid)
         if not "addresses" in data:
             data["addresses"] = list()
         addresses_data = data["addresses"]
@@ -86,7 +98,7 @@ class ExperimentData(object):
         addresses_data.append(address_data)
 
     def add_route_data(self, guid, destination, netprefix, nexthop, metric, device):
-        data = self.data[guid]
+        data = self._writable(guid)
         if not "routes" in data:
             data["routes"] = list()
         routes_data = data["routes"]
@@ -143,7 +155,7 @@ class ExperimentData(object):
             return attributes_data.get(attribute, default)
 
     def set_attribute_data(self, guid, attribute, value):
-        data = self.data[guid]
+        data = self._writable(guid)
         if not "attributes" in data:
             raise KeyError, "No attributes in reference OBJECT %r" % (guid,)
         attributes_data = data["attributes"]
@@ -188,6 +200,22 @@ class ExperimentData(object):
                  data["Device"]) \
                          for data in routes_data]
 
+class ExperimentDataView(ExperimentData):
+    """
+    Shares the element data of another ExperimentData until it's
+    modified, when only the data of the modified element is copied.
+    """
+    def __init__(self, base):
+        super(ExperimentDataView, self).__init__()
+        self.data = dict(base.data)
+        self._owned = set()
+
+    def _writable(self, guid):
+        if guid not in self._owned:
+            self.data[guid] = copy.deepcopy(self.data[guid])
+            self._owned.add(guid)
+        return self.data[guid]
+
 class ExperimentParser(object):
     def to_data(self, experiment_description):
         data = ExperimentData()
@@ -4,16 +4,21 @@ import base64
 import nepi.core.execute
 import nepi.util.environ
 from nepi.core.attributes import AttributesMap, Attribute
-from nepi.util import server, validation
-from nepi.util.constants import TIME_NOW, ATTR_NEPI_TESTBED_ENVIRONMENT_SETUP, DeploymentConfiguration as DC
+from nepi.util import server, validation, codec, defer, rpcstats
+from nepi.util.constants import TIME_NOW, ATTR_NEPI_TESTBED_ENVIRONMENT_SETUP, DeploymentConfiguration as DC, \
+        ApplicationStatus as AS
 import getpass
 import cPickle
+import copy
 import sys
+import threading
 import time
 import tempfile
 import shutil
 import functools
+import operator
 import os
+from nepi.util.parallel import ParallelMap
 
 # PROTOCOL REPLIES
 OK = 0
@@ -66,6 +71,23 @@ STOPPED_TIME  = 45
 CURRENT = 46
 ACCESS_CONFIGURATIONS = 47
 CURRENT_ACCESS_CONFIG = 48
+MULTICALL = 49
+READ_TRACE = 50
+STATS = 51
+RPC_STATS = 52
+DUMP_RPC_STATS = 53
+SNAPSHOT_ATTRIBUTES = 54
+WAIT_FOR = 55
+SUITE_METRICS = 56
+STATUS_MANY = 57
+GET_MANY = 58
+FINISHED_ALL = 59
+TIMELINE = 60
+DUMP_TIMELINE = 61
+
+# CLIENT-SIDE CACHING POLICIES
+CACHE_IMMUTABLE = "immutable"
+CACHE_PHASE = "phase"
 
 
 instruction_text = dict({
@@ -114,7 +136,20 @@ instruction_text = dict({
     STOPPED_TIME: "STOPPED_TIME",
     CURRENT: "CURRENT",
     ACCESS_CONFIGURATIONS: "ACCESS_CONFIGURATIONS",
-    CURRENT_ACCESS_CONFIG: "CURRENT_ACCESS_CONFIG"
+    CURRENT_ACCESS_CONFIG: "CURRENT_ACCESS_CONFIG",
+    MULTICALL: "MULTICALL",
+    READ_TRACE: "READ_TRACE",
+    STATS: "STATS",
+    RPC_STATS: "RPC_STATS",
+    DUMP_RPC_STATS: "DUMP_RPC_STATS",
+    SNAPSHOT_ATTRIBUTES: "SNAPSHOT_ATTRIBUTES",
+    WAIT_FOR: "WAIT_FOR",
+    SUITE_METRICS: "SUITE_METRICS",
+    STATUS_MANY: "STATUS_MANY",
+    GET_MANY: "GET_MANY",
+    FINISHED_ALL: "FINISHED_ALL",
+    TIMELINE: "TIMELINE",
+    DUMP_TIMELINE: "DUMP_TIMELINE",
 
     })
 
@@ -130,7 +165,12 @@ def log_msg(server, params):
 
 def log_reply(server, reply):
     try:
-        res = reply.split("|")
+        if codec.is_message(reply):
+            code, value = codec.decode_message(reply)
+            server.log_debug("%s - reply: %s %r" % (server.__class__.__name__,
+                    instruction_text[code], value))
+            return
+        res = reply.split("|", 1)
         code = int(res[0])
         code_txt = instruction_text[code]
         try:
@@ -152,6 +192,9 @@ def to_server_log_level(log_level):
         else DC.ERROR_LEVEL
     )
 
+# Default chunk size for stream_trace
+TRACE_CHUNK_SIZE = 1 << 20
+
 def get_access_config_params(access_config):
     mode = access_config.get_attribute_value(DC.DEPLOYMENT_MODE)
     launch = not access_config.get_attribute_value(DC.RECOVER)
@@ -172,8 +215,56 @@ def get_access_config_params(access_config):
     key = access_config.get_attribute_value(DC.DEPLOYMENT_KEY)
     communication = access_config.get_attribute_value(DC.DEPLOYMENT_COMMUNICATION)
     clean_root = access_config.get_attribute_value(DC.CLEAN_ROOT)
+    message_codec = access_config.get_attribute_value(DC.DEPLOYMENT_CODEC)
+    zygote = access_config.get_attribute_value(DC.USE_ZYGOTE)
     return (mode, launch, root_dir, log_level, communication, user, host, port,
-            key, agent, sudo, environment_setup, clean_root)
+            key, agent, sudo, environment_setup, clean_root, message_codec,
+            zygote)
+
+def stream_trace(controller, guid, trace_id, path, chunk_size = TRACE_CHUNK_SIZE):
+    """
+    Generator that copies a trace into the local file at path, fetching
+    it in chunks of at most chunk_size bytes, so memory usage is bounded
+    regardless of the trace's size. Works with any (testbed or experiment)
+    controller or controller proxy. The next chunk is requested before 
+    writing the current one, to overlap transfers with disk writes.
+    
+    Yields the number of bytes written so far after each chunk:
+    
+        for written in stream_trace(controller, guid, "pcap", "out.pcap"):
+            print "%d bytes" % (written,)
+    """
+    read = getattr(controller, 'read_trace_deferred', controller.read_trace)
+    def undefer(chunk):
+        if hasattr(chunk, '_get'):
+            return chunk._get()
+        return chunk
+    
+    offset = 0
+    pending = None
+    f = open(path, "wb")
+    try:
+        pending = read(guid, trace_id, offset, chunk_size)
+        while pending is not None:
+            chunk = undefer(pending)
+            pending = None
+            if not chunk:
+                break
+            offset += len(chunk)
+            if len(chunk) == chunk_size:
+                pending = read(guid, trace_id, offset, chunk_size)
+            # else short read, it's the end of the trace
+            f.write(chunk)
+            del chunk
+            yield offset
+    finally:
+        f.close()
+        if pending is not None:
+            # abandoned half-way, drain the outstanding reply
+            try:
+                undefer(pending)
+            except:
+                pass
 
 class AccessConfiguration(AttributesMap):
     def __init__(self, params = None):
@@ -202,12 +293,12 @@ class PermDir(object):
         self.path = path
 
 def create_experiment_suite(xml, access_config, repetitions = None,
-        duration = None, wait_guids = None):
+        duration = None, wait_guids = None, max_parallel = None):
     mode = None
     if access_config :
         (mode, launch, root_dir, log_level, communication, user, host, port, 
-                key, agent, sudo, environment_setup, clean_root) \
-                        = get_access_config_params(access_config)
+                key, agent, sudo, environment_setup, clean_root, message_codec,
+                zygote) = get_access_config_params(access_config)
 
     if not mode or mode == DC.MODE_SINGLE_PROCESS:
         from nepi.core.execute import ExperimentSuite
@@ -217,7 +308,7 @@ def create_experiment_suite(xml, access_config, repetitions = None,
             root_dir = PermDir(access_config.get_attribute_value(DC.ROOT_DIRECTORY))
 
         exp_suite = ExperimentSuite(xml, access_config, repetitions, duration,
-                wait_guids)
+                wait_guids, max_parallel)
         
         # inject reference to temporary dir, so that it gets cleaned
         # up at destruction time.
@@ -237,7 +328,10 @@ def create_experiment_suite(xml, access_config, repetitions = None,
                 agent = agent, 
                 sudo = sudo, 
                 environment_setup = environment_setup, 
-                clean_root = clean_root)
+                clean_root = clean_root,
+                message_codec = message_codec,
+                zygote = zygote,
+                max_parallel = max_parallel)
     raise RuntimeError("Unsupported access configuration '%s'" % mode)
 
 def create_experiment_controller(xml, access_config = None):
@@ -246,8 +340,8 @@ def create_experiment_controller(xml, access_config = None):
     log_level = DC.ERROR_LEVEL
     if access_config:
         (mode, launch, root_dir, log_level, communication, user, host, port, 
-                key, agent, sudo, environment_setup, clean_root) \
-                        = get_access_config_params(access_config)
+                key, agent, sudo, environment_setup, clean_root, message_codec,
+                zygote) = get_access_config_params(access_config)
 
     os.environ["NEPI_CONTROLLER_LOGLEVEL"] = log_level
 
@@ -282,7 +376,9 @@ def create_experiment_controller(xml, access_config = None):
                 sudo = sudo, 
                 launch = launch,
                 environment_setup = environment_setup, 
-                clean_root = clean_root)
+                clean_root = clean_root,
+                message_codec = message_codec,
+                zygote = zygote)
         except:
             if not launch:
                 # Maybe controller died, recover from persisted testbed information if possible
@@ -297,7 +393,9 @@ def create_experiment_controller(xml, access_config = None):
                     sudo = sudo, 
                     launch = True,
                     environment_setup = environment_setup,
-                    clean_root = clean_root)
+                    clean_root = clean_root,
+                    message_codec = message_codec,
+                    zygote = zygote)
                 controller.recover()
                 return controller
             else:
@@ -310,8 +408,8 @@ def create_testbed_controller(testbed_id, testbed_version, access_config):
     log_level = DC.ERROR_LEVEL
     if access_config:
         (mode, launch, root_dir, log_level, communication, user, host, port, 
-                key, agent, sudo, environment_setup, clean_root) \
-                        = get_access_config_params(access_config)
+                key, agent, sudo, environment_setup, clean_root, message_codec,
+                zygote) = get_access_config_params(access_config)
 
     os.environ["NEPI_CONTROLLER_LOGLEVEL"] = log_level
     
@@ -332,7 +430,9 @@ def create_testbed_controller(testbed_id, testbed_version, access_config):
                 sudo = sudo, 
                 launch = launch,
                 environment_setup = environment_setup, 
-                clean_root = clean_root)
+                clean_root = clean_root,
+                message_codec = message_codec,
+                zygote = zygote)
     raise RuntimeError("Unsupported access configuration '%s'" % mode)
 
 def _build_testbed_controller(testbed_id, testbed_version):
@@ -362,6 +462,10 @@ class Marshalling:
         def base64_data(sdata):
             return base64.b64decode(sdata)
         
+        @staticmethod
+        def raw_data(sdata):
+            return sdata
+        
         @staticmethod
         def nullint(sdata):
             return None if sdata == "None" else int(sdata)
@@ -381,6 +485,14 @@ class Marshalling:
                 return ""
             return base64.b64encode(data)
         
+        @staticmethod
+        def raw_data(data):
+            # Only valid as a return value, since it may contain
+            # the '|' separator
+            if not data:
+                return ""
+            return str(data)
+        
         @staticmethod
         def nullint(data):
             return "None" if data is None else int(data)
@@ -415,6 +527,36 @@ class Marshalling:
     # Generic encoder
     _TYPE_ENCODERS[None] = (str, "%s")
     
+    # type name -> function turning a native value into what an
+    # encode/decode round trip would yield, for binary messages
+    _TYPE_NORMALIZERS = dict(
+        base64_data = lambda data : str(data) if data else "",
+        raw_data = lambda data : str(data) if data else "",
+        pickled_data = lambda data : data,
+        nullint = lambda data : None if data is None else int(data),
+        bool = operator.truth,
+        float = float,
+        int = int,
+        long = int,
+        str = str,
+        unicode = str,
+    )
+    
+    @staticmethod
+    def normalize(typ, value):
+        """
+        Converts a native value of a command argument or return value
+        into the value it would have after being marshalled as typ.
+        None (void) types yield None.
+        """
+        if typ is None:
+            return None
+        normalize = Marshalling._TYPE_NORMALIZERS.get(typ.__name__)
+        if normalize is None:
+            # generic encoder
+            return typ(str(value))
+        return normalize(value)
+    
     @staticmethod
     def args(*types):
         """
@@ -452,6 +594,7 @@ class Marshalling:
             rv._argencoders = tuple(argencoders)
             
             rv._retval = getattr(f, '_retval', None)
+            rv._plain = getattr(f, '_plain', f)
             return rv
         return decor
 
@@ -489,6 +632,7 @@ class Marshalling:
             rv._retval = typ
             rv._argtypes = getattr(f, '_argtypes', None)
             rv._argencoders = getattr(f, '_argencoders', None)
+            rv._plain = f
             return rv
         return decor
     
@@ -510,8 +654,50 @@ class Marshalling:
         rv._retval = None
         rv._argtypes = getattr(f, '_argtypes', None)
         rv._argencoders = getattr(f, '_argencoders', None)
+        rv._plain = f
         return rv
     
+    @staticmethod
+    def serialized(f):
+        """
+        Marks the command as ordering-sensitive. Servers process 
+        serialized commands one at a time, in the order they arrive,
+        holding their state lock, while other commands may be processed
+        concurrently, with them and with each other. Every command that 
+        changes the server's state must be serialized, only read-only
+        queries may be left unmarked.
+        """
+        f._serialized = True
+        return f
+    
+    @staticmethod
+    def immutable(f):
+        """
+        Marks the command's result as depending only on its arguments
+        for the whole life of the server. Proxies cache it client-side.
+        """
+        f._cache = CACHE_IMMUTABLE
+        return f
+    
+    @staticmethod
+    def phase_cached(f):
+        """
+        Marks the command's result as constant until the next lifecycle
+        transition (see transition). Proxies cache it client-side, and
+        drop it whenever a transition is invoked.
+        """
+        f._cache = CACHE_PHASE
+        return f
+    
+    @staticmethod
+    def transition(f):
+        """
+        Marks the command as a lifecycle transition, after which
+        phase_cached results are no longer valid.
+        """
+        f._transition = True
+        return f
+    
     @staticmethod
     def handles(whichcommand):
         """
@@ -524,22 +710,64 @@ class Marshalling:
         return decor
 
 class BaseServer(server.Server):
+    # Maximum number of commands processed concurrently
+    MAX_WORKERS = 8
+    
+    def __init__(self, *p, **kw):
+        super(BaseServer, self).__init__(*p, **kw)
+        self._handlers = None
+        self._workers = None
+        self._serial_worker = None
+        # held while running serialized (state-changing) commands, 
+        # queries don't take it, so they're never held back by them
+        self._state_lock = threading.RLock()
+        self._rpc_stats = rpcstats.RpcStats()
+    
+    def _handler(self, instruction):
+        if self._handlers is None:
+            handlers = dict()
+            for cls in reversed(self.__class__.__mro__):
+                for mname,meth in vars(cls).iteritems():
+                    if not mname.startswith('_'):
+                        cmd = getattr(meth, '_handles_command', None)
+                        if cmd is not None:
+                            handlers[cmd] = mname
+            self._handlers = handlers
+        mname = self._handlers.get(instruction)
+        if mname is None:
+            return None
+        return getattr(self, mname)
+
     def reply_action(self, msg):
-        if not msg:
+        call = self._rpc_stats.begin(None)
+        if call is None:
+            return self._reply_action(msg)
+        
+        reply = self._reply_action(msg)
+        try:
+            meth = self._handler(self._instruction(msg))
+            error = self._instruction(reply) != OK
+        except ValueError:
+            meth = None
+            error = True
+        call.methname = meth.__name__ if meth is not None else "invalid"
+        call.finish(len(reply), len(msg), error)
+        return reply
+
+    def _reply_action(self, msg):
+        if codec.is_message(msg):
+            return self._binary_reply_action(msg)
+        elif not msg:
             result = base64.b64encode("Invalid command line")
             reply = "%d|%s" % (ERROR, result)
         else:
             params = msg.split("|")
-            instruction = int(params[0])
             log_msg(self, params)
             try:
-                for mname,meth in vars(self.__class__).iteritems():
-                    if not mname.startswith('_'):
-                        cmd = getattr(meth, '_handles_command', None)
-                        if cmd == instruction:
-                            meth = getattr(self, mname)
-                            reply = meth(params)
-                            break
+                instruction = int(params[0])
+                meth = self._handler(instruction)
+                if meth is not None:
+                    reply = meth(params)
                 else:
                     error = "Invalid instruction %s" % instruction
                     self.log_error(error)
@@ -552,6 +780,93 @@ class BaseServer(server.Server):
         log_reply(self, reply)
         return reply
 
+    def _binary_reply_action(self, msg):
+        try:
+            instruction, params = codec.decode_message(msg)
+            log_msg(self, [instruction] + list(params))
+            meth = self._handler(instruction)
+            if meth is not None:
+                # call the undecorated handler, values are already native
+                rv = meth._plain(self, *params)
+                rv = Marshalling.normalize(meth._retval, rv)
+                reply = codec.encode_message(OK, rv)
+            else:
+                error = "Invalid instruction %s" % instruction
+                self.log_error(error)
+                reply = codec.encode_message(ERROR, error)
+        except:
+            error = self.log_error()
+            reply = codec.encode_message(ERROR, error)
+        log_reply(self, reply)
+        return reply
+
+    @staticmethod
+    def _instruction(msg):
+        if codec.is_message(msg):
+            return codec.message_code(msg)
+        else:
+            return int(msg.split("|",1)[0])
+
+    def dispatch(self, msg, reply_to):
+        if self._workers is None:
+            # created on demand, threads don't survive daemonization
+            self._workers = ParallelMap(self.MAX_WORKERS, results = False)
+            self._workers.start()
+            self._serial_worker = ParallelMap(1, results = False)
+            self._serial_worker.start()
+        
+        try:
+            meth = self._handler(self._instruction(msg))
+        except ValueError:
+            meth = None
+        
+        if meth is not None and not getattr(meth, '_serialized', False):
+            workers = self._workers
+            lock = None
+        else:
+            # unknown commands go through the serial worker too,
+            # to get their error replies in order
+            workers = self._serial_worker
+            lock = self._state_lock
+        workers.put(self._dispatch_one, msg, reply_to, lock)
+
+    def _dispatch_one(self, msg, reply_to, lock):
+        if lock is not None:
+            with lock:
+                reply = self.reply_action(msg)
+        else:
+            reply = self.reply_action(msg)
+        reply_to(reply)
+
+    def sync(self):
+        if self._workers is not None:
+            self._serial_worker.sync()
+            self._workers.sync()
+
+    @Marshalling.handles(MULTICALL)
+    @Marshalling.serialized
+    @Marshalling.args(Marshalling.pickled_data)
+    @Marshalling.retval( Marshalling.pickled_data )
+    def execute_multicall(self, msgs):
+        # Each call gets its own reply, errors included, 
+        # so a failed call doesn't prevent the rest from running
+        return map(self.reply_action, msgs)
+
+    @Marshalling.handles(STATS)
+    @Marshalling.args(Marshalling.nullint, Marshalling.bool)
+    @Marshalling.retval( Marshalling.pickled_data )
+    def stats(self, enable = None, reset = False):
+        """
+        Returns the server's RPC statistics (see nepi.util.rpcstats),
+        after turning recording on or off if enable is given.
+        """
+        if enable is not None:
+            rpcstats.enable(enable)
+        rv = self._rpc_stats.snapshot()
+        if reset:
+            self._rpc_stats.reset()
+        return rv
+
 class ExperimentSuiteServer(BaseServer):
     def __init__(self, root_dir, log_level, 
             xml, repetitions, duration, wait_guids, 
@@ -563,7 +878,10 @@ class ExperimentSuiteServer(BaseServer):
             agent = None,
             sudo = False, 
             environment_setup = "", 
-            clean_root = False):
+            clean_root = False,
+            message_codec = None,
+            zygote = False,
+            max_parallel = None):
         super(ExperimentSuiteServer, self).__init__(root_dir, log_level, 
             environment_setup = environment_setup, clean_root = clean_root)
         access_config = AccessConfiguration()
@@ -586,10 +904,15 @@ class ExperimentSuiteServer(BaseServer):
             access_config.set_attribute_value(DC.DEPLOYMENT_COMMUNICATION, communication)
         if clean_root:
             access_config.set_attribute_value(DC.CLEAN_ROOT, clean_root)
+        if message_codec:
+            access_config.set_attribute_value(DC.DEPLOYMENT_CODEC, message_codec)
+        if zygote:
+            access_config.set_attribute_value(DC.USE_ZYGOTE, zygote)
         self._experiment_xml = xml
         self._duration = duration
         self._repetitions = repetitions
         self._wait_guids = wait_guids
+        self._max_parallel = max_parallel
         self._access_config = access_config
         self._experiment_suite = None
 
@@ -597,11 +920,12 @@ class ExperimentSuiteServer(BaseServer):
         from nepi.core.execute import ExperimentSuite
         self._experiment_suite = ExperimentSuite(
                 self._experiment_xml, self._access_config, 
-                self._repetitions, self._duration, self._wait_guids)
+                self._repetitions, self._duration, self._wait_guids,
+                self._max_parallel)
 
     @Marshalling.handles(CURRENT)
     @Marshalling.args()
-    @Marshalling.retval(int)
+    @Marshalling.retval( Marshalling.pickled_data )
     def current(self):
         return self._experiment_suite.current()
    
@@ -624,12 +948,14 @@ class ExperimentSuiteServer(BaseServer):
         return self._experiment_suite.get_access_configurations()
 
     @Marshalling.handles(START)
+    @Marshalling.serialized
     @Marshalling.args()
     @Marshalling.retvoid
     def start(self):
         self._experiment_suite.start()
 
     @Marshalling.handles(SHUTDOWN)
+    @Marshalling.serialized
     @Marshalling.args()
     @Marshalling.retvoid
     def shutdown(self):
@@ -641,6 +967,12 @@ class ExperimentSuiteServer(BaseServer):
     def get_current_access_config(self):
         return self._experiment_suite.get_current_access_config()
 
+    @Marshalling.handles(SUITE_METRICS)
+    @Marshalling.args()
+    @Marshalling.retval( Marshalling.pickled_data )
+    def metrics(self):
+        return self._experiment_suite.metrics()
+
 class TestbedControllerServer(BaseServer):
     def __init__(self, root_dir, log_level, testbed_id, testbed_version, 
             environment_setup, clean_root):
@@ -653,6 +985,9 @@ class TestbedControllerServer(BaseServer):
     def post_daemonize(self):
         self._testbed = _build_testbed_controller(self._testbed_id, 
                 self._testbed_version)
+        # the testbed's own lock, so that its threads can keep out
+        # of the way of state-changing commands
+        self._state_lock = self._testbed._lock
 
     @Marshalling.handles(GUIDS)
     @Marshalling.args()
@@ -661,18 +996,21 @@ class TestbedControllerServer(BaseServer):
         return self._testbed.guids
 
     @Marshalling.handles(TESTBED_ID)
+    @Marshalling.immutable
     @Marshalling.args()
     @Marshalling.retval()
     def testbed_id(self):
         return str(self._testbed.testbed_id)
 
     @Marshalling.handles(TESTBED_VERSION)
+    @Marshalling.immutable
     @Marshalling.args()
     @Marshalling.retval()
     def testbed_version(self):
         return str(self._testbed.testbed_version)
 
     @Marshalling.handles(CREATE)
+    @Marshalling.serialized
     @Marshalling.args(int, str)
     @Marshalling.retvoid
     def defer_create(self, guid, factory_id):
@@ -680,53 +1018,70 @@ class TestbedControllerServer(BaseServer):
 
     @Marshalling.handles(TRACE)
     @Marshalling.args(int, str, Marshalling.base64_data)
-    @Marshalling.retval()
+    @Marshalling.retval( Marshalling.raw_data )
     def trace(self, guid, trace_id, attribute):
         return self._testbed.trace(guid, trace_id, attribute)
 
+    @Marshalling.handles(READ_TRACE)
+    @Marshalling.args(int, str, int, int)
+    @Marshalling.retval( Marshalling.raw_data )
+    def read_trace(self, guid, trace_id, offset, length):
+        return self._testbed.read_trace(guid, trace_id, offset, length)
+
     @Marshalling.handles(TRACES_INFO)
+    @Marshalling.phase_cached
     @Marshalling.args()
     @Marshalling.retval( Marshalling.pickled_data )
     def traces_info(self):
         return self._testbed.traces_info()
 
     @Marshalling.handles(START)
+    @Marshalling.transition
+    @Marshalling.serialized
     @Marshalling.args()
     @Marshalling.retvoid
     def start(self):
         self._testbed.start()
 
     @Marshalling.handles(STOP)
+    @Marshalling.transition
+    @Marshalling.serialized
     @Marshalling.args()
     @Marshalling.retvoid
     def stop(self):
         self._testbed.stop()
 
     @Marshalling.handles(SHUTDOWN)
+    @Marshalling.transition
+    @Marshalling.serialized
     @Marshalling.args()
     @Marshalling.retvoid
     def shutdown(self):
         self._testbed.shutdown()
 
     @Marshalling.handles(CONFIGURE)
+    @Marshalling.serialized
     @Marshalling.args(Marshalling.base64_data, Marshalling.pickled_data)
     @Marshalling.retvoid
     def defer_configure(self, name, value):
         self._testbed.defer_configure(name, value)
 
     @Marshalling.handles(CREATE_SET)
+    @Marshalling.serialized
     @Marshalling.args(int, Marshalling.base64_data, Marshalling.pickled_data)
     @Marshalling.retvoid
     def defer_create_set(self, guid, name, value):
         self._testbed.defer_create_set(guid, name, value)
 
     @Marshalling.handles(FACTORY_SET)
+    @Marshalling.serialized
     @Marshalling.args(Marshalling.base64_data, Marshalling.pickled_data)
     @Marshalling.retvoid
     def defer_factory_set(self, name, value):
         self._testbed.defer_factory_set(name, value)
 
     @Marshalling.handles(CONNECT)
+    @Marshalling.serialized
     @Marshalling.args(int, str, int, str)
     @Marshalling.retvoid
     def defer_connect(self, guid1, connector_type_name1, guid2, connector_type_name2):
@@ -734,6 +1089,7 @@ class TestbedControllerServer(BaseServer):
             connector_type_name2)
 
     @Marshalling.handles(CROSS_CONNECT)
+    @Marshalling.serialized
     @Marshalling.args(int, str, int, int, str, str, str)
     @Marshalling.retvoid
     def defer_cross_connect(self, 
@@ -746,12 +1102,15 @@ class TestbedControllerServer(BaseServer):
             cross_connector_type_name)
 
     @Marshalling.handles(ADD_TRACE)
+    @Marshalling.transition
+    @Marshalling.serialized
     @Marshalling.args(int, str)
     @Marshalling.retvoid
     def defer_add_trace(self, guid, trace_id):
         self._testbed.defer_add_trace(guid, trace_id)
 
     @Marshalling.handles(ADD_ADDRESS)
+    @Marshalling.serialized
     @Marshalling.args(int, str, int, Marshalling.pickled_data)
     @Marshalling.retvoid
     def defer_add_address(self, guid, address, netprefix, broadcast):
@@ -759,6 +1118,7 @@ class TestbedControllerServer(BaseServer):
                 broadcast)
 
     @Marshalling.handles(ADD_ROUTE)
+    @Marshalling.serialized
     @Marshalling.args(int, str, int, str, int, str)
     @Marshalling.retvoid
     def defer_add_route(self, guid, destination, netprefix, nexthop, 
@@ -767,54 +1127,72 @@ class TestbedControllerServer(BaseServer):
                 metric, device)
 
     @Marshalling.handles(DO_SETUP)
+    @Marshalling.transition
+    @Marshalling.serialized
     @Marshalling.args()
     @Marshalling.retvoid
     def do_setup(self):
         self._testbed.do_setup()
 
     @Marshalling.handles(DO_CREATE)
+    @Marshalling.transition
+    @Marshalling.serialized
     @Marshalling.args()
     @Marshalling.retvoid
     def do_create(self):
         self._testbed.do_create()
 
     @Marshalling.handles(DO_CONNECT_INIT)
+    @Marshalling.transition
+    @Marshalling.serialized
     @Marshalling.args()
     @Marshalling.retvoid
     def do_connect_init(self):
         self._testbed.do_connect_init()
 
     @Marshalling.handles(DO_CONNECT_COMPL)
+    @Marshalling.transition
+    @Marshalling.serialized
     @Marshalling.args()
     @Marshalling.retvoid
     def do_connect_compl(self):
         self._testbed.do_connect_compl()
 
     @Marshalling.handles(DO_CONFIGURE)
+    @Marshalling.transition
+    @Marshalling.serialized
     @Marshalling.args()
     @Marshalling.retvoid
     def do_configure(self):
         self._testbed.do_configure()
 
     @Marshalling.handles(DO_PRECONFIGURE)
+    @Marshalling.transition
+    @Marshalling.serialized
     @Marshalling.args()
     @Marshalling.retvoid
     def do_preconfigure(self):
         self._testbed.do_preconfigure()
 
     @Marshalling.handles(DO_PRESTART)
+    @Marshalling.transition
+    @Marshalling.serialized
     @Marshalling.args()
     @Marshalling.retvoid
     def do_prestart(self):
         self._testbed.do_prestart()
 
     @Marshalling.handles(DO_CROSS_CONNECT_INIT)
+    @Marshalling.transition
+    @Marshalling.serialized
     @Marshalling.args( Marshalling.Decoders.pickled_data )
     @Marshalling.retvoid
     def do_cross_connect_init(self, cross_data):
         self._testbed.do_cross_connect_init(cross_data)
 
     @Marshalling.handles(DO_CROSS_CONNECT_COMPL)
+    @Marshalling.transition
+    @Marshalling.serialized
     @Marshalling.args( Marshalling.Decoders.pickled_data )
     @Marshalling.retvoid
     def do_cross_connect_compl(self, cross_data):
@@ -826,7 +1204,14 @@ class TestbedControllerServer(BaseServer):
     def get(self, guid, name, time):
         return self._testbed.get(guid, name, time)
 
+    @Marshalling.handles(GET_MANY)
+    @Marshalling.args(int, Marshalling.pickled_data, str)
+    @Marshalling.retval( Marshalling.pickled_data )
+    def get_many(self, guid, names, time):
+        return self._testbed.get_many(guid, names, time)
+
     @Marshalling.handles(SET)
+    @Marshalling.serialized
     @Marshalling.args(int, Marshalling.base64_data, Marshalling.pickled_data, str)
     @Marshalling.retvoid
     def set(self, guid, name, value, time):
@@ -845,6 +1230,7 @@ class TestbedControllerServer(BaseServer):
         return str(self._testbed.get_route(guid, index, attribute))
 
     @Marshalling.handles(ACTION)
+    @Marshalling.serialized
     @Marshalling.args(str, int, Marshalling.base64_data)
     @Marshalling.retvoid
     def action(self, time, guid, command):
@@ -856,6 +1242,24 @@ class TestbedControllerServer(BaseServer):
     def status(self, guid):
         return self._testbed.status(guid)
 
+    @Marshalling.handles(STATUS_MANY)
+    @Marshalling.args(Marshalling.pickled_data)
+    @Marshalling.retval( Marshalling.pickled_data )
+    def status_many(self, guids):
+        return self._testbed.status_many(guids)
+
+    @Marshalling.handles(FINISHED_ALL)
+    @Marshalling.args(Marshalling.pickled_data)
+    @Marshalling.retval(Marshalling.bool)
+    def is_finished_all(self, guids):
+        return self._testbed.is_finished_all(guids)
+
+    @Marshalling.handles(WAIT_FOR)
+    @Marshalling.args(Marshalling.pickled_data, int, Marshalling.pickled_data)
+    @Marshalling.retval(Marshalling.bool)
+    def wait_for(self, guids, state, timeout = None):
+        return self._testbed.wait_for(guids, state, timeout)
+
     @Marshalling.handles(TESTBED_STATUS)
     @Marshalling.args()
     @Marshalling.retval(int)
@@ -863,18 +1267,34 @@ class TestbedControllerServer(BaseServer):
         return self._testbed.testbed_status()
 
     @Marshalling.handles(GET_ATTRIBUTE_LIST)
+    @Marshalling.immutable
     @Marshalling.args(int, Marshalling.nullint, Marshalling.bool)
     @Marshalling.retval( Marshalling.pickled_data )
     def get_attribute_list(self, guid, filter_flags = None, exclude = False):
         return self._testbed.get_attribute_list(guid, filter_flags, exclude)
 
+    @Marshalling.handles(SNAPSHOT_ATTRIBUTES)
+    @Marshalling.args(Marshalling.nullint, Marshalling.bool)
+    @Marshalling.retval( Marshalling.pickled_data )
+    def snapshot_attributes(self, filter_flags = None, exclude = False):
+        return self._testbed.snapshot_attributes(filter_flags, exclude)
+
     @Marshalling.handles(GET_FACTORY_ID)
+    @Marshalling.immutable
     @Marshalling.args(int)
     @Marshalling.retval()
     def get_factory_id(self, guid):
         return self._testbed.get_factory_id(guid)
 
+    @Marshalling.handles(TIMELINE)
+    @Marshalling.args()
+    @Marshalling.retval( Marshalling.pickled_data )
+    def timeline(self):
+        return self._testbed.timeline()
+
     @Marshalling.handles(RECOVER)
+    @Marshalling.transition
+    @Marshalling.serialized
     @Marshalling.args()
     @Marshalling.retvoid
     def recover(self):
@@ -895,42 +1315,54 @@ class ExperimentControllerServer(BaseServer):
             root_dir = self._root_dir)
 
     @Marshalling.handles(GUIDS)
+    @Marshalling.phase_cached
     @Marshalling.args()
     @Marshalling.retval( Marshalling.pickled_data )
     def guids(self):
         return self._experiment.guids
 
     @Marshalling.handles(STARTED_TIME)
+    @Marshalling.phase_cached
     @Marshalling.args()
     @Marshalling.retval( Marshalling.pickled_data )
     def started_time(self):
         return self._experiment.started_time
 
     @Marshalling.handles(STOPPED_TIME)
+    @Marshalling.phase_cached
     @Marshalling.args()
     @Marshalling.retval( Marshalling.pickled_data )
     def stopped_time(self):
         return self._experiment.stopped_time
 
     @Marshalling.handles(XML)
+    @Marshalling.immutable
     @Marshalling.args()
-    @Marshalling.retval()
+    @Marshalling.retval( Marshalling.raw_data )
     def experiment_design_xml(self):
         return self._experiment.experiment_design_xml
         
     @Marshalling.handles(EXEC_XML)
+    @Marshalling.phase_cached
     @Marshalling.args()
-    @Marshalling.retval()
+    @Marshalling.retval( Marshalling.raw_data )
     def experiment_execute_xml(self):
         return self._experiment.experiment_execute_xml
         
     @Marshalling.handles(TRACE)
     @Marshalling.args(int, str, Marshalling.base64_data)
-    @Marshalling.retval()
+    @Marshalling.retval( Marshalling.raw_data )
     def trace(self, guid, trace_id, attribute):
         return str(self._experiment.trace(guid, trace_id, attribute))
 
+    @Marshalling.handles(READ_TRACE)
+    @Marshalling.args(int, str, int, int)
+    @Marshalling.retval( Marshalling.raw_data )
+    def read_trace(self, guid, trace_id, offset, length):
+        return self._experiment.read_trace(guid, trace_id, offset, length)
+
     @Marshalling.handles(TRACES_INFO)
+    @Marshalling.phase_cached
     @Marshalling.args()
     @Marshalling.retval( Marshalling.pickled_data )
     def traces_info(self):
@@ -942,70 +1374,209 @@ class ExperimentControllerServer(BaseServer):
     def is_finished(self, guid):
         return self._experiment.is_finished(guid)
 
+    @Marshalling.handles(FINISHED_ALL)
+    @Marshalling.args(Marshalling.pickled_data)
+    @Marshalling.retval(Marshalling.bool)
+    def is_finished_all(self, guids):
+        return self._experiment.is_finished_all(guids)
+
     @Marshalling.handles(STATUS)
     @Marshalling.args(int)
     @Marshalling.retval(int)
     def status(self, guid):
         return self._experiment.status(guid)
 
+    @Marshalling.handles(STATUS_MANY)
+    @Marshalling.args(Marshalling.pickled_data)
+    @Marshalling.retval( Marshalling.pickled_data )
+    def status_many(self, guids):
+        return self._experiment.status_many(guids)
+
+    @Marshalling.handles(WAIT_FOR)
+    @Marshalling.args(Marshalling.pickled_data, int, Marshalling.pickled_data)
+    @Marshalling.retval(Marshalling.bool)
+    def wait_for(self, guids, state = AS.STATUS_FINISHED, timeout = None):
+        return self._experiment.wait_for(guids, state, timeout)
+
     @Marshalling.handles(GET)
     @Marshalling.args(int, Marshalling.base64_data, str)
     @Marshalling.retval( Marshalling.pickled_data )
     def get(self, guid, name, time):
         return self._experiment.get(guid, name, time)
 
+    @Marshalling.handles(GET_MANY)
+    @Marshalling.args(int, Marshalling.pickled_data, str)
+    @Marshalling.retval( Marshalling.pickled_data )
+    def get_many(self, guid, names, time):
+        return self._experiment.get_many(guid, names, time)
+
     @Marshalling.handles(SET)
+    @Marshalling.transition
+    @Marshalling.serialized
     @Marshalling.args(int, Marshalling.base64_data, Marshalling.pickled_data, str)
     @Marshalling.retvoid
     def set(self, guid, name, value, time):
         self._experiment.set(guid, name, value, time)
 
     @Marshalling.handles(START)
+    @Marshalling.transition
+    @Marshalling.serialized
     @Marshalling.args()
     @Marshalling.retvoid
     def start(self):
         self._experiment.start()
 
     @Marshalling.handles(STOP)
+    @Marshalling.transition
+    @Marshalling.serialized
     @Marshalling.args()
     @Marshalling.retvoid
     def stop(self):
         self._experiment.stop()
 
     @Marshalling.handles(RECOVER)
+    @Marshalling.transition
+    @Marshalling.serialized
     @Marshalling.args()
     @Marshalling.retvoid
     def recover(self):
         self._experiment.recover()
 
     @Marshalling.handles(SHUTDOWN)
+    @Marshalling.transition
+    @Marshalling.serialized
     @Marshalling.args()
     @Marshalling.retvoid
     def shutdown(self):
         self._experiment.shutdown()
 
     @Marshalling.handles(GET_TESTBED_ID)
+    @Marshalling.immutable
     @Marshalling.args(int)
     @Marshalling.retval()
     def get_testbed_id(self, guid):
         return self._experiment.get_testbed_id(guid)
 
     @Marshalling.handles(GET_FACTORY_ID)
+    @Marshalling.immutable
     @Marshalling.args(int)
     @Marshalling.retval()
     def get_factory_id(self, guid):
         return self._experiment.get_factory_id(guid)
 
     @Marshalling.handles(GET_TESTBED_VERSION)
+    @Marshalling.immutable
     @Marshalling.args(int)
     @Marshalling.retval()
     def get_testbed_version(self, guid):
         return self._experiment.get_testbed_version(guid)
 
+    @Marshalling.handles(RPC_STATS)
+    @Marshalling.args()
+    @Marshalling.retval( Marshalling.pickled_data )
+    def rpc_stats(self):
+        return self._experiment.rpc_stats()
+
+    @Marshalling.handles(DUMP_RPC_STATS)
+    @Marshalling.args(Marshalling.pickled_data)
+    @Marshalling.retval()
+    def dump_rpc_stats(self, path):
+        return self._experiment.dump_rpc_stats(path)
+
+    @Marshalling.handles(TIMELINE)
+    @Marshalling.args()
+    @Marshalling.retval( Marshalling.pickled_data )
+    def timeline(self):
+        return self._experiment.timeline()
+
+    @Marshalling.handles(DUMP_TIMELINE)
+    @Marshalling.args(Marshalling.pickled_data)
+    @Marshalling.retval()
+    def dump_timeline(self, path):
+        return self._experiment.dump_timeline(path)
+
+class Multicall(object):
+    """
+    Multicall envelope: stub invocations are queued client-side,
+    and sent to the server in a single message upon flush().
+    
+    Subclasses with the queueing stubs are generated by 
+    BaseProxy._make_stubs, and instantiated by BaseProxy.multicall:
+    
+        multicall = proxy.multicall()
+        multicall.defer_create(2, "Node")
+        multicall.defer_create_set(2, "label", "node1")
+        results = multicall.flush()
+    
+    flush() returns the list of results, in order, or raises
+    MulticallError if any of the calls failed.
+    """
+    def __init__(self, proxy):
+        self._proxy = proxy
+        self._codec = proxy._codec
+        self._calls = []
+    
+    def _queue(self, methname, msg, parse):
+        self._calls.append((methname, msg, parse))
+    
+    def __len__(self):
+        return len(self._calls)
+    
+    def flush(self):
+        calls, self._calls = self._calls, []
+        if not calls:
+            return []
+        
+        classname = self._proxy._ServerClass.__name__
+        handler = BaseServer.execute_multicall
+        msg = self._codec.make_message(
+            handler._argtypes,
+            handler._argencoders,
+            MULTICALL,
+            'multicall',
+            classname,
+            [ msg for _,msg,_ in calls ])
+        client = self._proxy._client
+        transition = any(methname in self._proxy._CacheTransitions
+            for methname,_,_ in calls)
+        if transition:
+            self._proxy._begin_transition()
+        try:
+            call = self._proxy._rpc_stats.begin('multicall')
+            tag = client.send_msg(msg)
+            parse = functools.partial(self._codec.parse_reply,
+                handler._retval,
+                'multicall',
+                classname)
+            if call is not None:
+                parse = functools.partial(call.parse, len(msg), parse)
+            replies = parse(client.read_reply(tag))
+        finally:
+            if transition:
+                self._proxy._end_transition()
+        
+        results = []
+        errors = []
+        for index, ((methname, msg, parse), reply) in enumerate(zip(calls, replies)):
+            try:
+                results.append(parse(reply))
+            except (RuntimeError, TypeError), e:
+                results.append(None)
+                errors.append((index, methname, str(e)))
+        if errors:
+            raise nepi.core.execute.MulticallError(errors, results)
+        return results
+
 class BaseProxy(object):
     _ServerClass = None
     _ServerClassModule = "nepi.util.proxy"
     
+    # Modules worth having loaded in zygotes before launching the server
+    _PreloadModules = ("nepi.util.proxy", "nepi.core.execute")
+    
+    # Names of the transition methods, see Marshalling.transition
+    _CacheTransitions = frozenset()
+    
     def __init__(self, ctor_args, root_dir, 
             launch = True, 
             communication = DC.ACCESS_LOCAL,
@@ -1016,7 +1587,18 @@ class BaseProxy(object):
             agent = None,
             sudo = False, 
             environment_setup = "",
-            clean_root = False):
+            clean_root = False,
+            message_codec = None,
+            zygote = False):
+        self._codec = CODECS[message_codec or DC.CODEC_TEXT]
+        self._cache = {}
+        self._cache_stats = {}
+        self._cache_lock = threading.Lock()
+        # bumped on every transition, so that results fetched across
+        # one are never cached, and counting the ones still in progress
+        self._cache_generation = 0
+        self._cache_transitions = 0
+        self._rpc_stats = rpcstats.RpcStats()
         if launch:
             python_code = (
                     "from %(classmodule)s import %(classname)s;"
@@ -1027,7 +1609,8 @@ class BaseProxy(object):
                     classmodule = self._ServerClassModule,
                     ctor_args = ctor_args
                 ) )
-            proc = server.popen_python(python_code,
+            if zygote:
+                self._launch_zygote(python_code, ctor_args,
                         communication = communication,
                         host = host,
                         port = port, 
@@ -1036,17 +1619,16 @@ class BaseProxy(object):
                         ident_key = ident_key, 
                         sudo = sudo,
                         environment_setup = environment_setup) 
-            # Wait for the server to be ready, otherwise nobody
-            # will be able to connect to it
-            err = []
-            helo = "nope"
-            while helo:
-                helo = proc.stderr.readline()
-                if helo == 'SERVER_READY.\n':
-                    break
-                err.append(helo)
             else:
-                raise AssertionError, "Expected 'SERVER_READY.', got: %s" % (''.join(err),)
+                self._launch(python_code,
+                        communication = communication,
+                        host = host,
+                        port = port, 
+                        user = user, 
+                        agent = agent,
+                        ident_key = ident_key, 
+                        sudo = sudo,
+                        environment_setup = environment_setup) 
         # connect client to server
         self._client = server.Client(root_dir, 
                 communication = communication,
@@ -1057,6 +1639,176 @@ class BaseProxy(object):
                 sudo = sudo,
                 environment_setup = environment_setup)
     
+    def _launch(self, python_code, **access):
+        proc = server.popen_python(python_code, **access)
+        # Wait for the server to be ready, otherwise nobody
+        # will be able to connect to it
+        err = []
+        helo = "nope"
+        while helo:
+            helo = proc.stderr.readline()
+            if helo == 'SERVER_READY.\n':
+                break
+            err.append(helo)
+        else:
+            raise AssertionError, "Expected 'SERVER_READY.', got: %s" % (''.join(err),)
+
+    def _launch_zygote(self, python_code, ctor_args, **access):
+        zygote = server.get_zygote(
+            preload = self._zygote_preload_modules(ctor_args), 
+            **access)
+        out = zygote.spawn(python_code, 
+            preload = self._preload_modules(ctor_args))
+        # spawn only returns once the server is ready (or dead)
+        if 'SERVER_READY.' not in out.splitlines():
+            raise AssertionError, "Expected 'SERVER_READY.', got: %s" % (out,)
+
+    @classmethod
+    def _preload_modules(cls, ctor_args):
+        return (cls._ServerClassModule,) + cls._PreloadModules
+    
+    @classmethod
+    def _zygote_preload_modules(cls, ctor_args):
+        # zygotes launch all kinds of servers, so they load 
+        # every configured testbed as soon as they start
+        modules = cls._preload_modules(ctor_args)
+        for mod_name in sorted(nepi.util.environ.testbed_map().values()):
+            modules += (mod_name, mod_name + ".metadata")
+        return modules
+    
+    def multicall(self):
+        """
+        Returns a Multicall envelope for this proxy, 
+        see nepi.util.proxy.Multicall
+        """
+        return self._Multicall(self)
+    
+    def invalidate_cache(self, phase_only = True):
+        """
+        Drops cached results of phase_cached methods, or all of them
+        (immutable ones included) if phase_only is False.
+        """
+        self._cache_lock.acquire()
+        try:
+            self._cache_generation += 1
+            if phase_only:
+                for key, (policy, _) in self._cache.items():
+                    if policy == CACHE_PHASE:
+                        del self._cache[key]
+            else:
+                self._cache.clear()
+        finally:
+            self._cache_lock.release()
+    
+    def cache_stats(self):
+        """
+        Returns a dictionary with the total hits, misses and hit_rate
+        of the client-side cache, and the hits and misses per method
+        in methods.
+        """
+        self._cache_lock.acquire()
+        try:
+            methods = dict([
+                (methname, dict(hits = hits, misses = misses))
+                for methname, (hits, misses) in self._cache_stats.iteritems() ])
+        finally:
+            self._cache_lock.release()
+        hits = sum([ stats["hits"] for stats in methods.itervalues() ])
+        misses = sum([ stats["misses"] for stats in methods.itervalues() ])
+        return dict(
+            hits = hits,
+            misses = misses,
+            hit_rate = float(hits) / (hits + misses) if hits + misses else 0.0,
+            entries = len(self._cache),
+            methods = methods)
+    
+    def client_stats(self, reset = False):
+        """
+        Returns the RPC statistics of this proxy's calls, as seen from
+        the client side (see nepi.util.rpcstats). The server side ones 
+        are available through the stats() command.
+        """
+        rv = self._rpc_stats.snapshot()
+        if reset:
+            self._rpc_stats.reset()
+        return rv
+    
+    def _count_cache(self, methname, hit):
+        hits, misses = self._cache_stats.get(methname, (0, 0))
+        if hit:
+            hits += 1
+        else:
+            misses += 1
+        self._cache_stats[methname] = (hits, misses)
+    
+    def _begin_transition(self):
+        self._cache_lock.acquire()
+        try:
+            self._cache_transitions += 1
+        finally:
+            self._cache_lock.release()
+        self.invalidate_cache()
+    
+    def _end_transition(self):
+        self._cache_lock.acquire()
+        try:
+            self._cache_transitions -= 1
+        finally:
+            self._cache_lock.release()
+        self.invalidate_cache()
+    
+    def _deferred_transition(self, future):
+        future._add_done_callback(lambda future : self._end_transition())
+        return future
+    
+    @staticmethod
+    def _cache_copy(value):
+        if isinstance(value, (list, dict, set)):
+            return copy.deepcopy(value)
+        return value
+    
+    def _cached_call(self, policy, methname, stub, args, deferred = False):
+        key = (methname, args)
+        try:
+            hash(key)
+        except TypeError:
+            # unhashable arguments, can't cache
+            return stub(self, *args)
+        
+        self._cache_lock.acquire()
+        try:
+            try:
+                _, value = self._cache[key]
+                hit = True
+            except KeyError:
+                hit = False
+            self._count_cache(methname, hit)
+            generation = self._cache_generation
+        finally:
+            self._cache_lock.release()
+        if hit:
+            value = self._cache_copy(value)
+            if deferred:
+                value = defer.resolved(value)
+            return value
+        
+        def store(value):
+            self._cache_lock.acquire()
+            try:
+                # phase results fetched during a transition may be stale
+                if policy == CACHE_IMMUTABLE or (
+                        generation == self._cache_generation 
+                        and not self._cache_transitions):
+                    self._cache[key] = (policy, value)
+            finally:
+                self._cache_lock.release()
+            return self._cache_copy(value)
+        
+        if deferred:
+            return stub(self, *args)._then(store)
+        else:
+            return store(stub(self, *args))
+    
     @staticmethod
     def _make_message(argtypes, argencoders, command, methname, classname, *args):
         if len(argtypes) != len(argencoders):
@@ -1096,7 +1848,7 @@ class BaseProxy(object):
                     classname)
         
         try:
-            result = reply.split("|")
+            result = reply.split("|", 1)
             code = int(result[0])
             text = result[1]
         except:
@@ -1135,7 +1887,9 @@ class BaseProxy(object):
     def _make_stubs(server_class, template_class):
         """
         Returns a dictionary method_name -> method
-        with stub methods.
+        with stub methods, and a _Multicall entry with the 
+        Multicall envelope class with queueing stubs for 
+        those methods.
         
         Usage:
         
@@ -1153,8 +1907,18 @@ class BaseProxy(object):
         is the ultimate implementation class behind the server,
         from which argument names and defaults are taken, to
         maintain meaningful interfaces.
+        
+        Each stub comes with a non-blocking variant, named after it with
+        a _deferred suffix, which returns a nepi.util.defer.Future for 
+        its result.
+        
+        Stubs for methods marked with Marshalling.immutable or
+        Marshalling.phase_cached go through the proxy's cache, and
+        stubs for Marshalling.transition methods invalidate it.
         """
         rv = {}
+        multicall_methods = {}
+        transitions = set()
         
         class NONE: pass
         
@@ -1166,19 +1930,29 @@ class BaseProxy(object):
         func_template = func_template_file.read()
         func_template_file.close()
         
-        for methname in vars(template_class).copy():
+        # built-in commands every server handles, which have no 
+        # counterpart in template classes
+        builtins = dict(stats = BaseServer.stats._plain)
+        
+        for methname in set(vars(template_class)) | set(builtins):
             if methname.endswith('_deferred'):
                 # cannot wrap deferreds...
                 continue
             dmethname = methname+'_deferred'
+            mmethname = methname+'_multicall'
             if hasattr(server_class, methname) and not methname.startswith('_'):
-                template_meth = getattr(template_class, methname)
+                if methname in builtins:
+                    template_meth = builtins[methname]
+                else:
+                    template_meth = getattr(template_class, methname)
                 server_meth = getattr(server_class, methname)
                 
                 command = getattr(server_meth, '_handles_command', None)
                 argtypes = getattr(server_meth, '_argtypes', None)
                 argencoders = getattr(server_meth, '_argencoders', None)
                 rvtype = getattr(server_meth, '_retval', None)
+                cache = getattr(server_meth, '_cache', None)
+                transition = getattr(server_meth, '_transition', False)
                 doprop = False
                 
                 if hasattr(template_meth, 'fget'):
@@ -1205,6 +1979,7 @@ class BaseProxy(object):
                     func_text = func_template % dict(
                         self = argnames[0],
                         args = '%s' % (','.join(argnames[1:])),
+                        argtuple = ''.join([ argname + ',' for argname in argnames[1:] ]),
                         argdefs = ','.join([
                             argname if argdef is NONE
                             else "%s=%r" % (argname, argdef)
@@ -1212,7 +1987,8 @@ class BaseProxy(object):
                         ]),
                         command = command,
                         methname = methname,
-                        classname = server_class.__name__
+                        classname = server_class.__name__,
+                        cache = cache,
                     )
                     
                     func_text = compile(
@@ -1222,12 +1998,29 @@ class BaseProxy(object):
                     
                     exec func_text in func_globals, context
                     
+                    stub = context[methname]
+                    dstub = context[dmethname]
+                    func_globals.update(_stub = stub, _dstub = dstub)
+                    if cache is not None:
+                        wrapper = '_cached'
+                    elif transition:
+                        wrapper = '_transition'
+                        transitions.add(methname)
+                    else:
+                        wrapper = None
+                    if wrapper is not None:
+                        stub = context[methname + wrapper]
+                        dstub = context[dmethname + wrapper]
+                        stub.__name__ = methname
+                        dstub.__name__ = dmethname
+                    
                     if doprop:
-                        rv[methname] = property(context[methname])
-                        rv[dmethname] = property(context[dmethname])
+                        rv[methname] = property(stub)
+                        rv[dmethname] = property(dstub)
                     else:
-                        rv[methname] = context[methname]
-                        rv[dmethname] = context[dmethname]
+                        rv[methname] = stub
+                        rv[dmethname] = dstub
+                        multicall_methods[methname] = context[mmethname]
                     
                     # inject _deferred into core classes
                     if hasattr(template_class, methname) and not hasattr(template_class, dmethname):
@@ -1237,10 +2030,84 @@ class BaseProxy(object):
                             dmeth.__name__ = dmethname
                             return dmeth
                         dmeth = freezename(methname, dmethname)
+                        if doprop:
+                            dmeth = property(
+                                operator.attrgetter(methname))
                         setattr(template_class, dmethname, dmeth)
         
+        rv['_Multicall'] = type(
+            server_class.__name__ + 'Multicall',
+            (Multicall,),
+            multicall_methods)
+        rv['_CacheTransitions'] = frozenset(transitions)
+        
         return rv
 
+class MarshallingCodec(object):
+    """
+    Encodes commands as '|'-separated fields, marshalled according
+    to the argument types declared through Marshalling decorators.
+    """
+    make_message = staticmethod(BaseProxy._make_message)
+    parse_reply = staticmethod(BaseProxy._parse_reply)
+
+class BinaryCodec(object):
+    """
+    Encodes commands with the compact typed encoding of nepi.util.codec,
+    avoiding both text marshalling and base64.
+    """
+    @staticmethod
+    def make_message(argtypes, argencoders, command, methname, classname, *args):
+        if len(argtypes) != len(args):
+            raise ValueError, "Invalid arguments for make_message: "\
+                "in stub method %s of class %s "\
+                "expected %d arguments, got %d" % (
+                    methname, classname,
+                    len(argtypes), len(args))
+        
+        buf = []
+        for argnum, (typ, val) in enumerate(zip(argtypes, args)):
+            try:
+                buf.append(Marshalling.normalize(typ, val))
+            except:
+                import traceback
+                raise TypeError, "Argument %d of stub method %s of class %s "\
+                    "requires a value of type %s, but got %s - nested error: %s" % (
+                        argnum, methname, classname,
+                        getattr(typ, '__name__', typ), type(val),
+                        traceback.format_exc()
+                )
+        
+        return codec.encode_message(command, tuple(buf))
+    
+    @staticmethod
+    def parse_reply(rvtype, methname, classname, reply):
+        try:
+            code, value = codec.decode_message(reply)
+        except:
+            import traceback
+            raise RuntimeError, "Invalid reply: %r "\
+                "for stub method %s of class %s - nested error: %s" % (
+                    reply,
+                    methname,
+                    classname,
+                    traceback.format_exc())
+        if code == ERROR:
+            raise RuntimeError(value)
+        elif code == OK:
+            return value
+        else:
+            raise RuntimeError, "Invalid reply: %r "\
+                "for stub method %s of class %s - unknown code" % (
+                    reply,
+                    methname,
+                    classname)
+
+CODECS = {
+    DC.CODEC_TEXT : MarshallingCodec,
+    DC.CODEC_BINARY : BinaryCodec,
+}
+
 class ExperimentSuiteProxy(BaseProxy):
     
     _ServerClass = ExperimentSuiteServer
@@ -1255,7 +2122,10 @@ class ExperimentSuiteProxy(BaseProxy):
             agent = None,
             sudo = False, 
             environment_setup = "", 
-            clean_root = False):
+            clean_root = False,
+            message_codec = None,
+            zygote = False,
+            max_parallel = None):
         super(ExperimentSuiteProxy,self).__init__(
             ctor_args = (root_dir, log_level,
                 xml, 
@@ -1270,7 +2140,10 @@ class ExperimentSuiteProxy(BaseProxy):
                 agent, 
                 sudo, 
                 environment_setup, 
-                clean_root),
+                clean_root,
+                message_codec,
+                zygote,
+                max_parallel),
             root_dir = root_dir,
             launch = True, #launch
             communication = communication,
@@ -1280,7 +2153,9 @@ class ExperimentSuiteProxy(BaseProxy):
             ident_key = ident_key, 
             agent = agent, 
             sudo = sudo, 
-            environment_setup = environment_setup)
+            environment_setup = environment_setup,
+            message_codec = message_codec,
+            zygote = zygote)
 
     locals().update( BaseProxy._make_stubs(
         server_class = ExperimentSuiteServer,
@@ -1310,7 +2185,9 @@ class TestbedControllerProxy(BaseProxy):
             agent = None,
             sudo = False, 
             environment_setup = "", 
-            clean_root = False):
+            clean_root = False,
+            message_codec = None,
+            zygote = False):
         if launch and (testbed_id == None or testbed_version == None):
             raise RuntimeError("To launch a TesbedControllerServer a "
                     "testbed_id and testbed_version are required")
@@ -1326,7 +2203,17 @@ class TestbedControllerProxy(BaseProxy):
             ident_key = ident_key, 
             agent = agent, 
             sudo = sudo, 
-            environment_setup = environment_setup)
+            environment_setup = environment_setup,
+            message_codec = message_codec,
+            zygote = zygote)
+
+    @classmethod
+    def _preload_modules(cls, ctor_args):
+        # also load the testbed (and its metadata) being launched
+        testbed_id = ctor_args[2]
+        mod_name = nepi.util.environ.find_testbed(testbed_id)
+        return super(TestbedControllerProxy, cls)._preload_modules(ctor_args) \
+            + (mod_name, mod_name + ".metadata")
 
     locals().update( BaseProxy._make_stubs(
         server_class = TestbedControllerServer,
@@ -1355,7 +2242,9 @@ class ExperimentControllerProxy(BaseProxy):
             agent = None, 
             sudo = False, 
             environment_setup = "",
-            clean_root = False):
+            clean_root = False,
+            message_codec = None,
+            zygote = False):
         super(ExperimentControllerProxy,self).__init__(
             ctor_args = (root_dir, log_level, experiment_xml, environment_setup, 
                 clean_root),
@@ -1369,7 +2258,9 @@ class ExperimentControllerProxy(BaseProxy):
             agent = agent, 
             sudo = sudo, 
             environment_setup = environment_setup,
-            clean_root = clean_root)
+            clean_root = clean_root,
+            message_codec = message_codec,
+            zygote = zygote)
 
     locals().update( BaseProxy._make_stubs(
         server_class = ExperimentControllerServer,
@@ -1,14 +1,23 @@
 def %(methname)s(%(self)s, %(argdefs)s):
-    msg = BaseProxy._make_message(
+    call = %(self)s._rpc_stats.begin(%(methname)r)
+    msg = %(self)s._codec.make_message(
         argtypes,
         argencoders,
         %(command)d,
         %(methname)r,
         %(classname)r,
         %(args)s)
-    %(self)s._client.send_msg(msg)
-    reply = %(self)s._client.read_reply()
-    rv = BaseProxy._parse_reply(
+    tag = %(self)s._client.send_msg(msg)
+    reply = %(self)s._client.read_reply(tag)
+    if call is not None:
+        return call.parse(len(msg),
+            functools.partial(
+                %(self)s._codec.parse_reply,
+                rvtype,
+                %(methname)r,
+                %(classname)r),
+            reply)
+    rv = %(self)s._codec.parse_reply(
         rvtype,
         %(methname)r,
         %(classname)r,
@@ -16,20 +25,63 @@ def %(methname)s(%(self)s, %(argdefs)s):
     return rv
 
 def %(methname)s_deferred(%(self)s, %(argdefs)s):
-    msg = BaseProxy._make_message(
+    call = %(self)s._rpc_stats.begin(%(methname)r)
+    msg = %(self)s._codec.make_message(
         argtypes,
         argencoders,
         %(command)d,
         %(methname)r,
         %(classname)r,
         %(args)s)
-    %(self)s._client.send_msg(msg)
-    rv = %(self)s._client.defer_reply(
-        transform = functools.partial(
-            BaseProxy._parse_reply,
+    tag = %(self)s._client.send_msg(msg)
+    transform = functools.partial(
+        %(self)s._codec.parse_reply,
+        rvtype,
+        %(methname)r+'_deferred',
+        %(classname)r)
+    if call is not None:
+        transform = functools.partial(call.parse, len(msg), transform)
+    rv = %(self)s._client.defer_reply(tag,
+        transform = transform)
+    return rv
+
+
+def %(methname)s_multicall(%(self)s, %(argdefs)s):
+    msg = %(self)s._codec.make_message(
+        argtypes,
+        argencoders,
+        %(command)d,
+        %(methname)r,
+        %(classname)r,
+        %(args)s)
+    %(self)s._queue(%(methname)r, msg,
+        functools.partial(
+            %(self)s._codec.parse_reply,
             rvtype,
-            %(methname)r+'_deferred',
+            %(methname)r+'_multicall',
             %(classname)r)
         )
-    return rv
 
+def %(methname)s_cached(%(self)s, %(argdefs)s):
+    return %(self)s._cached_call(%(cache)r, %(methname)r,
+        _stub, (%(argtuple)s))
+
+def %(methname)s_deferred_cached(%(self)s, %(argdefs)s):
+    return %(self)s._cached_call(%(cache)r, %(methname)r,
+        _dstub, (%(argtuple)s), deferred = True)
+
+def %(methname)s_transition(%(self)s, %(argdefs)s):
+    %(self)s._begin_transition()
+    try:
+        return _stub(%(self)s, %(args)s)
+    finally:
+        %(self)s._end_transition()
+
+def %(methname)s_deferred_transition(%(self)s, %(argdefs)s):
+    %(self)s._begin_transition()
+    try:
+        rv = _dstub(%(self)s, %(args)s)
+    except:
+        %(self)s._end_transition()
+        raise
+    return %(self)s._deferred_transition(rv)
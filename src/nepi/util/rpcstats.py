@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+"""
+Per-method RPC instrumentation: call counts, error counts, bytes
+sent and received, and latency histograms.
+
+Both servers (BaseServer.reply_action) and proxies (the generated stubs)
+keep an RpcStats instance. Recording is off in the whole process unless
+the NEPI_RPC_STATS environment variable is set or enable() is called,
+and while it's off stubs and servers only pay for a flag check.
+
+Latencies are bucketed in powers of two milliseconds, up to 2^HIST_BUCKETS
+ms, the last bucket catching anything slower.
+"""
+
+import os
+import threading
+import time
+
+ENABLED = os.environ.get("NEPI_RPC_STATS", "false").lower() in ("true", "1", "on")
+
+HIST_BUCKETS = 16
+
+# Upper bounds (in ms) of each latency bucket
+HIST_BOUNDS = tuple([ 1 << i for i in xrange(HIST_BUCKETS) ]) + (None,)
+
+def enable(enabled = True):
+    global ENABLED
+    ENABLED = bool(enabled)
+
+def _bucket(elapsed):
+    ms = elapsed * 1000.0
+    for i, bound in enumerate(HIST_BOUNDS[:-1]):
+        if ms < bound:
+            return i
+    return HIST_BUCKETS
+
+class MethodStats(object):
+    __slots__ = ('calls', 'errors', 'bytes_in', 'bytes_out',
+        'total_time', 'max_time', 'histogram')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = [0] * (HIST_BUCKETS + 1)
+
+    def as_dict(self):
+        return dict(
+            calls = self.calls,
+            errors = self.errors,
+            bytes_in = self.bytes_in,
+            bytes_out = self.bytes_out,
+            total_time = self.total_time,
+            max_time = self.max_time,
+            avg_time = self.total_time / self.calls if self.calls else 0.0,
+            histogram = dict([
+                ("<%dms" % bound if bound is not None else "inf", count)
+                for bound, count in zip(HIST_BOUNDS, self.histogram)
+                if count ]),
+        )
+
+class RpcCall(object):
+    """
+    A call in progress, as returned by RpcStats.begin.
+    Sizes are taken from the calling side's point of view: bytes_out
+    are those of the request, bytes_in those of the reply.
+    """
+    __slots__ = ('stats', 'methname', 'start')
+
+    def __init__(self, stats, methname):
+        self.stats = stats
+        self.methname = methname
+        self.start = time.time()
+
+    def finish(self, bytes_out, bytes_in, error = False):
+        self.stats.record(self.methname, time.time() - self.start,
+            bytes_out, bytes_in, error)
+
+    def parse(self, bytes_out, parse, reply):
+        """
+        Finishes the call by parsing its reply with the given callable,
+        counting it as an error if parsing raises.
+        """
+        try:
+            rv = parse(reply)
+        except:
+            self.finish(bytes_out, len(reply or ""), True)
+            raise
+        self.finish(bytes_out, len(reply))
+        return rv
+
+class RpcStats(object):
+    def __init__(self):
+        self._methods = {}
+        self._lock = threading.Lock()
+        self._since = time.time()
+
+    def begin(self, methname):
+        """
+        Returns an RpcCall to be finished when the call completes,
+        or None if recording is disabled.
+        """
+        if not ENABLED:
+            return None
+        return RpcCall(self, methname)
+
+    def record(self, methname, elapsed, bytes_out, bytes_in, error = False):
+        self._lock.acquire()
+        try:
+            stats = self._methods.get(methname)
+            if stats is None:
+                stats = self._methods[methname] = MethodStats()
+            stats.calls += 1
+            if error:
+                stats.errors += 1
+            stats.bytes_out += bytes_out
+            stats.bytes_in += bytes_in
+            stats.total_time += elapsed
+            stats.max_time = max(stats.max_time, elapsed)
+            stats.histogram[_bucket(elapsed)] += 1
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._methods.clear()
+            self._since = time.time()
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """
+        Returns a plain dictionary (ready to be pickled or dumped as JSON)
+        with the per-method statistics under "methods".
+        """
+        self._lock.acquire()
+        try:
+            methods = dict([
+                (methname, stats.as_dict())
+                for methname, stats in self._methods.iteritems() ])
+        finally:
+            self._lock.release()
+        return dict(
+            enabled = ENABLED,
+            since = self._since,
+            elapsed = time.time() - self._since,
+            pid = os.getpid(),
+            methods = methods)
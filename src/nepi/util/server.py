@@ -2,8 +2,12 @@
 
 from nepi.util.constants import DeploymentConfiguration as DC
 
+import atexit
 import base64
+import contextlib
+import cStringIO
 import errno
+import fcntl
 import os
 import os.path
 import resource
@@ -11,6 +15,7 @@ import select
 import shutil
 import signal
 import socket
+import struct
 import sys
 import subprocess
 import threading
@@ -18,10 +23,15 @@ import time
 import traceback
 import re
 import tempfile
+import tarfile
 import defer
+import codec
+import parallel
 import functools
 import collections
 import hashlib
+import itertools
+import weakref
 
 CTRL_SOCK = "ctrl.sock"
 CTRL_PID = "ctrl.pid"
@@ -30,8 +40,38 @@ MAX_FD = 1024
 
 STOP_MSG = "STOP"
 
+# Process output beyond this many bytes gets spilled to a temporary file
+SPILL_THRESHOLD = 1 << 20
+
+# Wire protocol versions.
+#   PROTO_LINE: each message is base64-encoded and newline-terminated
+#   PROTO_FRAMED: each message is a 4-byte big-endian length header 
+#       followed by the raw message bytes
+#   PROTO_TAGGED: like PROTO_FRAMED, with a 4-byte request tag after 
+#       the length. Replies carry the tag of their request and may 
+#       arrive in any order.
+# Connections always start in PROTO_LINE and upgrade through a HELLO
+# exchange, so that peers not knowing about it keep working.
+PROTO_LINE = 1
+PROTO_FRAMED = 2
+PROTO_TAGGED = 3
+PROTOCOL_VERSION = PROTO_TAGGED
+
+FRAME_HEADER = struct.Struct("!I")
+TAGGED_FRAME_HEADER = struct.Struct("!II")
+
+# HELLO messages look like regular (invalid) instructions to older servers, 
+# which will answer with an error and leave the connection in PROTO_LINE.
+# Servers and forwarders use different keys so that an old forwarder 
+# relaying a client's HELLO never upgrades the server side of the link.
+SERVER_HELLO = "NEPI_SERVER_PROTO"
+FORWARDER_HELLO = "NEPI_FORWARDER_PROTO"
+
 TRACE = os.environ.get("NEPI_TRACE", "false").lower() in ("true", "1", "on")
 
+# Multiplex ssh sessions through pooled master connections (see SshSessionPool)
+SSH_POOL = os.environ.get("NEPI_SSH_POOL", "true").lower() in ("true", "1", "on")
+
 OPENSSH_HAS_PERSIST = None
 
 if hasattr(os, "devnull"):
@@ -64,6 +104,20 @@ def openssh_has_persist():
         OPENSSH_HAS_PERSIST = bool(vre.match(out))
     return OPENSSH_HAS_PERSIST
 
+def open_fds():
+    """
+    Returns the file descriptors that may be open in this process.
+    Listing them avoids trying to close every possible descriptor, 
+    which can take over a second when the fd limit is high.
+    """
+    try:
+        return map(int, os.listdir("/proc/self/fd"))
+    except (OSError, ValueError):
+        max_fd = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
+        if (max_fd == resource.RLIM_INFINITY):
+            max_fd = MAX_FD
+        return range(max_fd)
+
 def shell_escape(s):
     """ Escapes strings so that they are safe to use as command-line arguments """
     if SHELL_SAFE.match(s):
@@ -101,6 +155,48 @@ def eintr_retry(func):
             return func(*p, **kw)
     return rv
 
+def make_hello(key, version):
+    return "0|%s|%d" % (key, version)
+
+def parse_hello(key, msg):
+    """ Returns the protocol version proposed in a HELLO message, 
+    or None if msg is not a HELLO message for the given key """
+    params = msg.split("|")
+    if len(params) != 3 or params[0] != "0" or params[1] != key:
+        return None
+    try:
+        return int(params[2])
+    except ValueError:
+        return None
+
+def encode_line(msg):
+    return "%s\n" % (base64.b64encode(msg),)
+
+def frame_header(size, tag = None):
+    if tag is None:
+        return FRAME_HEADER.pack(size)
+    else:
+        return TAGGED_FRAME_HEADER.pack(size, tag)
+
+def read_frame(read, tagged = False):
+    """ Reads a length-prefixed frame using the given read(size) function,
+    which must return exactly size bytes unless EOF is reached.
+    Returns a (tag, data) tuple, tag being None for untagged frames, 
+    or (None, None) on EOF. """
+    header_struct = TAGGED_FRAME_HEADER if tagged else FRAME_HEADER
+    header = read(header_struct.size)
+    if len(header) < header_struct.size:
+        return None, None
+    if tagged:
+        (size, tag) = header_struct.unpack(header)
+    else:
+        (size,) = header_struct.unpack(header)
+        tag = None
+    data = read(size)
+    if len(data) < size:
+        return None, None
+    return tag, data
+
 class Server(object):
     def __init__(self, root_dir = ".", log_level = DC.ERROR_LEVEL, 
             environment_setup = "", clean_root = False):
@@ -110,6 +206,8 @@ class Server(object):
         self._ctrl_sock = None
         self._log_level = log_level
         self._rdbuf = ""
+        self._proto = PROTO_LINE
+        self._send_lock = threading.Lock()
         self._environment_setup = environment_setup
 
     def run(self):
@@ -178,11 +276,8 @@ class Server(object):
             os._exit(0)
 
         # close all open file descriptors.
-        max_fd = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
-        if (max_fd == resource.RLIM_INFINITY):
-            max_fd = MAX_FD
-        for fd in range(3, max_fd):
-            if fd != w:
+        for fd in open_fds():
+            if fd >= 3 and fd != w:
                 try:
                     os.close(fd)
                 except OSError:
@@ -280,9 +375,16 @@ class Server(object):
             conn, addr = self._ctrl_sock.accept()
             self.log_error("ACCEPTED CONNECTION: %s" % (addr,))
             conn.settimeout(5)
+            # every connection starts with the line protocol
+            self._proto = PROTO_LINE
+            self._rdbuf = ""
+            proto = None
             while not self._stop:
                 try:
-                    msg = self.recv_msg(conn)
+                    if self._proto == PROTO_TAGGED:
+                        tag, msg = self.recv_tagged_msg(conn)
+                    else:
+                        tag, msg = None, self.recv_msg(conn)
                 except socket.timeout, e:
                     #self.log_error("SERVER recv_msg: connection timedout ")
                     continue
@@ -290,10 +392,28 @@ class Server(object):
                 if not msg:
                     self.log_error("CONNECTION LOST")
                     break
+                
+                if tag is not None:
+                    # replies may be sent in any order, by any thread
+                    reply_to = functools.partial(self._send_tagged_reply, 
+                        conn, tag)
+                    if msg == STOP_MSG:
+                        self._stop = True
+                        # let requests in progress finish first
+                        self.sync()
+                        reply_to(self.stop_action())
+                    else:
+                        self.dispatch(msg, reply_to)
+                    continue
                     
                 if msg == STOP_MSG:
                     self._stop = True
+                    self.sync()
                     reply = self.stop_action()
+                elif self._proto == PROTO_LINE and \
+                        parse_hello(SERVER_HELLO, msg) is not None:
+                    proto = min(parse_hello(SERVER_HELLO, msg), PROTOCOL_VERSION)
+                    reply = make_hello(SERVER_HELLO, proto)
                 else:
                     reply = self.reply_action(msg)
                 
@@ -303,6 +423,11 @@ class Server(object):
                     self.log_error()
                     self.log_error("NOTICE: Awaiting for reconnection")
                     break
+
+                if proto is not None:
+                    # HELLO acknowledged, switch protocols
+                    self._proto = proto
+                    proto = None
             try:
                 conn.close()
             except:
@@ -310,6 +435,9 @@ class Server(object):
                 self.log_error()
 
     def recv_msg(self, conn):
+        if self._proto == PROTO_FRAMED:
+            return self._recv_frame(conn)[1]
+        
         data = [self._rdbuf]
         chunk = data[0]
         while '\n' not in chunk:
@@ -331,12 +459,88 @@ class Server(object):
         data, self._rdbuf = data
         
         decoded = base64.b64decode(data)
+        if codec.is_message(decoded):
+            # binary messages may legitimately end in whitespace
+            return decoded
         return decoded.rstrip()
 
+    def recv_tagged_msg(self, conn):
+        """ Returns a (tag, msg) tuple """
+        return self._recv_frame(conn, tagged = True)
+
+    def _recv_frame(self, conn, tagged = False):
+        header_struct = TAGGED_FRAME_HEADER if tagged else FRAME_HEADER
+        header = self._recv_bytes(conn, header_struct.size)
+        if len(header) < header_struct.size:
+            # EOF
+            return None, ""
+        if tagged:
+            (size, tag) = header_struct.unpack(header)
+        else:
+            (size,) = header_struct.unpack(header)
+            tag = None
+        try:
+            return tag, self._recv_bytes(conn, size)
+        except socket.timeout:
+            # put the header back, the frame will be read again
+            self._rdbuf = header + self._rdbuf
+            raise
+
+    def _recv_bytes(self, conn, size):
+        buf = bytearray(size)
+        view = memoryview(buf)
+        got = min(len(self._rdbuf), size)
+        view[:got] = self._rdbuf[:got]
+        self._rdbuf = self._rdbuf[got:]
+        while got < size:
+            try:
+                nbytes = conn.recv_into(view[got:], size - got)
+            except socket.timeout:
+                # keep partial data for the next attempt
+                self._rdbuf = str(buf[:got]) + self._rdbuf
+                raise
+            except (OSError, socket.error), e:
+                if e[0] != errno.EINTR:
+                    raise
+                else:
+                    continue
+            if not nbytes:
+                # EOF
+                return str(buf[:got])
+            got += nbytes
+        return str(buf)
+
     def send_reply(self, conn, reply):
-        encoded = base64.b64encode(reply)
-        conn.send("%s\n" % encoded)
+        if self._proto == PROTO_FRAMED:
+            conn.sendall(frame_header(len(reply)))
+            conn.sendall(reply)
+        else:
+            conn.sendall(encode_line(reply))
+
+    def send_tagged_reply(self, conn, tag, reply):
+        with self._send_lock:
+            conn.sendall(frame_header(len(reply), tag))
+            conn.sendall(reply)
+
+    def _send_tagged_reply(self, conn, tag, reply):
+        try:
+            self.send_tagged_reply(conn, tag, reply)
+        except socket.error:
+            # The connection loop will notice it too
+            self.log_error()
        
+    def dispatch(self, msg, reply_to):
+        """ 
+        Processes a request and passes the reply to reply_to, which
+        can be called from any thread. Requests can be processed 
+        concurrently, this implementation does it synchronously.
+        """
+        reply_to(self.reply_action(msg))
+
+    def sync(self):
+        """ Waits for all dispatched requests to be replied """
+        pass
+
     def cleanup(self):
         try:
             self._ctrl_sock.close()
@@ -370,48 +574,103 @@ class Forwarder(object):
         self._root_dir = root_dir
         self._stop = False
         self._rdbuf = ""
+        # protocol spoken with the client (stdin/stdout) and with the server
+        self._client_proto = PROTO_LINE
+        self._server_proto = PROTO_LINE
+        self._pump = None
+        self._wrlock = threading.Lock()
 
     def forward(self):
         self.connect()
         print >>sys.stderr, "FORWARDER_READY."
         while not self._stop:
-            data = self.read_data()
-            if not data:
+            tag, data = self.read_data()
+            if data is None:
                 # Connection to client lost
                 break
-            self.send_to_server(data)
             
-            data = self.recv_from_server()
-            if not data:
+            version = None
+            if self._client_proto == PROTO_LINE:
+                version = parse_hello(FORWARDER_HELLO, data)
+            if version is not None:
+                # client wants to upgrade, server protocol is
+                # handled independently by connect()
+                version = min(version, PROTOCOL_VERSION)
+                self.write_data(make_hello(FORWARDER_HELLO, version))
+                self._client_proto = version
+                continue
+            
+            self.send_to_server(data, tag)
+            
+            if self._pump is not None:
+                # replies are relayed by the pump thread
+                continue
+            
+            rtag, data = self.recv_from_server()
+            if data is None:
                 # Connection to server lost
                 raise IOError, "Connection to server lost while "\
                     "expecting response"
-            self.write_data(data)
+            self.write_data(data, tag)
+        
+        if self._pump is not None and self._stop:
+            # wait for the reply to STOP
+            self._pump.join()
         self.disconnect()
 
     def read_data(self):
-        return sys.stdin.readline()
-
-    def write_data(self, data):
-        sys.stdout.write(data)
-        # sys.stdout.write is buffered, this is why we need to do a flush()
-        sys.stdout.flush()
+        """ Returns a (tag, data) tuple, or (None, None) on EOF """
+        if self._client_proto >= PROTO_FRAMED:
+            return read_frame(sys.stdin.read, 
+                tagged = self._client_proto == PROTO_TAGGED)
+        data = sys.stdin.readline()
+        if not data:
+            return None, None
+        return None, base64.b64decode(data.rstrip())
+
+    def write_data(self, data, tag = None):
+        with self._wrlock:
+            if self._client_proto >= PROTO_FRAMED:
+                if self._client_proto != PROTO_TAGGED:
+                    tag = None
+                sys.stdout.write(frame_header(len(data), tag))
+                sys.stdout.write(data)
+            else:
+                sys.stdout.write(encode_line(data))
+            # sys.stdout.write is buffered, this is why we need to do a flush()
+            sys.stdout.flush()
 
-    def send_to_server(self, data):
+    def send_to_server(self, data, tag = None):
         try:
-            self._ctrl_sock.send(data)
+            self._send(data, tag)
         except (IOError, socket.error), e:
             if e[0] == errno.EPIPE:
                 self.connect()
-                self._ctrl_sock.send(data)
+                self._send(data, tag)
             else:
                 raise e
-        encoded = data.rstrip() 
-        msg = base64.b64decode(encoded)
-        if msg == STOP_MSG:
+        if data == STOP_MSG:
             self._stop = True
 
+    def _send(self, data, tag = None):
+        if self._server_proto is None:
+            self._negotiate()
+        if self._server_proto >= PROTO_FRAMED:
+            if self._server_proto == PROTO_TAGGED:
+                tag = tag or 0
+            else:
+                tag = None
+            self._ctrl_sock.sendall(frame_header(len(data), tag))
+            self._ctrl_sock.sendall(data)
+        else:
+            self._ctrl_sock.sendall(encode_line(data))
+
     def recv_from_server(self):
+        """ Returns a (tag, data) tuple, or (None, None) on EOF """
+        if self._server_proto >= PROTO_FRAMED:
+            return read_frame(self._recv_bytes, 
+                tagged = self._server_proto == PROTO_TAGGED)
+        
         data = [self._rdbuf]
         chunk = data[0]
         while '\n' not in chunk:
@@ -431,13 +690,70 @@ class Forwarder(object):
             data.append('')
         data, self._rdbuf = data
         
-        return data+'\n'
+        if not data:
+            return None, None
+        return None, base64.b64decode(data)
+
+    def _recv_bytes(self, size):
+        buf = bytearray(size)
+        view = memoryview(buf)
+        got = min(len(self._rdbuf), size)
+        view[:got] = self._rdbuf[:got]
+        self._rdbuf = self._rdbuf[got:]
+        while got < size:
+            try:
+                nbytes = self._ctrl_sock.recv_into(view[got:], size - got)
+            except (OSError, socket.error), e:
+                if e[0] != errno.EINTR:
+                    raise
+                continue
+            if not nbytes:
+                # EOF
+                return str(buf[:got])
+            got += nbytes
+        return str(buf)
+
+    def _pump_replies(self):
+        # Relays replies from a tagged server to a tagged client,
+        # in whatever order they arrive
+        while True:
+            try:
+                tag, data = self.recv_from_server()
+            except (OSError, socket.error):
+                # Connection closed, probably by a reconnection
+                break
+            if data is None:
+                break
+            self.write_data(data, tag)
  
     def connect(self):
         self.disconnect()
         self._ctrl_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         sock_addr = os.path.join(self._root_dir, CTRL_SOCK)
         self._ctrl_sock.connect(sock_addr)
+        self._rdbuf = ""
+        self._pump = None
+        # negotiated upon the first message, the server might
+        # still be busy with another connection
+        self._server_proto = None
+
+    def _negotiate(self):
+        self._server_proto = PROTO_LINE
+        self._send(make_hello(SERVER_HELLO, PROTOCOL_VERSION))
+        tag, reply = self.recv_from_server()
+        if reply is None:
+            raise IOError, "Connection to server lost during negotiation"
+        version = parse_hello(SERVER_HELLO, reply)
+        if version is not None:
+            self._server_proto = version
+        
+        if self._server_proto == PROTO_TAGGED and \
+                self._client_proto == PROTO_TAGGED:
+            # Both ends can handle out-of-order replies, 
+            # so relay them as soon as they come.
+            self._pump = threading.Thread(target = self._pump_replies)
+            self._pump.setDaemon(True)
+            self._pump.start()
 
     def disconnect(self):
         try:
@@ -448,7 +764,7 @@ class Forwarder(object):
 class Client(object):
     def __init__(self, root_dir = ".", host = None, port = None, user = None, 
             agent = None, sudo = False, communication = DC.ACCESS_LOCAL,
-            environment_setup = ""):
+            environment_setup = "", protocol = PROTOCOL_VERSION, direct = True):
         self.root_dir = root_dir
         self.addr = (host, port)
         self.user = user
@@ -456,16 +772,70 @@ class Client(object):
         self.sudo = sudo
         self.communication = communication
         self.environment_setup = environment_setup
+        self.protocol = protocol
+        # Local daemons are reached straight through their control 
+        # socket, sparing a forwarder process, unless told otherwise.
+        # Sudo'd daemons' sockets may not be accessible though.
+        self.direct = direct and not sudo and communication != DC.ACCESS_SSH
+        self._process = None
+        self._sock = None
+        self._rfile = None
+        self._wfile = None
+        self._proto = PROTO_LINE
         self._stopped = False
-        self._deferreds = collections.deque()
+        # request tags awaiting a reply, in the order they were sent
+        self._pending = collections.OrderedDict()
+        # replies received but not yet read, by tag, oldest first
+        self._replies = collections.OrderedDict()
+        # weak references to the futures replies are deferred to, by 
+        # tag, and tags whose future was dropped before its reply came
+        self._futures = dict()
+        self._abandoned = set()
+        self._tags = itertools.count(1)
+        self._last_tag = None
+        self._rdlock = threading.Lock()
+        self._wrlock = threading.Lock()
         self.connect()
     
     def __del__(self):
-        if self._process.poll() is None:
-            os.kill(self._process.pid, signal.SIGTERM)
-        self._process.wait()
+        self.close()
+    
+    def close(self):
+        if self._process is not None:
+            if self._process.poll() is None:
+                os.kill(self._process.pid, signal.SIGTERM)
+            self._process.wait()
+            self._process = None
+        if self._sock is not None:
+            for f in (self._rfile, self._wfile, self._sock):
+                try:
+                    f.close()
+                except (IOError, socket.error):
+                    pass
+            self._sock = None
+        self._rfile = self._wfile = None
         
     def connect(self):
+        self.close()
+        if self.direct:
+            self._connect_socket()
+        else:
+            self._connect_forwarder()
+        
+        # replies to requests sent through a previous connection are lost
+        self._pending.clear()
+        self._proto = PROTO_LINE
+        if self.protocol > PROTO_LINE:
+            self._negotiate()
+
+    def _connect_socket(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(os.path.join(self.root_dir, CTRL_SOCK))
+        self._sock = sock
+        self._rfile = sock.makefile("rb")
+        self._wfile = sock.makefile("wb", 0)
+
+    def _connect_forwarder(self):
         root_dir = self.root_dir
         (host, port) = self.addr
         user = self.user
@@ -497,75 +867,172 @@ class Client(object):
         else:
             raise AssertionError, "Expected 'FORWARDER_READY.', got: %s" % (''.join(err),)
         
-    def send_msg(self, msg):
-        encoded = base64.b64encode(msg)
-        data = "%s\n" % encoded
+        self._rfile = self._process.stdout
+        self._wfile = self._process.stdin
+
+    def _negotiate(self):
+        # Older forwarders relay the HELLO to the server, which
+        # answers with an error, as do older servers, so anything 
+        # but an acknowledge means we stay with the line protocol.
+        if self.direct:
+            key = SERVER_HELLO
+        else:
+            key = FORWARDER_HELLO
+        self._write_msg(make_hello(key, self.protocol), 0)
+        tag, reply = self._read_reply()
+        version = parse_hello(key, reply)
+        if version is not None:
+            self._proto = version
+
+    def _write_msg(self, msg, tag):
+        if self._proto >= PROTO_FRAMED:
+            if self._proto != PROTO_TAGGED:
+                tag = None
+            self._wfile.write(frame_header(len(msg), tag))
+            self._wfile.write(msg)
+        else:
+            self._wfile.write(encode_line(msg))
         
-        try:
-            self._process.stdin.write(data)
-        except (IOError, ValueError):
-            # dead process, poll it to un-zombify
-            self._process.poll()
-            
-            # try again after reconnect
-            # If it fails again, though, give up
-            self.connect()
-            self._process.stdin.write(data)
+    def send_msg(self, msg):
+        """ Sends a request, returns the tag with which to read its reply """
+        with self._wrlock:
+            tag = self._tags.next()
+            try:
+                self._write_msg(msg, tag)
+            except (IOError, ValueError):
+                # dead process or connection,
+                # try again after reconnect
+                # If it fails again, though, give up
+                with self._rdlock:
+                    self.connect()
+                self._write_msg(msg, tag)
+            self._pending[tag] = None
+            self._last_tag = tag
+        return tag
 
     def send_stop(self):
         self.send_msg(STOP_MSG)
         self._stopped = True
 
-    def defer_reply(self, transform=None):
-        defer_entry = []
-        self._deferreds.append(defer_entry)
-        return defer.Defer(
-            functools.partial(self.read_reply, defer_entry, transform)
-        )
+    def defer_reply(self, which=None, transform=None):
+        """
+        Returns a nepi.util.defer.Future for the reply to the request 
+        with the given tag, or to the last request sent if none is given.
+        
+        If the future is dropped unresolved, its reply is discarded 
+        (whenever it comes), since nobody can read it anymore.
+        """
+        if which is None:
+            which = self._last_tag
+        future = defer.Future(
+            functools.partial(self.read_reply, which, transform),
+            poll = functools.partial(self.reply_ready, which),
+            fileno = self.fileno)
+        # the callback mustn't keep the client alive, it has a __del__
+        self._futures[which] = weakref.ref(future, 
+            functools.partial(Client._abandon, weakref.ref(self), which))
+        return future
+    
+    @staticmethod
+    def _abandon(selfref, which, futureref):
+        # may run in any thread, whenever the future is collected, 
+        # the reply is discarded by the next one to receive a reply
+        self = selfref()
+        if self is None or self._futures.get(which) is not futureref:
+            return
+        self._futures.pop(which, None)
+        self._abandoned.add(which)
+    
+    def fileno(self):
+        """
+        Returns the descriptor replies are read from, to wait for them
+        with select, or None if replies can't be polled.
+        """
+        if self._proto >= PROTO_FRAMED and self._rfile is not None:
+            # frames are read exactly, so nothing is ever left
+            # in the file's buffer - unlike with readline
+            return self._rfile.fileno()
+        else:
+            return None
+    
+    def reply_ready(self, which):
+        """
+        Returns True if the reply to the request with the given tag can
+        be read without blocking, reading any replies already available.
+        """
+        if which in self._replies:
+            return True
+        fd = self.fileno()
+        if fd is None or not self._rdlock.acquire(False):
+            # someone's reading, they'll tell
+            return False
+        try:
+            while which not in self._replies and which in self._pending:
+                if not select.select([fd], [], [], 0)[0]:
+                    break
+                self._receive_reply()
+            # lost replies are ready too, as errors
+            return which in self._replies or which not in self._pending
+        finally:
+            self._rdlock.release()
         
     def _read_reply(self):
-        data = self._process.stdout.readline()
-        encoded = data.rstrip() 
-        if not encoded:
+        """ Returns a (tag, data) tuple, tag being None for untagged protocols """
+        if self._proto >= PROTO_FRAMED:
+            tag, data = read_frame(self._rfile.read,
+                tagged = self._proto == PROTO_TAGGED)
+        else:
+            tag = None
+            data = self._rfile.readline().rstrip()
+            data = base64.b64decode(data) if data else None
+        if data is None:
+            if self._process is None:
+                raise RuntimeError, "Connection to server lost while awaiting reply"
+            
             # empty == eof == dead process, poll it to un-zombify
             self._process.poll()
             
             raise RuntimeError, "Forwarder died while awaiting reply: %s" % (self._process.stderr.read(),)
-        return base64.b64decode(encoded)
+        return tag, data
+    
+    def _receive_reply(self):
+        # must hold _rdlock
+        tag, data = self._read_reply()
+        if tag is None:
+            # untagged protocols reply in order
+            tag, _ = self._pending.popitem(last = False)
+        else:
+            self._pending.pop(tag, None)
+        self._replies[tag] = data
+        for tag in list(self._abandoned):
+            if tag in self._replies:
+                del self._replies[tag]
+                self._abandoned.discard(tag)
+            elif tag not in self._pending:
+                self._abandoned.discard(tag)
     
     def read_reply(self, which=None, transform=None):
-        # Test to see if someone did it already
-        if which is not None and len(which):
-            # Ok, they did it...
-            # ...just return the deferred value
-            if transform:
-                return transform(which[0])
-            else:
-                return which[0]
+        """
+        Returns the reply to the request with the given tag, or to 
+        the last request sent if none is given. Replies to other requests
+        received in the meantime are kept until someone reads them, 
+        unless their deferred reply was dropped (see defer_reply).
+        """
+        if which is None:
+            which = self._last_tag
         
-        # Process all deferreds until the one we're looking for
-        # or until the queue is empty
-        while self._deferreds:
-            try:
-                deferred = self._deferreds.popleft()
-            except IndexError:
-                # emptied
-                break
-            
-            deferred.append(self._read_reply())
-            if deferred is which:
-                # We reached the one we were looking for
-                if transform:
-                    return transform(deferred[0])
-                else:
-                    return deferred[0]
+        with self._rdlock:
+            while which not in self._replies:
+                if which not in self._pending:
+                    raise RuntimeError, "Reply to request %r was lost" % (which,)
+                self._receive_reply()
+            reply = self._replies.pop(which)
+            self._futures.pop(which, None)
         
-        if which is None:
-            # They've requested a synchronous read
-            if transform:
-                return transform(self._read_reply())
-            else:
-                return self._read_reply()
+        if transform:
+            return transform(reply)
+        else:
+            return reply
 
 def _make_server_key_args(server_key, host, port, args):
     """ 
@@ -598,6 +1065,295 @@ def _make_server_key_args(server_key, host, port, args):
     
     return tmp_known_hosts
 
+class _SshMaster(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.proc = None
+        self.sessions = 0
+        self.last_used = time.time()
+    
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None \
+            and os.path.exists(self.path)
+
+    def close(self):
+        if self.proc is not None:
+            try:
+                self.proc.terminate()
+            except OSError:
+                pass
+            eintr_retry(self.proc.wait)()
+            self.proc = None
+        if os.path.exists(self.path):
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+class SshSessionPool(object):
+    """
+    Keeps one multiplexed ssh master connection per (user, host, port, 
+    key), so that ssh and scp invocations open a session on an already
+    authenticated connection instead of connecting anew.
+    
+    Masters are started on demand (or in advance, with prewarm), and 
+    closed after being idle for idle_timeout seconds. At most 
+    max_sessions sessions run concurrently on each host, which keeps
+    them under the server's MaxSessions limit (10 by default in OpenSSH).
+    
+    If a master can't be started, sessions connect directly.
+    """
+    def __init__(self, max_sessions = 8, idle_timeout = 60):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._masters = dict()
+        self._host_slots = dict()
+        self._dir = None
+        self._reaper = None
+        self._counters = dict(
+            hits = 0,
+            misses = 0,
+            failures = 0,
+            waits = 0,
+            setup_count = 0,
+            setup_time = 0.0,
+            setup_max = 0.0,
+        )
+    
+    def stats(self):
+        """
+        Returns a dictionary of counters: 
+            hits: sessions run through an already established master
+            misses: sessions that needed a master to be started
+            failures: masters that failed to start
+            waits: sessions delayed by the per-host limit
+            setup_count, setup_time, setup_max: count, total and maximum
+                time spent establishing masters, in seconds
+            masters: currently established masters
+            sessions: currently running sessions
+        """
+        with self._lock:
+            rv = dict(self._counters)
+            masters = self._masters.values()
+        rv['masters'] = len(filter(_SshMaster.alive, masters))
+        rv['sessions'] = sum([ master.sessions for master in masters ])
+        return rv
+
+    def _count(self, counter, value = 1):
+        with self._lock:
+            self._counters[counter] += value
+
+    def _get_master(self, key):
+        with self._lock:
+            if self._dir is None:
+                self._dir = tempfile.mkdtemp(prefix = "nepi_ssh-")
+            master = self._masters.get(key)
+            if master is None:
+                # keep it short, unix socket paths are limited to ~100 chars
+                path = os.path.join(self._dir, 
+                    hashlib.md5(repr(key)).hexdigest()[:16])
+                master = self._masters[key] = _SshMaster(path)
+            if self._reaper is None:
+                self._reaper = threading.Thread(target = self._reap_loop)
+                self._reaper.setDaemon(True)
+                self._reaper.start()
+        return master
+
+    def _start_master(self, master, host, port, user, agent, 
+            ident_key, server_key, connect_timeout):
+        args = ['ssh', '-C', '-N', '-M',
+                '-o', 'ControlPath=%s' % (master.path,),
+                # Don't bother with localhost. Makes test easier
+                '-o', 'NoHostAuthenticationForLocalhost=yes',
+                '-o', 'ConnectTimeout=%d' % (int(connect_timeout),),
+                '-o', 'ConnectionAttempts=3',
+                '-o', 'ServerAliveInterval=30',
+                '-o', 'TCPKeepAlive=yes',
+                '-o', 'BatchMode=yes',
+                '-l', user, host]
+        if agent:
+            args.append('-A')
+        if port:
+            args.append('-p%d' % port)
+        if ident_key:
+            args.extend(('-i', ident_key))
+        tmp_known_hosts = None
+        if server_key:
+            tmp_known_hosts = _make_server_key_args(
+                server_key, host, port, args)
+        
+        start = time.time()
+        proc = subprocess.Popen(args,
+                stdin = open(DEV_NULL, "r"),
+                stdout = open(DEV_NULL, "w"),
+                stderr = open(DEV_NULL, "w"))
+        proc._known_hosts = tmp_known_hosts
+        
+        # the control socket shows up once the master is authenticated
+        deadline = start + connect_timeout * 3
+        while proc.poll() is None and not os.path.exists(master.path) \
+                and time.time() < deadline:
+            time.sleep(0.01)
+        master.proc = proc
+        
+        if not master.alive():
+            master.close()
+            self._count('failures')
+            return False
+        
+        elapsed = time.time() - start
+        with self._lock:
+            self._counters['setup_count'] += 1
+            self._counters['setup_time'] += elapsed
+            self._counters['setup_max'] = max(
+                self._counters['setup_max'], elapsed)
+        return True
+
+    def control_path(self, host, port, user, agent = None, 
+            ident_key = None, server_key = None, connect_timeout = 60,
+            start = True):
+        """
+        Returns the ControlPath of an established master for the given
+        host and credentials, starting one if needed and start is True, 
+        or None if there is none.
+        """
+        master = self._checkout(host, port, user, agent, ident_key, 
+            server_key, connect_timeout, start, False)
+        if master is not None:
+            return master.path
+        return None
+
+    def _checkout(self, host, port, user, agent, ident_key, server_key,
+            connect_timeout, start, session):
+        master = self._get_master((user, host, port, ident_key, bool(agent)))
+        with master.lock:
+            master.last_used = time.time()
+            if master.alive():
+                self._count('hits')
+            elif not start:
+                return None
+            else:
+                self._count('misses')
+                master.close()
+                if not self._start_master(master, host, port, user, agent, 
+                        ident_key, server_key, connect_timeout):
+                    return None
+            if session:
+                # in use, so not to be reaped
+                master.sessions += 1
+            return master
+
+    def _acquire_slot(self, host):
+        with self._lock:
+            slot = self._host_slots.get(host)
+            if slot is None:
+                slot = self._host_slots[host] = threading.BoundedSemaphore(
+                    self.max_sessions)
+        if not slot.acquire(False):
+            self._count('waits')
+            slot.acquire()
+        return slot
+
+    @contextlib.contextmanager
+    def session(self, host, port, user, agent = None, 
+            ident_key = None, server_key = None, connect_timeout = 60,
+            start = True):
+        """
+        Context manager that holds one of the host's session slots, and
+        gives the ssh options needed to run the session through its 
+        master (an empty list, if there's no master to go through):
+        
+            with ssh_sessions.session(host, port, user) as ssh_args:
+                subprocess.call(['ssh'] + ssh_args + [...])
+        """
+        slot = self._acquire_slot(host)
+        try:
+            master = self._checkout(host, port, user, agent, ident_key, 
+                server_key, connect_timeout, start, True)
+            if master is None:
+                yield []
+            else:
+                try:
+                    yield ['-o', 'ControlMaster=no', 
+                           '-o', 'ControlPath=%s' % (master.path,)]
+                finally:
+                    with master.lock:
+                        master.sessions -= 1
+                        master.last_used = time.time()
+        finally:
+            slot.release()
+
+    def prewarm(self, hosts):
+        """
+        Starts masters for all the given hosts concurrently. 
+        
+        hosts is a list of dictionaries with the keyword arguments 
+        to control_path (host, port, user, agent, ident_key, server_key)
+        """
+        threads = [ threading.Thread(target = self.control_path, kwargs = kw)
+                    for kw in hosts ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def reap(self, idle_timeout = None):
+        """
+        Closes masters that have been idle for more than idle_timeout
+        seconds (by default, the pool's idle_timeout)
+        """
+        if idle_timeout is None:
+            idle_timeout = self.idle_timeout
+        now = time.time()
+        with self._lock:
+            masters = self._masters.values()
+        for master in masters:
+            with master.lock:
+                if master.proc is not None and not master.sessions \
+                        and now - master.last_used >= idle_timeout:
+                    master.close()
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(max(1, self.idle_timeout / 4.0))
+            try:
+                self.reap()
+            except:
+                # keep reaping, it's only housekeeping
+                pass
+
+    def close(self):
+        self.reap(0)
+
+ssh_sessions = SshSessionPool()
+atexit.register(ssh_sessions.close)
+
+def ssh_session(host, port, user, agent = None, ident_key = None, 
+        server_key = None, connect_timeout = 60, persistent = True):
+    """
+    Returns a context manager giving the extra ssh options for a 
+    session to the given host, see SshSessionPool.session.
+    
+    Non-persistent sessions only go through already established
+    masters, they never start one.
+    """
+    if SSH_POOL:
+        return ssh_sessions.session(host, port, user, agent, ident_key,
+            server_key, connect_timeout, start = persistent)
+    elif persistent and openssh_has_persist():
+        return _fixed_session([
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=/tmp/nepi_ssh-%r@%h:%p',
+            '-o', 'ControlPersist=60' ])
+    else:
+        return _fixed_session([])
+
+@contextlib.contextmanager
+def _fixed_session(args):
+    yield args
+
 def popen_ssh_command(command, host, port, user, agent, 
         stdin="", 
         ident_key = None,
@@ -608,9 +1364,24 @@ def popen_ssh_command(command, host, port, user, agent,
         err_on_timeout = True,
         connect_timeout = 60,
         persistent = True,
-        hostip = None):
+        hostip = None,
+        stdout_callback = None,
+        stderr_callback = None,
+        spill = SPILL_THRESHOLD,
+        spooled = False):
     """
     Executes a remote commands, returns ((stdout,stderr),process)
+    
+    stdin is either the command's input, as a string, or a file 
+    the command reads its input from.
+    
+    Unless persistent is False, the command runs through a pooled 
+    master connection (see SshSessionPool).
+    
+    Output lines can be processed as they arrive with stdout_callback 
+    and stderr_callback, see OutputSpool. If spooled is set, stdout 
+    and stderr are returned as OutputSpools rather than strings, to
+    keep large outputs out of memory.
     """
    
     tmp_known_hosts = None
@@ -622,11 +1393,6 @@ def popen_ssh_command(command, host, port, user, agent,
             '-o', 'ServerAliveInterval=30',
             '-o', 'TCPKeepAlive=yes',
             '-l', user, hostip or host]
-    if persistent and openssh_has_persist():
-        args.extend([
-            '-o', 'ControlMaster=auto',
-            '-o', 'ControlPath=/tmp/nepi_ssh-%r@%h:%p',
-            '-o', 'ControlPersist=60' ])
     if agent:
         args.append('-A')
     if port:
@@ -643,37 +1409,51 @@ def popen_ssh_command(command, host, port, user, agent,
     args.append(command)
 
     for x in xrange(retry or 3):
-        # connects to the remote host and starts a remote connection
-        proc = subprocess.Popen(args, 
-                stdout = subprocess.PIPE,
-                stdin = subprocess.PIPE, 
-                stderr = subprocess.PIPE)
+        session = ssh_session(hostip or host, port, user, agent, ident_key,
+            server_key, connect_timeout, persistent)
+        with session as session_args:
+            if isinstance(stdin, basestring):
+                stdin_data = stdin
+                stdin_arg = subprocess.PIPE
+            else:
+                # retries read it from the start again
+                stdin.seek(0)
+                stdin_data = None
+                stdin_arg = stdin
+            
+            # connects to the remote host and starts a remote connection
+            proc = subprocess.Popen(args[:1] + session_args + args[1:], 
+                    stdout = subprocess.PIPE,
+                    stdin = stdin_arg, 
+                    stderr = subprocess.PIPE)
+            
+            # attach tempfile object to the process, to make sure the file stays
+            # alive until the process is finished with it
+            proc._known_hosts = tmp_known_hosts
         
-        # attach tempfile object to the process, to make sure the file stays
-        # alive until the process is finished with it
-        proc._known_hosts = tmp_known_hosts
-    
-        try:
-            out, err = _communicate(proc, stdin, timeout, err_on_timeout)
-            if TRACE:
-                print "COMMAND host %s, command %s, out %s, error %s" % (host, " ".join(args), out, err)
-
-            if proc.poll():
-                if err.strip().startswith('ssh: ') or err.strip().startswith('mux_client_hello_exchange: '):
-                    # SSH error, can safely retry
-                    continue
-                elif retry:
-                    # Probably timed out or plain failed but can retry
-                    continue
-            break
-        except RuntimeError,e:
-            if TRACE:
-                print "EXCEPTION host %s, command %s, out %s, error %s, exception TIMEOUT ->  %s" % (
-                        host, " ".join(args), out, err, e.args)
+            try:
+                out, err = _communicate(proc, stdin_data, timeout, err_on_timeout,
+                    stdout_callback, stderr_callback, spill, spooled)
+                if TRACE:
+                    print "COMMAND host %s, command %s, out %s, error %s" % (host, " ".join(args), out, err)
+
+                if proc.poll():
+                    errhead = err.head(256) if spooled else err
+                    if errhead.strip().startswith('ssh: ') or errhead.strip().startswith('mux_client_hello_exchange: '):
+                        # SSH error, can safely retry
+                        continue
+                    elif retry:
+                        # Probably timed out or plain failed but can retry
+                        continue
+                break
+            except RuntimeError,e:
+                if TRACE:
+                    print "EXCEPTION host %s, command %s, out %s, error %s, exception TIMEOUT ->  %s" % (
+                            host, " ".join(args), out, err, e.args)
 
-            if retry <= 0:
-                raise
-            retry -= 1
+                if retry <= 0:
+                    raise
+                retry -= 1
         
     return ((out, err), proc)
 
@@ -739,11 +1519,6 @@ def popen_scp(source, dest,
                 '-o', 'ServerAliveInterval=30',
                 '-o', 'TCPKeepAlive=yes',
                 host ]
-        if openssh_has_persist():
-            args.extend([
-                '-o', 'ControlMaster=auto',
-                '-o', 'ControlPath=/tmp/nepi_ssh-%r@%h:%p',
-                '-o', 'ControlPersist=60' ])
         if port:
             args.append('-P%d' % port)
         if ident_key:
@@ -760,99 +1535,101 @@ def popen_scp(source, dest,
         else:
             raise AssertionError, "Unreachable code reached! :-Q"
         
-        # connects to the remote host and starts a remote connection
-        if isinstance(source, file):
-            proc = subprocess.Popen(args, 
-                    stdout = open('/dev/null','w'),
-                    stderr = subprocess.PIPE,
-                    stdin = source)
-            err = proc.stderr.read()
-            proc._known_hosts = tmp_known_hosts
-            eintr_retry(proc.wait)()
-            return ((None,err), proc)
-        elif isinstance(dest, file):
-            proc = subprocess.Popen(args, 
-                    stdout = open('/dev/null','w'),
-                    stderr = subprocess.PIPE,
-                    stdin = source)
-            err = proc.stderr.read()
-            proc._known_hosts = tmp_known_hosts
-            eintr_retry(proc.wait)()
-            return ((None,err), proc)
-        elif hasattr(source, 'read'):
-            # file-like (but not file) source
-            proc = subprocess.Popen(args, 
-                    stdout = open('/dev/null','w'),
-                    stderr = subprocess.PIPE,
-                    stdin = subprocess.PIPE)
+        with ssh_session(host, port, user, agent, ident_key, 
+                server_key) as session_args:
+            # connects to the remote host and starts a remote connection
+            if isinstance(source, file):
+                proc = subprocess.Popen(args[:1] + session_args + args[1:], 
+                        stdout = open('/dev/null','w'),
+                        stderr = subprocess.PIPE,
+                        stdin = source)
+                err = proc.stderr.read()
+                proc._known_hosts = tmp_known_hosts
+                eintr_retry(proc.wait)()
+                return ((None,err), proc)
+            elif isinstance(dest, file):
+                proc = subprocess.Popen(args[:1] + session_args + args[1:], 
+                        stdout = open('/dev/null','w'),
+                        stderr = subprocess.PIPE,
+                        stdin = source)
+                err = proc.stderr.read()
+                proc._known_hosts = tmp_known_hosts
+                eintr_retry(proc.wait)()
+                return ((None,err), proc)
+            elif hasattr(source, 'read'):
+                # file-like (but not file) source
+                proc = subprocess.Popen(args[:1] + session_args + args[1:], 
+                        stdout = open('/dev/null','w'),
+                        stderr = subprocess.PIPE,
+                        stdin = subprocess.PIPE)
             
-            buf = None
-            err = []
-            while True:
-                if not buf:
-                    buf = source.read(4096)
-                if not buf:
-                    #EOF
-                    break
+                buf = None
+                err = []
+                while True:
+                    if not buf:
+                        buf = source.read(4096)
+                    if not buf:
+                        #EOF
+                        break
                 
-                rdrdy, wrdy, broken = select.select(
-                    [proc.stderr],
-                    [proc.stdin],
-                    [proc.stderr,proc.stdin])
+                    rdrdy, wrdy, broken = select.select(
+                        [proc.stderr],
+                        [proc.stdin],
+                        [proc.stderr,proc.stdin])
                 
-                if proc.stderr in rdrdy:
-                    # use os.read for fully unbuffered behavior
-                    err.append(os.read(proc.stderr.fileno(), 4096))
+                    if proc.stderr in rdrdy:
+                        # use os.read for fully unbuffered behavior
+                        err.append(os.read(proc.stderr.fileno(), 4096))
                 
-                if proc.stdin in wrdy:
-                    proc.stdin.write(buf)
-                    buf = None
+                    if proc.stdin in wrdy:
+                        proc.stdin.write(buf)
+                        buf = None
                 
-                if broken:
-                    break
-            proc.stdin.close()
-            err.append(proc.stderr.read())
+                    if broken:
+                        break
+                proc.stdin.close()
+                err.append(proc.stderr.read())
                 
-            proc._known_hosts = tmp_known_hosts
-            eintr_retry(proc.wait)()
-            return ((None,''.join(err)), proc)
-        elif hasattr(dest, 'write'):
-            # file-like (but not file) dest
-            proc = subprocess.Popen(args, 
-                    stdout = subprocess.PIPE,
-                    stderr = subprocess.PIPE,
-                    stdin = open('/dev/null','w'))
+                proc._known_hosts = tmp_known_hosts
+                eintr_retry(proc.wait)()
+                return ((None,''.join(err)), proc)
+            elif hasattr(dest, 'write'):
+                # file-like (but not file) dest
+                proc = subprocess.Popen(args[:1] + session_args + args[1:], 
+                        stdout = subprocess.PIPE,
+                        stderr = subprocess.PIPE,
+                        stdin = open('/dev/null','w'))
             
-            buf = None
-            err = []
-            while True:
-                rdrdy, wrdy, broken = select.select(
-                    [proc.stderr, proc.stdout],
-                    [],
-                    [proc.stderr, proc.stdout])
+                buf = None
+                err = []
+                while True:
+                    rdrdy, wrdy, broken = select.select(
+                        [proc.stderr, proc.stdout],
+                        [],
+                        [proc.stderr, proc.stdout])
                 
-                if proc.stderr in rdrdy:
-                    # use os.read for fully unbuffered behavior
-                    err.append(os.read(proc.stderr.fileno(), 4096))
+                    if proc.stderr in rdrdy:
+                        # use os.read for fully unbuffered behavior
+                        err.append(os.read(proc.stderr.fileno(), 4096))
                 
-                if proc.stdout in rdrdy:
-                    # use os.read for fully unbuffered behavior
-                    buf = os.read(proc.stdout.fileno(), 4096)
-                    dest.write(buf)
+                    if proc.stdout in rdrdy:
+                        # use os.read for fully unbuffered behavior
+                        buf = os.read(proc.stdout.fileno(), 4096)
+                        dest.write(buf)
                     
-                    if not buf:
-                        #EOF
-                        break
+                        if not buf:
+                            #EOF
+                            break
                 
-                if broken:
-                    break
-            err.append(proc.stderr.read())
+                    if broken:
+                        break
+                err.append(proc.stderr.read())
                 
-            proc._known_hosts = tmp_known_hosts
-            eintr_retry(proc.wait)()
-            return ((None,''.join(err)), proc)
-        else:
-            raise AssertionError, "Unreachable code reached! :-Q"
+                proc._known_hosts = tmp_known_hosts
+                eintr_retry(proc.wait)()
+                return ((None,''.join(err)), proc)
+            else:
+                raise AssertionError, "Unreachable code reached! :-Q"
     else:
         # Parse destination as <user>@<server>:<path>
         if isinstance(dest, basestring) and ':' in dest:
@@ -886,23 +1663,231 @@ def popen_scp(source, dest,
         if isinstance(source,list):
             args.extend(source)
         else:
-            if openssh_has_persist():
-                args.extend([
-                    '-o', 'ControlMaster=auto',
-                    '-o', 'ControlPath=/tmp/nepi_ssh-%r@%h:%p'])
             args.append(source)
         args.append(dest)
 
-        # connects to the remote host and starts a remote connection
-        proc = subprocess.Popen(args, 
+        with ssh_session(host, port, user, agent, ident_key, 
+                server_key) as session_args:
+            # connects to the remote host and starts a remote connection
+            proc = subprocess.Popen(args[:1] + session_args + args[1:], 
+                    stdout = subprocess.PIPE,
+                    stdin = subprocess.PIPE, 
+                    stderr = subprocess.PIPE)
+            proc._known_hosts = tmp_known_hosts
+            
+            comm = proc.communicate()
+            eintr_retry(proc.wait)()
+        return (comm, proc)
+
+def _push_source_items(sources):
+    """ Normalizes push_files sources to a list of (name, source) pairs """
+    items = []
+    for source in sources:
+        if isinstance(source, basestring):
+            source = (os.path.basename(source), source)
+        items.append(source)
+    return items
+
+def pack_files(sources, fileobj):
+    """
+    Writes a tar archive with the given sources (see push_files) into
+    fileobj, reading them in chunks, and returns a dictionary with the
+    md5 hash of each file in it by name.
+    """
+    tar = tarfile.open(fileobj = fileobj, mode = "w|")
+    hashes = dict()
+    now = time.time()
+    for name, source in _push_source_items(sources):
+        if isinstance(source, basestring):
+            f = open(source, "rb")
+            mode = os.stat(source).st_mode & 0777
+        else:
+            # its size must be known before adding it
+            f = tempfile.TemporaryFile()
+            shutil.copyfileobj(source, f)
+            f.seek(0)
+            mode = 0644
+        try:
+            md5 = hashlib.md5()
+            for chunk in iter(functools.partial(f.read, 65536), ""):
+                md5.update(chunk)
+            hashes[name] = md5.hexdigest()
+            info = tarfile.TarInfo(name)
+            info.size = f.tell()
+            info.mode = mode
+            info.mtime = now
+            f.seek(0)
+            tar.addfile(info, f)
+        finally:
+            f.close()
+    tar.close()
+    return hashes
+
+def _parse_md5sums(out):
+    """ Parses md5sum's output into a dictionary of hashes by name """
+    hashes = dict()
+    for line in out.splitlines():
+        parts = line.split(None, 1)
+        if len(parts) == 2:
+            md5, name = parts
+            hashes[name.lstrip('*')] = md5.lstrip('\\')
+    return hashes
+
+def push_files(sources, targets, 
+        port = None, 
+        agent = None, 
+        ident_key = None, 
+        server_key = None,
+        skip_existing = True,
+        max_parallel = 16,
+        timeout = None):
+    """
+    Copies a set of files into a folder at each of the given targets, 
+    concurrently, with a single ssh session per target that extracts
+    a tar stream of the files.
+    
+    Sources is a list of local file paths, or (name, source) pairs, 
+    source being a local path or a file-like object, that will be 
+    created with the given name.
+    
+    Targets is a list of destination folders, as <user>@<host>:<path> 
+    (as per scp specs), or local paths. Relative remote paths are 
+    relative to the remote user's home.
+    
+    If skip_existing is True, files already present at the target with
+    the same contents (as told by their md5 hash) are not transferred.
+    
+    Returns a dictionary with transfer statistics for each target:
+        files: number of files transferred
+        skipped: number of files skipped because they were up to date
+        bytes: size of the transferred tar stream
+        latency: seconds taken to check for existing files
+        time: seconds taken to transfer the files
+        throughput: transfer rate, in bytes per second
+    
+    If any transfer fails, raises RuntimeError(out, err) with the 
+    failures' details, once all transfers are done.
+    """
+    items = _push_source_items(sources)
+    tmpfiles = []
+    try:
+        return _push_files(items, targets, tmpfiles, port, agent, ident_key,
+            server_key, skip_existing, max_parallel, timeout)
+    finally:
+        for tmpfile in tmpfiles:
+            tmpfile.close()
+
+def _push_files(items, targets, tmpfiles, port, agent, ident_key, 
+        server_key, skip_existing, max_parallel, timeout):
+    # read file-like sources once, so every target gets the same thing
+    paths = dict()
+    for name, source in items:
+        if not isinstance(source, basestring):
+            tmpfile = tempfile.NamedTemporaryFile()
+            tmpfiles.append(tmpfile)
+            shutil.copyfileobj(source, tmpfile)
+            tmpfile.flush()
+            os.chmod(tmpfile.name, 0644)
+            source = tmpfile.name
+        paths[name] = source
+    def get_sources(names):
+        return [ (name, paths[name]) 
+                 for name, source in items if name in names ]
+    
+    # the archive is packed once, into a temporary file, for every 
+    # distinct set of files to send, which is usually the whole set,
+    # and every target reads it from there
+    def pack(names):
+        archive = tempfile.NamedTemporaryFile()
+        tmpfiles.append(archive)
+        hashes = pack_files(get_sources(names), archive)
+        archive.flush()
+        return archive, hashes
+    names = [ name for name, source in items ]
+    archive, hashes = pack(names)
+    archives = { frozenset(names) : archive }
+    archives_lock = threading.Lock()
+    def get_archive(names):
+        names = frozenset(names)
+        with archives_lock:
+            if names not in archives:
+                archives[names] = pack(names)[0]
+            return archives[names].name
+    
+    def run(target, command, stdin = ""):
+        if ':' in target:
+            remspec, path = target.split(':', 1)
+            user, host = remspec.rsplit('@', 1)
+            return popen_ssh_command(command % { 'path' : shell_escape(path) },
+                host = host, port = port, user = user, agent = agent,
+                stdin = stdin, ident_key = ident_key, server_key = server_key,
+                timeout = timeout)
+        else:
+            proc = subprocess.Popen(
+                ["/bin/sh", "-c", command % { 'path' : shell_escape(target) }],
+                stdin = subprocess.PIPE if isinstance(stdin, basestring) 
+                    else stdin,
                 stdout = subprocess.PIPE,
-                stdin = subprocess.PIPE, 
                 stderr = subprocess.PIPE)
-        proc._known_hosts = tmp_known_hosts
+            if not isinstance(stdin, basestring):
+                stdin = None
+            return _communicate(proc, stdin, timeout), proc
+    
+    stats = dict()
+    errors = []
+    def push(target):
+        names = [ name for name, source in items ]
+        latency = 0
+        if skip_existing and names:
+            start = time.time()
+            (out, err), proc = run(target,
+                "cd %%(path)s 2>/dev/null && md5sum -- %s 2>/dev/null ; true" % (
+                    " ".join(map(shell_escape, names)),))
+            latency = time.time() - start
+            if not eintr_retry(proc.wait)():
+                existing = _parse_md5sums(out)
+                names = [ name for name in names 
+                          if existing.get(name) != hashes[name] ]
         
-        comm = proc.communicate()
-        eintr_retry(proc.wait)()
-        return (comm, proc)
+        start = time.time()
+        size = 0
+        if names:
+            path = get_archive(names)
+            size = os.path.getsize(path)
+            # ssh reads the archive straight from the file
+            data = open(path, "rb")
+            try:
+                (out, err), proc = run(target,
+                    "mkdir -p %(path)s && tar -x -m -C %(path)s -f -", data)
+            finally:
+                data.close()
+            if eintr_retry(proc.wait)():
+                errors.append("%s: %s%s" % (target, out, err))
+                return
+        elapsed = time.time() - start
+        
+        stats[target] = dict(
+            files = len(names),
+            skipped = len(items) - len(names),
+            bytes = size,
+            latency = latency,
+            time = elapsed,
+            throughput = size / max(elapsed, 1e-6),
+        )
+    
+    pool = parallel.WorkerPool(max(1, min(max_parallel, len(targets))))
+    try:
+        pool.run_all([ functools.partial(push, target) 
+                       for target in targets ], 
+            cancel_on_error = False)
+    finally:
+        pool.close()
+    
+    if errors:
+        raise RuntimeError, ("Failed to push files %r to %d of %d targets" % (
+            [ name for name, source in items ], len(errors), len(targets)),
+            "\n".join(errors))
+    return stats
 
 def decode_and_execute():
     # The python code we want to execute might have characters that 
@@ -1019,116 +2004,488 @@ def popen_python(python_code,
 
     return proc
 
-# POSIX
-def _communicate(self, input, timeout=None, err_on_timeout=True):
-    read_set = []
-    write_set = []
-    stdout = None # Return
-    stderr = None # Return
+def _preload(modules):
+    for mod_name in modules:
+        try:
+            __import__(mod_name)
+        except:
+            # the launched code will fail loudly if it needs it
+            pass
+
+def zygote_main(preload = ()):
+    """
+    Main loop of a zygote process (see Zygote), started through 
+    popen_python. Imports the preload modules, then reads launch 
+    requests from stdin, one per line, and runs each one in a forked
+    child. Each request is answered with a line holding everything 
+    the child wrote to its stdout and stderr.
+    """
+    _preload(preload)
+    while True:
+        line = eintr_retry(sys.stdin.readline)()
+        if not line:
+            # our launcher is gone
+            break
+        preload, python_code = codec.loads(base64.b64decode(line))
+        
+        # imported modules stay loaded in the zygote, 
+        # so only the first launch that needs them pays for them
+        _preload(preload)
+        
+        (r, w) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(r)
+                devnull = os.open(DEV_NULL, os.O_RDONLY)
+                os.dup2(devnull, 0)
+                os.dup2(w, 1)
+                os.dup2(w, 2)
+                os.close(devnull)
+                os.close(w)
+                exec python_code in { '__name__' : '__main__' }
+            except:
+                traceback.print_exc()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            # see ref: "os._exit(0)"
+            os._exit(0)
+        
+        os.close(w)
+        output = []
+        while True:
+            data = eintr_retry(os.read)(r, 4096)
+            if not data:
+                break
+            output.append(data)
+        os.close(r)
+        eintr_retry(os.waitpid)(pid, 0)
+        
+        sys.stdout.write(base64.b64encode(codec.dumps("".join(output))) + "\n")
+        sys.stdout.flush()
+
+class Zygote(object):
+    """
+    A python interpreter (local, or remote through ssh) that stays
+    around to launch python code in forked copies of itself, so that
+    launches skip the interpreter startup, the ssh connection and 
+    the import of modules already loaded by a previous launch.
+    
+    Launched code runs as in popen_python, except that its stdin is 
+    closed and its stdout and stderr are collected into a string that 
+    spawn() returns when the code finishes. It must thus daemonize 
+    (as Server.run does) to keep running in the background.
+    
+    The preload modules are imported as soon as the zygote starts.
+    """
+    def __init__(self, preload = (), **access):
+        self._lock = threading.Lock()
+        self._process = popen_python(
+            "from nepi.util import server; server.zygote_main(%r)" % (
+                tuple(preload),), 
+            **access)
+    
+    def alive(self):
+        return self._process.poll() is None
+
+    def spawn(self, python_code, preload = ()):
+        """
+        Runs python_code in a fresh fork of the zygote, after 
+        importing the preload modules (in the zygote itself). 
+        Returns the output of the launched code.
+        """
+        request = base64.b64encode(codec.dumps((tuple(preload), python_code)))
+        with self._lock:
+            try:
+                self._process.stdin.write(request + "\n")
+                self._process.stdin.flush()
+                reply = eintr_retry(self._process.stdout.readline)()
+            except (IOError, OSError):
+                reply = None
+            if not reply:
+                raise RuntimeError, "Zygote process died: \nerr:\n%s" % (
+                    self._process.stderr.read(),)
+        return codec.loads(base64.b64decode(reply))
+
+    def close(self):
+        # launches in progress finish first
+        with self._lock:
+            try:
+                self._process.stdin.close()
+            except:
+                pass
+            eintr_retry(self._process.wait)()
+
+# Zygotes by access parameters
+_zygotes = dict()
+_zygotes_lock = threading.Lock()
+
+def get_zygote(communication = DC.ACCESS_LOCAL, 
+        host = None, 
+        port = None, 
+        user = None, 
+        agent = False, 
+        ident_key = None,
+        sudo = False, 
+        environment_setup = "",
+        preload = ()):
+    """
+    Returns the Zygote for the given access parameters, launching it 
+    (or relaunching it, if it died) when needed, with the given 
+    preload modules.
+    """
+    key = (communication, host, port, user, agent, ident_key, sudo,
+        environment_setup)
+    with _zygotes_lock:
+        zygote = _zygotes.get(key)
+        if zygote is None or not zygote.alive():
+            zygote = _zygotes[key] = Zygote(
+                preload = preload,
+                communication = communication,
+                host = host,
+                port = port,
+                user = user,
+                agent = agent,
+                ident_key = ident_key,
+                sudo = sudo,
+                environment_setup = environment_setup)
+    return zygote
+
+def close_zygotes():
+    """
+    Closes all zygotes launched by get_zygote. Code they launched 
+    keeps running.
+    """
+    with _zygotes_lock:
+        zygotes = _zygotes.values()
+        _zygotes.clear()
+    for zygote in zygotes:
+        zygote.close()
+
+class OutputSpool(object):
+    """
+    Accumulates the output of a process, in memory up to spill bytes,
+    and in a temporary file beyond that.
     
-    killed = False
+    If given, line_callback is called with every line written, without
+    its line terminator, as soon as it is complete.
+    """
+    def __init__(self, spill = SPILL_THRESHOLD, line_callback = None):
+        self.spill = spill
+        self.line_callback = line_callback
+        self._chunks = []
+        self._file = None
+        self._size = 0
+        self._partial = ""
+    
+    def __len__(self):
+        return self._size
     
-    if timeout is not None:
-        timelimit = time.time() + timeout
-        killtime = timelimit + 4
-        bailtime = timelimit + 4
-
-    if self.stdin:
-        # Flush stdio buffer.  This might block, if the user has
-        # been writing to .stdin in an uncontrolled fashion.
-        self.stdin.flush()
-        if input:
-            write_set.append(self.stdin)
+    @property
+    def spilled(self):
+        return self._file is not None
+
+    def write(self, data):
+        if not data:
+            return
+        self._size += len(data)
+        if self._file is not None:
+            self._file.write(data)
+        else:
+            self._chunks.append(data)
+            if self._size > self.spill:
+                self._file = tempfile.NamedTemporaryFile()
+                self._file.write(''.join(self._chunks))
+                self._chunks = None
+        
+        if self.line_callback is not None:
+            lines = (self._partial + data).split('\n')
+            self._partial = lines.pop()
+            for line in lines:
+                self.line_callback(line)
+            if len(self._partial) > self.spill:
+                # don't hold on to endless lines either
+                self.line_callback(self._partial)
+                self._partial = ""
+
+    def close(self):
+        """ Signals the end of the output, flushing any unterminated line """
+        if self._partial and self.line_callback is not None:
+            self.line_callback(self._partial)
+        self._partial = ""
+
+    def __iter__(self):
+        """ Iterates over the lines of the output, reading them as needed """
+        f = self.open()
+        try:
+            for line in f:
+                yield line
+        finally:
+            f.close()
+
+    def head(self, size):
+        """ Returns up to size bytes from the start of the output """
+        f = self.open()
+        try:
+            return f.read(size)
+        finally:
+            f.close()
+
+    def open(self):
+        """ Returns a file-like object with the output, positioned at its start """
+        if self._file is not None:
+            self._file.flush()
+            # an independent file, so that reading doesn't disturb writing
+            return open(self._file.name, "rb")
+        else:
+            return cStringIO.StringIO(''.join(self._chunks))
+
+    def getvalue(self):
+        if self._file is not None:
+            f = self.open()
+            try:
+                return f.read()
+            finally:
+                f.close()
         else:
-            self.stdin.close()
-    if self.stdout:
-        read_set.append(self.stdout)
-        stdout = []
-    if self.stderr:
-        read_set.append(self.stderr)
-        stderr = []
-
-    input_offset = 0
-    while read_set or write_set:
+            value = ''.join(self._chunks)
+            self._chunks = [value]
+            return value
+
+class Communication(object):
+    """
+    A process being exchanged data with by a Communicator. Its output 
+    is accumulated in the stdout and stderr OutputSpools.
+    
+    Processes that exceed their timeout are killed, and flagged as
+    timed_out.
+    """
+    def __init__(self, proc, input = None, timeout = None, 
+            err_on_timeout = True, spill = SPILL_THRESHOLD,
+            stdout_callback = None, stderr_callback = None):
+        self.proc = proc
+        self.input = input or ""
+        self.input_offset = 0
+        self.err_on_timeout = err_on_timeout
+        self.timed_out = False
+        self.done = False
+        self.fds = set()
+        self.last_activity = time.time()
         if timeout is not None:
-            curtime = time.time()
-            if timeout is None or curtime > timelimit:
-                if curtime > bailtime:
-                    break
-                elif curtime > killtime:
-                    signum = signal.SIGKILL
-                else:
-                    signum = signal.SIGTERM
-                # Lets kill it
-                os.kill(self.pid, signum)
-                select_timeout = 0.5
-            else:
-                select_timeout = timelimit - curtime + 0.1
+            self.timelimit = time.time() + timeout
+            self.killtime = self.timelimit + 4
+            self.bailtime = self.timelimit + 4
         else:
-            select_timeout = 1.0
+            self.timelimit = self.killtime = self.bailtime = None
+        self.stdout = OutputSpool(spill, stdout_callback) \
+            if proc.stdout else None
+        self.stderr = OutputSpool(spill, stderr_callback) \
+            if proc.stderr else None
+    
+    def result(self, spooled = False):
+        """
+        Returns the (stdout, stderr) output as strings, or as the
+        OutputSpools themselves if spooled is set, so that output 
+        spilled to disk isn't read back into memory.
+        """
+        if spooled:
+            return (self.stdout, self.stderr)
+        
+        stdout = stderr = None
+        if self.stdout is not None:
+            stdout = self.stdout.getvalue()
+        if self.stderr is not None:
+            stderr = self.stderr.getvalue()
+
+        # Translate newlines, if requested.  We cannot let the file
+        # object do the translation: It is based on stdio, which is
+        # impossible to combine with select (unless forcing no
+        # buffering).
+        if self.proc.universal_newlines and hasattr(file, 'newlines'):
+            if stdout:
+                stdout = self.proc._translate_newlines(stdout)
+            if stderr:
+                stderr = self.proc._translate_newlines(stderr)
+
+        return (stdout, stderr)
+
+class Communicator(object):
+    """
+    Exchanges data with any number of processes from a single thread,
+    with poll, like subprocess.Popen.communicate does for one:
+    
+        communicator = Communicator()
+        comms = [ communicator.add(proc, timeout = 60) for proc in procs ]
+        communicator.run()
+        for comm in comms:
+            out, err = comm.result()
+    """
+    # Read size per readiness notification
+    READ_SIZE = 65536
+    
+    def __init__(self):
+        self._poll = select.poll()
+        self._fds = dict()
+        self._comms = []
+
+    def add(self, proc, input = None, timeout = None, err_on_timeout = True,
+            spill = SPILL_THRESHOLD, stdout_callback = None, 
+            stderr_callback = None):
+        """
+        Starts exchanging data with the process proc (a subprocess.Popen).
+        Returns its Communication. See OutputSpool for spill and the 
+        callbacks.
+        """
+        comm = Communication(proc, input, timeout, err_on_timeout, spill,
+            stdout_callback, stderr_callback)
+        self._comms.append(comm)
+        
+        if proc.stdin:
+            # Flush stdio buffer.  This might block, if the user has
+            # been writing to .stdin in an uncontrolled fashion.
+            proc.stdin.flush()
+            if comm.input:
+                fd = proc.stdin.fileno()
+                fcntl.fcntl(fd, fcntl.F_SETFL, 
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+                self._register(fd, comm, proc.stdin, None, select.POLLOUT)
+            else:
+                proc.stdin.close()
+        if proc.stdout:
+            self._register(proc.stdout.fileno(), comm, proc.stdout, 
+                comm.stdout, select.POLLIN | select.POLLPRI)
+        if proc.stderr:
+            self._register(proc.stderr.fileno(), comm, proc.stderr, 
+                comm.stderr, select.POLLIN | select.POLLPRI)
+        if not comm.fds:
+            self._finish(comm)
+        return comm
+
+    def _register(self, fd, comm, fileobj, spool, events):
+        self._fds[fd] = (comm, fileobj, spool)
+        comm.fds.add(fd)
+        self._poll.register(fd, events)
+
+    def _unregister(self, fd):
+        comm, fileobj, spool = self._fds.pop(fd)
+        comm.fds.discard(fd)
+        self._poll.unregister(fd)
+        fileobj.close()
+        if spool is not None:
+            spool.close()
+    
+    def _finish(self, comm):
+        for fd in list(comm.fds):
+            self._unregister(fd)
+        eintr_retry(comm.proc.wait)()
+        comm.done = True
+
+    def pending(self):
+        return [ comm for comm in self._comms if not comm.done ]
+
+    def run(self):
+        """ Runs until all processes are done """
+        while self.step():
+            pass
+
+    def step(self, max_wait = 1.0):
+        """
+        Waits up to max_wait seconds for something to happen, handles it,
+        and returns whether there are processes left to be done with.
+        """
+        now = time.time()
+        wait = max_wait
+        for comm in self.pending():
+            if comm.timelimit is not None:
+                if now > comm.timelimit:
+                    if now > comm.bailtime:
+                        self._finish(comm)
+                        continue
+                    elif now > comm.killtime:
+                        signum = signal.SIGKILL
+                    else:
+                        signum = signal.SIGTERM
+                    # Lets kill it
+                    try:
+                        os.kill(comm.proc.pid, signum)
+                    except OSError:
+                        # already gone
+                        pass
+                    comm.timed_out = True
+                    wait = min(wait, 0.5)
+                else:
+                    wait = min(wait, comm.timelimit - now + 0.1)
+        
+        if not self._fds:
+            return bool(self.pending())
         
-        if select_timeout > 1.0:
-            select_timeout = 1.0
-            
         try:
-            rlist, wlist, xlist = select.select(read_set, write_set, [], select_timeout)
-        except select.error,e:
-            if e[0] != 4:
+            events = self._poll.poll(max(wait, 0) * 1000)
+        except select.error, e:
+            if e[0] != errno.EINTR:
                 raise
+            return True
+        
+        now = time.time()
+        for fd, event in events:
+            comm, fileobj, spool = self._fds[fd]
+            comm.last_activity = now
+            if spool is None:
+                # stdin
+                if event & (select.POLLERR | select.POLLHUP):
+                    # nobody's reading anymore
+                    self._unregister(fd)
+                    continue
+                try:
+                    written = os.write(fd, buffer(comm.input, comm.input_offset,
+                        self.READ_SIZE))
+                except OSError, e:
+                    if e.errno in (errno.EAGAIN, errno.EINTR):
+                        continue
+                    elif e.errno == errno.EPIPE:
+                        written = len(comm.input)
+                    else:
+                        raise
+                comm.input_offset += written
+                if comm.input_offset >= len(comm.input):
+                    self._unregister(fd)
             else:
-                continue
+                try:
+                    data = os.read(fd, self.READ_SIZE)
+                except OSError, e:
+                    if e.errno in (errno.EAGAIN, errno.EINTR):
+                        continue
+                    raise
+                if data:
+                    spool.write(data)
+                else:
+                    self._unregister(fd)
         
-        if not rlist and not wlist and not xlist and self.poll() is not None:
-            # timeout and process exited, say bye
-            break
+        for comm in self.pending():
+            if not comm.fds:
+                self._finish(comm)
+            elif now - comm.last_activity > max_wait \
+                    and comm.proc.poll() is not None:
+                # process exited, yet something keeps its output 
+                # open, say bye
+                self._finish(comm)
+        
+        return bool(self.pending())
 
-        if self.stdin in wlist:
-            # When select has indicated that the file is writable,
-            # we can write up to PIPE_BUF bytes without risk
-            # blocking.  POSIX defines PIPE_BUF >= 512
-            bytes_written = os.write(self.stdin.fileno(), buffer(input, input_offset, 512))
-            input_offset += bytes_written
-            if input_offset >= len(input):
-                self.stdin.close()
-                write_set.remove(self.stdin)
-
-        if self.stdout in rlist:
-            data = os.read(self.stdout.fileno(), 1024)
-            if data == "":
-                self.stdout.close()
-                read_set.remove(self.stdout)
-            stdout.append(data)
-
-        if self.stderr in rlist:
-            data = os.read(self.stderr.fileno(), 1024)
-            if data == "":
-                self.stderr.close()
-                read_set.remove(self.stderr)
-            stderr.append(data)
+# POSIX
+def _communicate(self, input, timeout=None, err_on_timeout=True,
+        stdout_callback = None, stderr_callback = None, 
+        spill = SPILL_THRESHOLD, spooled = False):
+    """
+    Like self.communicate(input) (self being a subprocess.Popen), 
+    but with an optional timeout, in seconds, after which the process
+    is killed, and the output it produced so far returned.
     
-    # All data exchanged.  Translate lists into strings.
-    if stdout is not None:
-        stdout = ''.join(stdout)
-    if stderr is not None:
-        stderr = ''.join(stderr)
-
-    # Translate newlines, if requested.  We cannot let the file
-    # object do the translation: It is based on stdio, which is
-    # impossible to combine with select (unless forcing no
-    # buffering).
-    if self.universal_newlines and hasattr(file, 'newlines'):
-        if stdout:
-            stdout = self._translate_newlines(stdout)
-        if stderr:
-            stderr = self._translate_newlines(stderr)
-
-    if killed and err_on_timeout:
-        errcode = self.poll()
-        raise RuntimeError, ("Operation timed out", errcode, stdout, stderr)
-    else:
-        if killed:
-            self.poll()
-        else:
-            self.wait()
-        return (stdout, stderr)
-
+    See OutputSpool for spill and the callbacks, and Communication.result
+    for spooled.
+    """
+    communicator = Communicator()
+    comm = communicator.add(self, input, timeout, err_on_timeout, spill,
+        stdout_callback, stderr_callback)
+    communicator.run()
+    return comm.result(spooled)
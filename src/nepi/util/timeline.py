@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+"""
+Deployment timelines: start and end times of deployment phases, factory
+steps and per-element actions, exported in the Chrome trace event
+format ("X" complete events), which chrome://tracing and Perfetto can show.
+
+Both the experiment controller and testbed controllers keep a Timeline.
+Events are (name, category, start, end, tid, args) tuples, times being
+those of the clock of the host that recorded them, and tid the thread
+that ran them, unless told otherwise.
+"""
+
+import collections
+import thread
+import time
+
+class Timeline(object):
+    def __init__(self, history = 100000):
+        self._events = collections.deque(maxlen = history)
+
+    def record(self, name, category, start, end, tid = None, args = None):
+        if tid is None:
+            tid = thread.get_ident()
+        self._events.append((name, category, start, end, tid, args))
+
+    def span(self, name, category, callable, *p, **kw):
+        """
+        Calls callable with the given arguments, recording an event
+        for the time it took, and returns its result.
+        """
+        start = time.time()
+        try:
+            return callable(*p, **kw)
+        finally:
+            self.record(name, category, start, time.time())
+
+    def events(self):
+        return list(self._events)
+
+    def clear(self):
+        self._events.clear()
+
+def to_trace_events(processes):
+    """
+    Returns a trace event document (a dictionary ready to be dumped as
+    JSON) with the events of the given processes, a list of
+    (pid, process name, thread names, events) tuples, thread names being
+    a dict mapping tids to names. Threads without a name are numbered.
+    Times are made relative to the earliest event.
+    """
+    origin = min([ event[2]
+        for pid, process_name, thread_names, events in processes
+        for event in events ] or [0])
+
+    trace_events = []
+    for pid, process_name, thread_names, events in processes:
+        trace_events.append(dict(name = "process_name", ph = "M",
+            pid = pid, tid = 0, args = dict(name = process_name)))
+        tids = dict()
+        for tid in sorted(thread_names):
+            tids[tid] = tid
+            trace_events.append(dict(name = "thread_name", ph = "M",
+                pid = pid, tid = tid, args = dict(name = thread_names[tid])))
+        used = set(tids)
+        for name, category, start, end, tid, args in events:
+            if tid not in tids:
+                # thread idents are big and meaningless, number them
+                number = 1
+                while number in used:
+                    number += 1
+                tids[tid] = number
+                used.add(number)
+                trace_events.append(dict(name = "thread_name", ph = "M",
+                    pid = pid, tid = tids[tid],
+                    args = dict(name = "thread %d" % (tids[tid],))))
+            event = dict(name = name, cat = category, ph = "X",
+                pid = pid, tid = tids[tid],
+                ts = int((start - origin) * 1000000),
+                dur = int((end - start) * 1000000))
+            if args:
+                event["args"] = args
+            trace_events.append(event)
+    return dict(traceEvents = trace_events, displayTimeUnit = "ms")
@@ -73,6 +73,162 @@ class ExecuteTestCase(unittest.TestCase):
         instance.stop()
         instance.shutdown()
 
+    def test_multicall(self):
+        from nepi.core.execute import MulticallError
+        instance = mock.TestbedController()
+        
+        multicall = instance.multicall()
+        self.make_mock_test(multicall)
+        multicall.defer_create(2, "Node")
+        multicall.defer_create(8, "Node")
+        self.assertEquals(instance.guids, [])
+        self.assertEquals(len(multicall), 16)
+        
+        try:
+            multicall.flush()
+        except MulticallError, e:
+            self.assertEquals(len(e.results), 16)
+            self.assertEquals([ (index, name) for index,name,error in e.errors ],
+                [ (14, "defer_create") ])
+        else:
+            self.fail("Expected MulticallError")
+        self.assertEquals(len(multicall), 0)
+        self.assertEquals(sorted(instance.guids), [2,3,4,5,6,7,8])
+        
+        self.do_presteps(instance)
+        instance.shutdown()
+
+    def test_snapshot_attributes(self):
+        from nepi.core.attributes import Attribute
+        instance = mock.TestbedController()
+        self.make_mock_test(instance)
+        self.do_presteps(instance)
+        
+        for flags in (None, Attribute.ExecImmutable):
+            expected = dict()
+            for guid in instance.guids:
+                for name in instance.get_attribute_list(guid, flags):
+                    value = instance.get(guid, name)
+                    if value is not None:
+                        expected.setdefault(guid, dict())[name] = value
+            self.assertEquals(instance.snapshot_attributes(flags), expected)
+        self.assertEquals(instance.snapshot_attributes()[5]["fake"], True)
+        instance.shutdown()
+
+    def test_timeline(self):
+        from nepi.core.metadata import Parallel
+        instance = mock.TestbedController()
+        self.make_mock_test(instance)
+        self.do_presteps(instance)
+        
+        events = instance.timeline()
+        steps = [ (name, category) for name, category, start, end, tid, args 
+            in events if name in ("Node", "Interface", "Application") ]
+        self.assertTrue(("Node", "create_function") in steps)
+        self.assertTrue(("Application", "create_function") in steps)
+        for name, category, start, end, tid, args in events:
+            self.assertTrue(start <= end)
+            if name == "Node[3]" and category == "create_function":
+                self.assertEquals(args, dict(guid = 3))
+        
+        def action(instance, guid):
+            time.sleep(0.1)
+        instance._timeline.clear()
+        instance._do_in_factory_order(action, [Parallel("Node")])
+        events = instance.timeline()
+        self.assertEquals(sorted([ event[0] for event in events ]), 
+            ["Node", "Node[2]", "Node[3]", "Node[4]"])
+        step = [ event for event in events if event[0] == "Node" ][0]
+        self.assertEquals(step[1], "action")
+        self.assertEquals(step[5], dict(elements = 3, parallel = True))
+        # each element in its own thread, all at once
+        actions = [ event for event in events if event[0] != "Node" ]
+        self.assertEquals(len(set([ event[4] for event in actions ])), 3)
+        self.assertTrue(step[3] - step[2] < 0.25)
+        instance.shutdown()
+
+    def test_bulk_queries(self):
+        instance = mock.TestbedController()
+        self.make_mock_test(instance)
+        self.do_presteps(instance)
+        
+        guids = sorted(instance.guids)
+        self.assertEquals(instance.status_many(guids), 
+            [ instance.status(guid) for guid in guids ])
+        self.assertEquals(instance.get_many(5, ["fake", "label"]), 
+            [ instance.get(5, "fake"), instance.get(5, "label") ])
+        self.assertEquals(instance.get_many(5, []), [])
+        self.assertRaises(AttributeError, instance.get_many, 5, ["fake", "nope"])
+        
+        instance.start()
+        while instance.status(7) != AS.STATUS_FINISHED:
+            time.sleep(0.1)
+        self.assertTrue(instance.is_finished_all([7]))
+        self.assertTrue(instance.is_finished_all([]))
+        # nodes have no status
+        self.assertFalse(instance.is_finished_all([7, 2]))
+        instance.stop()
+        instance.shutdown()
+
+    def test_wait_for(self):
+        import threading
+        instance = mock.TestbedController()
+        self.make_mock_test(instance)
+        self.do_presteps(instance)
+        instance.start()
+        
+        self.assertTrue(instance.wait_for([7], AS.STATUS_FINISHED))
+        self.assertFalse(instance.wait_for([2, 7], AS.STATUS_FINISHED, 0.2))
+        
+        # waiters are woken up as soon as the testbed stops
+        result = []
+        waiter = threading.Thread(target = lambda : result.append(
+            instance.wait_for([2], AS.STATUS_FINISHED, 30)))
+        waiter.start()
+        time.sleep(0.2)
+        start = time.time()
+        instance.stop()
+        waiter.join()
+        self.assertEquals(result, [False])
+        self.assertTrue(time.time() - start < 1)
+        instance.shutdown()
+
+    def test_read_trace(self):
+        from nepi.core import testbed_impl
+        from nepi.util import proxy
+        import os, tempfile
+        instance = mock.TestbedController()
+        self.make_mock_test(instance)
+        self.do_presteps(instance)
+        
+        content = instance.trace(7, "fake")
+        self.assertEquals(instance.trace(7, "fake", "size"), str(len(content)))
+        self.assertEquals(instance.read_trace(7, "fake", 5, 10), content[5:15])
+        self.assertEquals(instance.read_trace(7, "fake", len(content), 10), "")
+        
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            written = list(proxy.stream_trace(instance, 7, "fake", path, 16))
+            self.assertEquals(written, range(16, len(content), 16) + [len(content)])
+            self.assertEquals(open(path).read(), content)
+            
+            # file-backed traces
+            instance.trace_filepath = lambda guid, trace_id : path
+            self.assertEquals(
+                testbed_impl.TestbedController.read_trace(instance, 7, "fake", 3, 7),
+                content[3:10])
+            self.assertEquals(
+                testbed_impl.TestbedController.trace(instance, 7, "fake", "size"),
+                str(len(content)))
+            self.assertEquals(
+                testbed_impl.TestbedController.trace(instance, 7, "fake", "mtime"),
+                repr(os.path.getmtime(path)))
+        finally:
+            os.remove(path)
+        
+        instance.shutdown()
+
 if __name__ == '__main__':
     unittest.main()
 
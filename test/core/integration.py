@@ -2,9 +2,15 @@
 # -*- coding: utf-8 -*-
 
 import getpass
+import json
 from nepi.core.design import ExperimentDescription, FactoriesProvider
-from nepi.util import proxy
-from nepi.util.constants import DeploymentConfiguration as DC
+from nepi.core.attributes import Attribute
+from nepi.core.execute import ExperimentController, ExperimentSuite, Netref
+from nepi.util import proxy, server, rpcstats
+from nepi.util.parallel import TaskTimeout
+from nepi.util.parser._xml import XmlExperimentParser
+from nepi.util.constants import ApplicationStatus as AS, \
+        DeploymentConfiguration as DC
 import mock
 import mock.metadata
 import mock2
@@ -14,6 +20,7 @@ import shutil
 import sys
 import tempfile
 import test_util
+import threading
 import time
 import unittest
 
@@ -180,6 +187,69 @@ class ExecuteTestCase(unittest.TestCase):
         controller.stop()
         controller.shutdown()
 
+    def test_daemonized_testbed_multicall(self):
+        access_config = proxy.AccessConfiguration()
+        access_config.set_attribute_value(DC.DEPLOYMENT_MODE, DC.MODE_DAEMON)
+        access_config.set_attribute_value(DC.ROOT_DIRECTORY, self.root_dir)
+        access_config.set_attribute_value(DC.DEPLOYMENT_ENVIRONMENT_SETUP, 
+            "export PYTHONPATH=%r:%r:$PYTHONPATH "
+            "export NEPI_TESTBEDS='mock:mock mock2:mock2' " % (
+                os.path.dirname(os.path.dirname(mock.__file__)),
+                os.path.dirname(os.path.dirname(mock2.__file__)),))
+        
+        testbed = proxy.create_testbed_controller("mock", "0.1", access_config)
+        
+        multicall = testbed.multicall()
+        multicall.defer_configure("fake", True)
+        multicall.defer_create(2, "Node")
+        multicall.defer_create(2, "Node")
+        multicall.defer_create(3, "Interface")
+        multicall.defer_create_set(3, "fake", True)
+        multicall.defer_connect(2, "devs", 3, "node")
+        self.assertEquals(len(multicall), 6)
+        
+        try:
+            multicall.flush()
+        except RuntimeError, e:
+            self.assertEquals(e.results, [None] * 6)
+            self.assertEquals([ (index, name) for index,name,error in e.errors ],
+                [ (2, "defer_create") ])
+        else:
+            self.fail("Expected MulticallError")
+        self.assertEquals(len(multicall), 0)
+        self.assertEquals(multicall.flush(), [])
+        self.assertEquals(sorted(testbed.guids), [2,3])
+        
+        testbed.shutdown()
+
+    def test_daemonized_testbed_queries(self):
+        access_config = proxy.AccessConfiguration()
+        access_config.set_attribute_value(DC.DEPLOYMENT_MODE, DC.MODE_DAEMON)
+        access_config.set_attribute_value(DC.ROOT_DIRECTORY, self.root_dir)
+        access_config.set_attribute_value(DC.DEPLOYMENT_ENVIRONMENT_SETUP, 
+            "export PYTHONPATH=%r:%r:$PYTHONPATH "
+            "export NEPI_TESTBEDS='mock:mock mock2:mock2' "
+            "export MOCK_CONFIGURE_DELAY=2 " % (
+                os.path.dirname(os.path.dirname(mock.__file__)),
+                os.path.dirname(os.path.dirname(mock2.__file__)),))
+        
+        testbed = proxy.create_testbed_controller("mock", "0.1", access_config)
+        testbed.defer_create(2, "Node")
+        testbed.do_setup()
+        testbed.do_create()
+        
+        # queries aren't held back by a slow state-changing command
+        configure = testbed.do_configure_deferred()
+        time.sleep(0.2)
+        start = time.time()
+        self.assertEquals(testbed.status(2), AS.STATUS_UNDETERMINED)
+        self.assertEquals(testbed.guids, [2])
+        self.assertTrue(time.time() - start < 1)
+        self.assertFalse(configure._done())
+        configure._get()
+        
+        testbed.shutdown()
+
     def test_daemonized_all_integration(self):
         exp_desc, desc, app, node1, node2, iface1, iface2 = self.make_test_experiment()
         
@@ -215,6 +285,16 @@ class ExecuteTestCase(unittest.TestCase):
         self.assertEquals(controller.get_testbed_version(node1.guid), "0.1")
         self.assertEquals(controller.get_factory_id(node1.guid), "Node")
 
+        self.assertEquals(controller.trace(app.guid, "fake", "size"), 
+            str(len(fake_result)))
+        self.assertEquals(controller.read_trace(app.guid, "fake", 8, 8),
+            fake_result[8:16])
+        trace_path = os.path.join(self.root_dir, "fake.trace")
+        written = list(proxy.stream_trace(controller, app.guid, "fake", 
+            trace_path, chunk_size = 32))
+        self.assertEquals(written[-1], len(fake_result))
+        self.assertEquals(open(trace_path).read(), fake_result)
+
         traces_info = controller.traces_info()
         expected_traces_info = dict({
             1: dict({ # testbed guid
@@ -232,6 +312,583 @@ class ExecuteTestCase(unittest.TestCase):
         controller.stop()
         controller.shutdown()
 
+    def test_daemonized_wait_for(self):
+        exp_desc, desc, app, node1, node2, iface1, iface2 = self.make_test_experiment()
+        
+        desc.set_attribute_value(DC.DEPLOYMENT_MODE, DC.MODE_DAEMON)
+        inst_root_dir = os.path.join(self.root_dir, "instance")
+        os.mkdir(inst_root_dir)
+        desc.set_attribute_value(DC.ROOT_DIRECTORY, inst_root_dir)
+        
+        xml = exp_desc.to_xml()
+        
+        access_config = proxy.AccessConfiguration()
+        access_config.set_attribute_value(DC.DEPLOYMENT_MODE, DC.MODE_DAEMON)
+        access_config.set_attribute_value(DC.ROOT_DIRECTORY, self.root_dir)
+        access_config.set_attribute_value(DC.DEPLOYMENT_ENVIRONMENT_SETUP, 
+            "export PYTHONPATH=%r:%r:$PYTHONPATH "
+            "export NEPI_TESTBEDS='mock:mock mock2:mock2' " % (
+                os.path.dirname(os.path.dirname(mock.__file__)),
+                os.path.dirname(os.path.dirname(mock2.__file__)),))
+        controller = proxy.create_experiment_controller(xml, access_config)
+
+        controller.start()
+        self.assertTrue(controller.wait_for([app.guid]))
+        self.assertTrue(controller.is_finished(app.guid))
+        
+        # nodes never finish
+        start = time.time()
+        self.assertFalse(controller.wait_for([node1.guid], 
+            AS.STATUS_FINISHED, 0.5))
+        self.assertTrue(time.time() - start >= 0.5)
+        self.assertRaises(RuntimeError, controller.wait_for, [9999])
+
+        controller.stop()
+        controller.shutdown()
+
+    def test_daemonized_binary_codec_integration(self):
+        exp_desc, desc, app, node1, node2, iface1, iface2 = self.make_test_experiment()
+        
+        desc.set_attribute_value(DC.DEPLOYMENT_MODE, DC.MODE_DAEMON)
+        desc.set_attribute_value(DC.DEPLOYMENT_CODEC, DC.CODEC_BINARY)
+        inst_root_dir = os.path.join(self.root_dir, "instance")
+        os.mkdir(inst_root_dir)
+        desc.set_attribute_value(DC.ROOT_DIRECTORY, inst_root_dir)
+        
+        xml = exp_desc.to_xml()
+        
+        access_config = proxy.AccessConfiguration()
+        access_config.set_attribute_value(DC.DEPLOYMENT_MODE, DC.MODE_DAEMON)
+        access_config.set_attribute_value(DC.DEPLOYMENT_CODEC, DC.CODEC_BINARY)
+        access_config.set_attribute_value(DC.ROOT_DIRECTORY, self.root_dir)
+        access_config.set_attribute_value(DC.DEPLOYMENT_ENVIRONMENT_SETUP, 
+            "export PYTHONPATH=%r:%r:$PYTHONPATH "
+            "export NEPI_TESTBEDS='mock:mock mock2:mock2' " % (
+                os.path.dirname(os.path.dirname(mock.__file__)),
+                os.path.dirname(os.path.dirname(mock2.__file__)),))
+        controller = proxy.create_experiment_controller(xml, access_config)
+        self.assertTrue(controller._codec is proxy.BinaryCodec)
+
+        controller.start()
+        while not controller.is_finished(app.guid):
+            time.sleep(0.5)
+        fake_result = controller.trace(app.guid, "fake")
+        comp_result = """PING 10.0.0.2 (10.0.0.2) 56(84) bytes of data.
+
+--- 10.0.0.2 ping statistics ---
+1 packets transmitted, 1 received, 0% packet loss, time 0ms
+"""
+        self.assertTrue(fake_result.startswith(comp_result))
+
+        self.assertEquals(controller.get_testbed_id(node1.guid), "mock")
+        self.assertEquals(controller.get_factory_id(node1.guid), "Node")
+        self.assertEquals(controller.get(node1.guid, "label"), None)
+        self.assertRaises(RuntimeError, controller.get_factory_id, 1000)
+
+        traces_info = controller.traces_info()
+        self.assertEquals(traces_info[1][6]['fake']['filepath'], '<test>')
+
+        controller.stop()
+        controller.shutdown()
+
+    def test_daemonized_zygote_integration(self):
+        exp_desc, desc, app, node1, node2, iface1, iface2 = self.make_test_experiment()
+        
+        desc.set_attribute_value(DC.DEPLOYMENT_MODE, DC.MODE_DAEMON)
+        desc.set_attribute_value(DC.USE_ZYGOTE, True)
+        inst_root_dir = os.path.join(self.root_dir, "instance")
+        os.mkdir(inst_root_dir)
+        desc.set_attribute_value(DC.ROOT_DIRECTORY, inst_root_dir)
+        
+        xml = exp_desc.to_xml()
+        
+        access_config = proxy.AccessConfiguration()
+        access_config.set_attribute_value(DC.DEPLOYMENT_MODE, DC.MODE_DAEMON)
+        access_config.set_attribute_value(DC.USE_ZYGOTE, True)
+        access_config.set_attribute_value(DC.ROOT_DIRECTORY, self.root_dir)
+        access_config.set_attribute_value(DC.DEPLOYMENT_ENVIRONMENT_SETUP, 
+            "export PYTHONPATH=%r:%r:$PYTHONPATH "
+            "export NEPI_TESTBEDS='mock:mock mock2:mock2' " % (
+                os.path.dirname(os.path.dirname(mock.__file__)),
+                os.path.dirname(os.path.dirname(mock2.__file__)),))
+        try:
+            controller = proxy.create_experiment_controller(xml, access_config)
+            self.assertEquals(len(server._zygotes), 1)
+
+            controller.start()
+            while not controller.is_finished(app.guid):
+                time.sleep(0.5)
+            fake_result = controller.trace(app.guid, "fake")
+            comp_result = """PING 10.0.0.2 (10.0.0.2) 56(84) bytes of data.
+
+--- 10.0.0.2 ping statistics ---
+1 packets transmitted, 1 received, 0% packet loss, time 0ms
+"""
+            self.assertTrue(fake_result.startswith(comp_result))
+            self.assertEquals(controller.get_testbed_id(node1.guid), "mock")
+
+            controller.stop()
+            controller.shutdown()
+        finally:
+            server.close_zygotes()
+
+    def test_concurrent_bootstrap(self):
+        exp_desc = ExperimentDescription()
+        apps = []
+        for i in xrange(5):
+            exp_desc, desc, app, node1, node2, iface1, iface2 = \
+                    self.make_testbed(exp_desc, "mock")
+            apps.append(app)
+        xml = exp_desc.to_xml()
+        
+        # slow down controller creation, to see it overlap
+        lock = threading.Lock()
+        active = [0, 0]
+        class SlowBootstrapController(ExperimentController):
+            MAX_BOOTSTRAP_PER_HOST = 2
+            def _create_testbed_controller(self, *p, **kw):
+                with lock:
+                    active[0] += 1
+                    active[1] = max(active)
+                try:
+                    time.sleep(0.2)
+                    return super(SlowBootstrapController, 
+                        self)._create_testbed_controller(*p, **kw)
+                finally:
+                    with lock:
+                        active[0] -= 1
+        
+        controller = SlowBootstrapController(xml, self.root_dir)
+        start = time.time()
+        controller.start()
+        elapsed = time.time() - start
+        
+        # all on the same host, so never more than 2 at once
+        self.assertEquals(active[1], 2)
+        self.assertTrue(elapsed < 5 * 0.2)
+        self.assertEquals(len(controller._testbeds), 5)
+        
+        for app in apps:
+            while not controller.is_finished(app.guid):
+                time.sleep(0.5)
+        controller.stop()
+        controller.shutdown()
+
+    def test_independent_phases(self):
+        exp_desc = ExperimentDescription()
+        exp_desc, desc1, app1, node11, node12, iface11, iface12 = \
+                self.make_testbed(exp_desc, "mock")
+        exp_desc, desc2, app2, node21, node22, iface21, iface22 = \
+                self.make_testbed(exp_desc, "mock")
+        exp_desc, desc3, app3, node31, node32, iface31, iface32 = \
+                self.make_testbed(exp_desc, "mock")
+        # the third testbed refers to the first one, the second is
+        # on its own
+        iface11.set_attribute_value("label", "slow")
+        addr = iface11.add_address()
+        addr.set_attribute_value("Address", "10.0.0.2")
+        iface31.set_attribute_value("test", "{#[slow].addr[0].[Address]#}")
+        xml = exp_desc.to_xml()
+        
+        slow_guid = desc1.guid
+        class SlowSetupController(ExperimentController):
+            def _init_testbed_controllers(self, *p, **kw):
+                rv = super(SlowSetupController, self)._init_testbed_controllers(*p, **kw)
+                testbed = self._testbeds[slow_guid]
+                def do_setup(do_setup = testbed.do_setup):
+                    time.sleep(0.5)
+                    do_setup()
+                testbed.do_setup = do_setup
+                return rv
+        
+        controller = SlowSetupController(xml, self.root_dir)
+        controller.start()
+        
+        graph = controller._phase_graph
+        times = graph.times
+        # the independent testbed doesn't wait for the slow one at all...
+        self.assertTrue(times["start[%d]" % desc2.guid][1]
+            < times["do_setup[%d]" % desc1.guid][1])
+        # ...nor does the other one, until its netrefs have to be resolved
+        self.assertTrue(times["do_preconfigure[%d]" % desc3.guid][1]
+            < times["do_setup[%d]" % desc1.guid][1])
+        self.assertTrue(times["program_cross_connections[%d]" % desc3.guid][0]
+            >= times["do_preconfigure[%d]" % desc1.guid][1])
+        self.assertEquals(controller.get(iface31.guid, "test"), "10.0.0.2")
+        # and starts don't wait for the execute xml to be persisted
+        self.assertEquals(graph.deps("start[%d]" % desc2.guid),
+            ("resolve_netrefs[%d]" % desc2.guid,))
+        path = [ name for name, start, end in graph.critical_path() ]
+        self.assertEquals(path[0], "do_setup[%d]" % desc1.guid)
+        self.assertTrue("do_setup[%d]" % desc2.guid not in path)
+        
+        for app in (app1, app2, app3):
+            while not controller.is_finished(app.guid):
+                time.sleep(0.5)
+        controller.stop()
+        controller.shutdown()
+
+    def test_worker_pool(self):
+        exp_desc = ExperimentDescription()
+        guids = []
+        for i in xrange(4):
+            exp_desc, desc, app, node1, node2, iface1, iface2 = \
+                    self.make_testbed(exp_desc, "mock")
+            guids.append(desc.guid)
+        xml = exp_desc.to_xml()
+        
+        lock = threading.Lock()
+        active = [0, 0]
+        class PoolController(ExperimentController):
+            MAX_PARALLEL = 2
+            def _init_testbed_controllers(self, *p, **kw):
+                rv = super(PoolController, self)._init_testbed_controllers(*p, **kw)
+                for guid, testbed in self._testbeds.iteritems():
+                    def do_setup(guid = guid, do_setup = testbed.do_setup):
+                        with lock:
+                            active[0] += 1
+                            active[1] = max(active)
+                        try:
+                            self.slow_setup(guid)
+                            do_setup()
+                        finally:
+                            with lock:
+                                active[0] -= 1
+                    testbed.do_setup = do_setup
+                return rv
+            def slow_setup(self, guid):
+                time.sleep(0.2)
+        
+        # never more than MAX_PARALLEL tasks at once
+        controller = PoolController(xml, self.root_dir)
+        controller.start()
+        self.assertEquals(active[1], 2)
+        names = [ name for name, start, end in controller.task_times() ]
+        for guid in guids:
+            self.assertTrue("do_setup[%d]" % guid in names)
+        controller.stop()
+        controller.shutdown()
+        
+        # a task taking too long fails the whole phase
+        class HungController(PoolController):
+            TASK_TIMEOUT = 1
+            def slow_setup(self, guid):
+                if guid == guids[0]:
+                    time.sleep(2.5)
+        controller = HungController(xml, self.root_dir)
+        start = time.time()
+        self.assertRaises(TaskTimeout, controller.start)
+        self.assertTrue(time.time() - start < 2.5)
+        controller.shutdown()
+        # the hung task isn't stopped, let it finish
+        while active[0]:
+            time.sleep(0.1)
+        
+        # the first failure cancels tasks that haven't started yet
+        class FailingController(PoolController):
+            def slow_setup(self, guid):
+                if guid == guids[0]:
+                    raise RuntimeError("setup failed")
+                time.sleep(0.2)
+        controller = FailingController(xml, self.root_dir)
+        self.assertRaises(RuntimeError, controller.start)
+        times = controller._phase_graph.times
+        self.assertTrue(len([ name for name in times 
+            if name.startswith("do_setup[") ]) < 4)
+        self.assertFalse([ name for name in times 
+            if name.startswith("do_create[") ])
+        controller.shutdown()
+
+    def make_cross_pairs_experiment(self):
+        # two pairs of cross-connected testbeds
+        exp_desc = ExperimentDescription()
+        pairs = []
+        for i in xrange(2):
+            exp_desc, desc1, app1, node11, node12, iface11, iface12 = \
+                    self.make_testbed(exp_desc, "mock")
+            exp_desc, desc2, app2, node21, node22, iface21, iface22 = \
+                     self.make_testbed(exp_desc, "mock2")
+            iface12.connector("cross").connect(iface21.connector("cross"))
+            pairs.append((desc1.guid, desc2.guid))
+        return exp_desc.to_xml(), pairs
+
+    def run_slow_cross_connect(self, xml, slow_guid, deterministic):
+        class SlowCrossController(ExperimentController):
+            DETERMINISTIC_CROSS_CONNECT = deterministic
+            def _init_testbed_controllers(self, *p, **kw):
+                rv = super(SlowCrossController, self)._init_testbed_controllers(*p, **kw)
+                testbed = self._testbeds[slow_guid]
+                def do_cross_connect_init(cross_data, 
+                        do_cross_connect_init = testbed.do_cross_connect_init):
+                    time.sleep(0.5)
+                    do_cross_connect_init(cross_data)
+                testbed.do_cross_connect_init = do_cross_connect_init
+                return rv
+        
+        controller = SlowCrossController(xml, self.root_dir)
+        controller.start()
+        times = controller._phase_graph.times
+        controller.stop()
+        controller.shutdown()
+        return times
+
+    def test_parallel_cross_connect(self):
+        xml, ((a, b), (c, d)) = self.make_cross_pairs_experiment()
+        
+        times = self.run_slow_cross_connect(xml, a, False)
+        # the other pair doesn't wait...
+        self.assertTrue(times["do_cross_connect_compl[%d]" % d][1]
+            < times["do_cross_connect_init[%d]" % a][1])
+        # ...but a's peer does
+        self.assertTrue(times["do_cross_connect_init[%d]" % b][0]
+            >= times["do_cross_connect_init[%d]" % a][1])
+        
+        times = self.run_slow_cross_connect(xml, a, True)
+        steps = sorted([ (start, name) 
+            for name, (start, end) in times.iteritems() 
+            if name.startswith("do_cross_connect") ])
+        self.assertEquals([ name for start, name in steps ],
+            [ "do_cross_connect_init[%d]" % guid for guid in (a, b, c, d) ]
+            + [ "do_cross_connect_compl[%d]" % guid for guid in (a, b, c, d) ])
+
+    def test_daemonized_proxy_cache(self):
+        exp_desc, desc, app, node1, node2, iface1, iface2 = self.make_test_experiment()
+        
+        desc.set_attribute_value(DC.DEPLOYMENT_MODE, DC.MODE_DAEMON)
+        inst_root_dir = os.path.join(self.root_dir, "instance")
+        os.mkdir(inst_root_dir)
+        desc.set_attribute_value(DC.ROOT_DIRECTORY, inst_root_dir)
+        
+        xml = exp_desc.to_xml()
+        
+        access_config = proxy.AccessConfiguration()
+        access_config.set_attribute_value(DC.DEPLOYMENT_MODE, DC.MODE_DAEMON)
+        access_config.set_attribute_value(DC.ROOT_DIRECTORY, self.root_dir)
+        access_config.set_attribute_value(DC.DEPLOYMENT_ENVIRONMENT_SETUP, 
+            "export PYTHONPATH=%r:%r:$PYTHONPATH "
+            "export NEPI_TESTBEDS='mock:mock mock2:mock2' " % (
+                os.path.dirname(os.path.dirname(mock.__file__)),
+                os.path.dirname(os.path.dirname(mock2.__file__)),))
+        controller = proxy.create_experiment_controller(xml, access_config)
+        
+        try:
+            controller.start()
+            for i in xrange(3):
+                self.assertEquals(controller.get_testbed_id(node1.guid), "mock")
+                self.assertEquals(controller.get_factory_id(node1.guid), "Node")
+            stats = controller.cache_stats()
+            self.assertEquals(stats["methods"]["get_testbed_id"], 
+                dict(hits = 2, misses = 1))
+            self.assertEquals(stats["methods"]["get_factory_id"], 
+                dict(hits = 2, misses = 1))
+            
+            # cached values are copies
+            guids = controller.guids
+            guids.append(-1)
+            self.assertTrue(-1 not in controller.guids)
+            
+            # deferred variants share the cache
+            self.assertEquals(
+                proxy.nepi.core.execute._undefer(
+                    controller.get_factory_id_deferred(node1.guid)),
+                "Node")
+            self.assertEquals(controller.cache_stats()["methods"]["get_factory_id"], 
+                dict(hits = 3, misses = 1))
+            
+            while not controller.is_finished(app.guid):
+                time.sleep(0.5)
+            
+            self.assertEquals(controller.stopped_time, None)
+            self.assertEquals(controller.stopped_time, None)
+            controller.stop()
+            # transitions drop phase-cached results, but not immutable ones
+            self.assertNotEquals(controller.stopped_time, None)
+            self.assertEquals(controller.get_testbed_id(node1.guid), "mock")
+            stats = controller.cache_stats()
+            self.assertEquals(stats["methods"]["stopped_time"], 
+                dict(hits = 1, misses = 2))
+            self.assertEquals(stats["methods"]["get_testbed_id"], 
+                dict(hits = 3, misses = 1))
+            
+            controller.invalidate_cache(phase_only = False)
+            self.assertEquals(controller.cache_stats()["entries"], 0)
+            self.assertEquals(controller.get_testbed_id(node1.guid), "mock")
+            self.assertTrue(controller.cache_stats()["hit_rate"] > 0.5)
+        finally:
+            controller.shutdown()
+
+    def test_daemonized_rpc_stats(self):
+        exp_desc, desc, app, node1, node2, iface1, iface2 = self.make_test_experiment()
+        
+        desc.set_attribute_value(DC.DEPLOYMENT_MODE, DC.MODE_DAEMON)
+        inst_root_dir = os.path.join(self.root_dir, "instance")
+        os.mkdir(inst_root_dir)
+        desc.set_attribute_value(DC.ROOT_DIRECTORY, inst_root_dir)
+        
+        xml = exp_desc.to_xml()
+        
+        access_config = proxy.AccessConfiguration()
+        access_config.set_attribute_value(DC.DEPLOYMENT_MODE, DC.MODE_DAEMON)
+        access_config.set_attribute_value(DC.ROOT_DIRECTORY, self.root_dir)
+        access_config.set_attribute_value(DC.DEPLOYMENT_ENVIRONMENT_SETUP, 
+            "export PYTHONPATH=%r:%r:$PYTHONPATH "
+            "export NEPI_TESTBEDS='mock:mock mock2:mock2' " % (
+                os.path.dirname(os.path.dirname(mock.__file__)),
+                os.path.dirname(os.path.dirname(mock2.__file__)),))
+        controller = proxy.create_experiment_controller(xml, access_config)
+        
+        enabled = rpcstats.ENABLED
+        try:
+            rpcstats.enable(False)
+            self.assertEquals(controller.stats(0)["methods"], {})
+            self.assertEquals(controller.client_stats()["methods"], {})
+            
+            # turn it on here and in the controller's server
+            rpcstats.enable()
+            controller.stats(1)
+            controller.start()
+            while not controller.is_finished(app.guid):
+                time.sleep(0.5)
+            self.assertRaises(RuntimeError, controller.get, 9999, "label")
+            
+            client = controller.client_stats()["methods"]
+            self.assertEquals(client["start"]["calls"], 1)
+            self.assertEquals(client["get"]["errors"], 1)
+            self.assertTrue(client["is_finished"]["bytes_in"] > 0)
+            self.assertEquals(sum(client["start"]["histogram"].values()), 1)
+            
+            server_stats = controller.stats()["methods"]
+            self.assertEquals(server_stats["start"]["calls"], 1)
+            self.assertEquals(server_stats["get"]["errors"], 1)
+            
+            stats = controller.rpc_stats()
+            self.assertEquals(len(stats["testbeds"]), 1)
+            for testbed_stats in stats["testbeds"].itervalues():
+                for side in ("client", "server"):
+                    self.assertEquals(
+                        testbed_stats[side]["methods"]["do_setup"]["calls"], 1)
+            
+            path = controller.dump_rpc_stats(None)
+            self.assertEquals(os.path.dirname(path), self.root_dir)
+            dumped = json.load(open(path))
+            self.assertEquals(len(dumped["testbeds"]), 1)
+            
+            controller.stop()
+        finally:
+            rpcstats.enable(enabled)
+            controller.shutdown()
+
+    def test_deployment_timeline(self):
+        exp_desc, desc1, desc2, iface12, iface21 = \
+                self.make_cross_test_experiment()
+        desc1.set_attribute_value(DC.DEPLOYMENT_MODE, DC.MODE_DAEMON)
+        inst_root_dir = os.path.join(self.root_dir, "instance")
+        os.mkdir(inst_root_dir)
+        desc1.set_attribute_value(DC.ROOT_DIRECTORY, inst_root_dir)
+        desc1.set_attribute_value(DC.DEPLOYMENT_ENVIRONMENT_SETUP, 
+            "export PYTHONPATH=%r:%r:$PYTHONPATH "
+            "export NEPI_TESTBEDS='mock:mock mock2:mock2' " % (
+                os.path.dirname(os.path.dirname(mock.__file__)),
+                os.path.dirname(os.path.dirname(mock2.__file__)),))
+        xml = exp_desc.to_xml()
+        
+        controller = ExperimentController(xml, self.root_dir)
+        controller.start()
+        
+        # only dumped when asked to
+        path = os.path.join(self.root_dir, "experiment-timeline.json")
+        self.assertFalse(os.path.exists(path))
+        self.assertEquals(controller.dump_timeline(), path)
+        trace = json.load(open(path))
+        events = trace["traceEvents"]
+        processes = dict([ (event["pid"], event["args"]["name"])
+            for event in events if event["name"] == "process_name" ])
+        self.assertEquals(processes, {
+            0 : "experiment controller",
+            desc1.guid : "testbed %d (mock)" % (desc1.guid,),
+            desc2.guid : "testbed %d (mock2)" % (desc2.guid,) })
+        
+        spans = dict([ ((event["pid"], event["tid"], event["name"]), event)
+            for event in events if event["ph"] == "X" ])
+        for event in spans.itervalues():
+            self.assertTrue(event["ts"] >= 0 and event["dur"] >= 0)
+        deploy = spans[(0, 0, "deploy")]
+        for guid in (desc1.guid, desc2.guid):
+            for name in ("bootstrap", "do_setup", "do_cross_connect_init", "start"):
+                phase = spans[(0, guid, "%s[%d]" % (name, guid))]
+                self.assertEquals(phase["cat"], "phase")
+                self.assertTrue(deploy["ts"] <= phase["ts"])
+                self.assertTrue(phase["ts"] + phase["dur"] 
+                    <= deploy["ts"] + deploy["dur"])
+        self.assertTrue((0, 0, "persist_execute_data") in spans)
+        
+        # the testbed daemon's steps and actions are there too
+        names = set([ (event["pid"], event["name"], event["cat"]) 
+            for event in spans.itervalues() ])
+        for guid in (desc1.guid, desc2.guid):
+            self.assertTrue((guid, "Node", "create_function") in names)
+        self.assertTrue((desc1.guid, "Interface[%d]" % iface12.guid, 
+            "create_function") in names)
+        
+        controller.stop()
+        controller.shutdown()
+
+    def test_daemonized_bulk_queries(self):
+        exp_desc, desc1, desc2, iface12, iface21 = \
+                self.make_cross_test_experiment()
+        for desc in (desc1, desc2):
+            desc.set_attribute_value(DC.DEPLOYMENT_MODE, DC.MODE_DAEMON)
+            inst_root_dir = os.path.join(self.root_dir, "instance%d" % desc.guid)
+            os.mkdir(inst_root_dir)
+            desc.set_attribute_value(DC.ROOT_DIRECTORY, inst_root_dir)
+        
+        xml = exp_desc.to_xml()
+        
+        access_config = proxy.AccessConfiguration()
+        access_config.set_attribute_value(DC.DEPLOYMENT_MODE, DC.MODE_DAEMON)
+        access_config.set_attribute_value(DC.ROOT_DIRECTORY, self.root_dir)
+        access_config.set_attribute_value(DC.DEPLOYMENT_ENVIRONMENT_SETUP, 
+            "export PYTHONPATH=%r:%r:$PYTHONPATH "
+            "export NEPI_TESTBEDS='mock:mock mock2:mock2' " % (
+                os.path.dirname(os.path.dirname(mock.__file__)),
+                os.path.dirname(os.path.dirname(mock2.__file__)),))
+        controller = proxy.create_experiment_controller(xml, access_config)
+        
+        enabled = rpcstats.ENABLED
+        try:
+            rpcstats.enable()
+            controller.stats(1)
+            controller.start()
+            
+            apps = [ guid for guid in controller.guids
+                if controller.get_factory_id(guid) == "Application" ]
+            self.assertEquals(len(apps), 2)
+            self.assertTrue(controller.wait_for(apps))
+            
+            guids = sorted(controller.guids) + [desc1.guid, 9999]
+            self.assertEquals(controller.status_many(guids),
+                [ controller.status(guid) for guid in guids ])
+            self.assertTrue(controller.is_finished_all(apps))
+            self.assertFalse(controller.is_finished_all(apps + [iface12.guid]))
+            self.assertRaises(RuntimeError, controller.is_finished_all, [9999])
+            self.assertEquals(
+                controller.get_many(iface12.guid, ["fake", "cross", "label"]),
+                [ controller.get(iface12.guid, name) 
+                  for name in ("fake", "cross", "label") ])
+            self.assertRaises(RuntimeError, controller.get_many, 9999, ["label"])
+            
+            # a single call to each testbed
+            stats = controller.rpc_stats()
+            for testbed_stats in stats["testbeds"].itervalues():
+                methods = testbed_stats["server"]["methods"]
+                self.assertEquals(methods["status_many"]["calls"], 1)
+                self.assertEquals(methods["is_finished_all"]["calls"], 2)
+            
+            controller.stop()
+        finally:
+            rpcstats.enable(enabled)
+            controller.shutdown()
+
     def test_daemonized_all_integration_recovery(self):
         exp_desc, desc, app, node1, node2, iface1, iface2 = self.make_test_experiment()
         
@@ -282,6 +939,66 @@ class ExecuteTestCase(unittest.TestCase):
         controller.stop()
         controller.shutdown()
 
+    def test_journaled_recovery(self):
+        exp_desc, desc1, desc2, iface12, iface21 = \
+                self.make_cross_test_experiment()
+        for desc in (desc1, desc2):
+            inst_root_dir = os.path.join(self.root_dir, "instance%d" % desc.guid)
+            os.mkdir(inst_root_dir)
+            desc.set_attribute_value(DC.DEPLOYMENT_MODE, DC.MODE_DAEMON)
+            desc.set_attribute_value(DC.ROOT_DIRECTORY, inst_root_dir)
+            desc.set_attribute_value(DC.DEPLOYMENT_ENVIRONMENT_SETUP, 
+                "export PYTHONPATH=%r:%r:$PYTHONPATH "
+                "export NEPI_TESTBEDS='mock:mock mock2:mock2' " % (
+                    os.path.dirname(os.path.dirname(mock.__file__)),
+                    os.path.dirname(os.path.dirname(mock2.__file__)),))
+        xml = exp_desc.to_xml()
+        
+        controller = ExperimentController(xml, self.root_dir)
+        controller.start()
+        records = controller._journal.load()
+        for desc in (desc1, desc2):
+            for step in ("do_setup", "do_configure", "do_cross_connect_compl", 
+                    "start"):
+                self.assertTrue(("phase", desc.guid, step) in records)
+        
+        def recover(controller):
+            # the controller dies, testbeds live on
+            for testbed in controller._testbeds.values():
+                testbed._client.close()
+            controller._pool.close()
+            controller = ExperimentController(None, self.root_dir)
+            controller.recover()
+            return controller
+        
+        # nothing left to do
+        controller = recover(controller)
+        self.assertEquals(controller._journal.load(), records)
+        self.assertEquals(controller.get_testbed_id(iface12.guid), "mock")
+        
+        # died before starting testbed 1
+        journal_path = controller._journal.path
+        controller._journal.reset()
+        for record in records:
+            if record != ("phase", desc1.guid, "start"):
+                controller._journal.record(*record)
+        controller._journal.close()
+        controller = recover(controller)
+        records = controller._journal.load()
+        self.assertEquals(records[-1], ("phase", desc1.guid, "start"))
+        self.assertEquals(records.count(("phase", desc1.guid, "start")), 1)
+        
+        # no journal, all cross connection steps and netrefs are redone
+        os.remove(journal_path)
+        controller = recover(controller)
+        records = controller._journal.load()
+        for desc in (desc1, desc2):
+            for step in ("do_cross_connect_init", "do_cross_connect_compl"):
+                self.assertTrue(("phase", desc.guid, step) in records)
+        
+        controller.stop()
+        controller.shutdown()
+
     def test_reference_expressions(self):
         exp_desc, desc, app, node1, node2, iface1, iface2 = self.make_test_experiment()
         
@@ -347,6 +1064,194 @@ class ExecuteTestCase(unittest.TestCase):
         controller.stop()
         controller.shutdown()
 
+    def test_netref_resolution(self):
+        exp_desc = ExperimentDescription()
+        exp_desc, desc1, app1, node11, node12, iface11, iface12 = \
+                self.make_testbed(exp_desc, "mock")
+        exp_desc, desc2, app2, node21, node22, iface21, iface22 = \
+                self.make_testbed(exp_desc, "mock")
+        
+        iface11.set_attribute_value("label", "some")
+        addr = iface11.add_address()
+        addr.set_attribute_value("Address", "10.0.0.2")
+        iface12.set_attribute_value("label", "other")
+        iface12.set_attribute_value("test", "{#[some].addr[0].[Address]#}")
+        # refers to another netreffed attribute, in another testbed
+        iface21.set_attribute_value("test", "{#[other].[test]#}")
+        iface22.set_attribute_value("test", 
+            "{#[other].[test]#} {#[some].addr[0].[Address]#}")
+        xml = exp_desc.to_xml()
+        
+        found = []
+        class LookupController(ExperimentController):
+            def _lookup_netrefs(self, keys):
+                known = set(self._netref_values)
+                super(LookupController, self)._lookup_netrefs(keys)
+                found.extend(set(self._netref_values) - known)
+        
+        controller = LookupController(xml, self.root_dir)
+        controller.start()
+        self.assertEquals(controller.get(iface12.guid, "test"), "10.0.0.2")
+        self.assertEquals(controller.get(iface21.guid, "test"), "10.0.0.2")
+        self.assertEquals(controller.get(iface22.guid, "test"), 
+            "10.0.0.2 10.0.0.2")
+        # referenced values are fetched once, and reused
+        self.assertEquals(len(found), len(set(found)))
+        self.assertFalse(controller._netrefs)
+        
+        # even across deployment stages
+        addr_key = Netref.make_key(iface11.guid, "Address", "addr", "0")
+        self.assertTrue(addr_key in found)
+        controller._clear_caches()
+        self.assertEquals(controller.resolve_netref_value(
+            "{#[GUID-%d].addr[0].[Address]#}" % iface11.guid), "10.0.0.2")
+        self.assertEquals(found.count(addr_key), 1)
+        
+        # failed lookups aren't taken as unresolved netrefs
+        self.assertRaises(RuntimeError, controller.resolve_netref_value,
+            "{#[GUID-%d].addr[5].[Address]#}" % iface11.guid)
+        
+        # written attributes are looked up again
+        controller.set(iface12.guid, "test", "10.0.0.3")
+        self.assertEquals(controller.resolve_netref_value(
+            "{#[GUID-%d].[test]#}" % iface12.guid), "10.0.0.3")
+        
+        for app in (app1, app2):
+            while not controller.is_finished(app.guid):
+                time.sleep(0.5)
+        controller.stop()
+        controller.shutdown()
+
+    def test_execute_xml(self):
+        exp_desc, desc, app, node1, node2, iface1, iface2 = self.make_test_experiment()
+        node1.set_attribute_value("label", "node1")
+        xml = exp_desc.to_xml()
+        
+        controller = ExperimentController(xml, self.root_dir)
+        controller.start()
+        
+        # same as regenerating it all
+        parser = XmlExperimentParser()
+        data = parser.from_xml_to_data(xml)
+        testbed = controller._testbeds[desc.guid]
+        for guid in testbed.guids:
+            for name in testbed.get_attribute_list(guid, Attribute.ExecImmutable):
+                value = testbed.get(guid, name)
+                if value is not None:
+                    data.add_attribute_data(guid, name, value)
+        execute_xml = controller.experiment_execute_xml
+        self.assertEquals(execute_xml, parser.to_xml(data = data))
+        self.assertTrue('value="node1"' in execute_xml)
+        
+        # updates only regenerate what changed
+        controller._update_execute_xml()
+        self.assertTrue(controller.experiment_execute_xml is execute_xml)
+        del controller._execute_snapshot[node1.guid]
+        controller._update_execute_xml()
+        self.assertEquals(controller.experiment_execute_xml, execute_xml)
+        
+        path = os.path.join(self.root_dir, "experiment-execute.xml")
+        self.assertEquals(open(path).read(), execute_xml)
+        
+        while not controller.is_finished(app.guid):
+            time.sleep(0.5)
+        controller.stop()
+        controller.shutdown()
+
+    def test_parse_once(self):
+        exp_desc, desc, app, node1, node2, iface1, iface2 = self.make_test_experiment()
+        iface2.set_attribute_value("label", "iface2")
+        iface1.set_attribute_value("test", "{#[iface2].addr[0].[Address]#}")
+        iface2.add_address()
+        iface2.addresses[0].set_attribute_value("Address", "10.0.0.2")
+        xml = exp_desc.to_xml()
+        
+        parsed = []
+        from_xml_to_data = XmlExperimentParser.from_xml_to_data
+        def counting_from_xml_to_data(parser, xml):
+            parsed.append(xml)
+            return from_xml_to_data(parser, xml)
+        XmlExperimentParser.from_xml_to_data = counting_from_xml_to_data
+        try:
+            controller = ExperimentController(xml, self.root_dir)
+            controller.start()
+            controller._testbed_recovery_policy(desc.guid)
+            self.assertEquals(parsed, [xml])
+        finally:
+            XmlExperimentParser.from_xml_to_data = from_xml_to_data
+        
+        # the parsed design is never modified, only copies of the 
+        # elements modified through the views
+        self.assertEquals(controller.get(iface1.guid, "test"), "10.0.0.2")
+        base = controller._parsed_data.values()[0]
+        self.assertEquals(base.get_attribute_data(iface1.guid, "test"), 
+            "{#[iface2].addr[0].[Address]#}")
+        self.assertTrue(controller._execute_data.data[node1.guid] 
+            is base.data[node1.guid])
+        view = controller._experiment_data(xml)
+        view.add_attribute_data(node1.guid, "label", "node1")
+        self.assertEquals(view.get_attribute_data(node1.guid, "label"), "node1")
+        self.assertEquals(base.get_attribute_data(node1.guid, "label"), None)
+        
+        controller.stop()
+        controller.shutdown()
+
+    def test_experiment_suite_scheduling(self):
+        exp_desc, desc, app, node1, node2, iface1, iface2 = self.make_test_experiment()
+        xml = exp_desc.to_xml()
+        access_config = proxy.AccessConfiguration()
+        access_config.set_attribute_value(DC.ROOT_DIRECTORY, self.root_dir)
+        
+        running = [0]
+        peak = [0]
+        current = []
+        lock = threading.Lock()
+        
+        class FakeSuite(ExperimentSuite):
+            def _run_one_experiment(self, repetition):
+                self._access_configs[repetition] = repetition
+                self._running.add(repetition)
+                current.append(repetition in self.current() and
+                    repetition in self.get_current_access_config())
+                with lock:
+                    running[0] += 1
+                    peak[0] = max(peak[0], running[0])
+                time.sleep(0.2)
+                with lock:
+                    running[0] -= 1
+                if repetition == 2:
+                    raise RuntimeError("boom")
+        
+        def run(**kw):
+            peak[0] = 0
+            suite = FakeSuite(xml, access_config, repetitions = 5, **kw)
+            suite.start()
+            while not suite.is_finished():
+                time.sleep(0.1)
+            suite.shutdown()
+            return suite.metrics()
+        
+        metrics = run(max_parallel = 3)
+        self.assertEquals(peak[0], 3)
+        self.assertEquals([ m['repetition'] for m in metrics ], range(1, 6))
+        for m in metrics:
+            self.assertTrue(m['wall_time'] >= 0.2)
+            self.assertTrue(m['queued'] >= 0)
+            self.assertEquals(m['error'] is not None, m['repetition'] == 2)
+        # the last ones waited for a free slot
+        self.assertTrue(max([ m['queued'] for m in metrics ]) >= 0.2)
+        # running repetitions are all current
+        self.assertEquals(current, [True] * 5)
+        
+        # a single mock testbed instance at once serializes repetitions
+        metrics = run(max_parallel = 3, capacity = dict(mock = 1))
+        self.assertEquals(peak[0], 1)
+        self.assertEquals(len(metrics), 5)
+        
+        for capacity in (0, -1, 1.5):
+            self.assertRaises(ValueError, FakeSuite, xml, access_config,
+                capacity = dict(mock = capacity))
+
     def test_ssh_daemonized_integration(self):
         exp_desc, desc, app, node1, node2, iface1, iface2 = self.make_test_experiment()
         env = test_util.test_environment()
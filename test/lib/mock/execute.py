@@ -2,13 +2,18 @@
 
 from constants import TESTBED_ID, TESTBED_VERSION
 from nepi.core import testbed_impl
+import os
+import time
 
 class TestbedController(testbed_impl.TestbedController):
     def __init__(self):
         super(TestbedController, self).__init__(TESTBED_ID, TESTBED_VERSION)
 
     def do_configure(self):
-        pass
+        # lets tests keep the testbed busy configuring
+        delay = float(os.environ.get("MOCK_CONFIGURE_DELAY", 0))
+        if delay:
+            time.sleep(delay)
 
     def action(self, time, guid, action):
         raise NotImplementedError
@@ -22,9 +27,14 @@ class TestbedController(testbed_impl.TestbedController):
 """
         elif attribute == 'path':
             return '<test>'
+        elif attribute == 'size':
+            return str(len(self.trace(guid, trace_id)))
         else:
             return None
 
+    def read_trace(self, guid, trace_id, offset, length):
+        return self.trace(guid, trace_id)[offset:offset+length]
+
     def shutdown(self):
 	    pass
 
@@ -22,9 +22,14 @@ class TestbedController(testbed_impl.TestbedController):
 """
         elif attribute == 'path':
             return '<test>'
+        elif attribute == 'size':
+            return str(len(self.trace(guid, trace_id)))
         else:
             return None
 
+    def read_trace(self, guid, trace_id, offset, length):
+        return self.trace(guid, trace_id)[offset:offset+length]
+
     def shutdown(self):
 	    pass
 
@@ -48,6 +48,10 @@ def pl_auth():
     else:
         return None
 
+def benchmarks_enabled():
+    # timing comparisons are too noisy for shared or loaded test hosts
+    return "NEPI_BENCHMARKS" in os.environ
+
 def find_bin(name, extra_path = None):
     search = []
     if "PATH" in os.environ:
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from nepi.util import codec
+from nepi.util.proxy import Marshalling, MarshallingCodec, BinaryCodec, \
+        TestbedControllerServer, ExperimentControllerServer, OK
+import test_util
+import time
+import unittest
+
+class CodecTestCase(unittest.TestCase):
+    def test_roundtrip(self):
+        values = [
+            None, True, False, 0, 1, -1, 127, -128, 128, 70000, -70000,
+            1 << 40, -(1 << 40), 1 << 70, -(1 << 70), 3.25, -1e300,
+            "", "a", "\x00\xff|\n ", "x" * 300, u"", u"ñandú",
+            [], [1, "a", None], (), (1, (2, (3,))), set([1,2]),
+            frozenset(["a"]), {}, {1 : {"a" : [1.5, None]}, "b" : ()},
+            # pickled fallback
+            Exception("boom"),
+        ]
+        for value in values:
+            data = codec.dumps(value)
+            rv = codec.loads(data)
+            self.assertEquals(type(rv), type(value))
+            if isinstance(value, Exception):
+                self.assertEquals(rv.args, value.args)
+            else:
+                self.assertEquals(rv, value)
+
+    def test_compact(self):
+        import base64, cPickle
+        value = {"a" : [1, 2, "bcd"], 2 : None}
+        self.assertTrue(len(codec.dumps(value)) 
+            < len(base64.b64encode(cPickle.dumps(value))))
+        self.assertEquals(codec.dumps(value)[0], "M")
+        self.assertEquals(codec.dumps([Exception()])[0], "P")
+
+    def test_malformed(self):
+        for value in ({"a" : [1, 2, "bcd"]}, [Exception("boom")]):
+            data = codec.dumps(value)
+            for i in xrange(len(data)):
+                self.assertRaises(ValueError, codec.loads, data[:i])
+        self.assertRaises(ValueError, codec.loads, "Z")
+
+    def test_message(self):
+        msg = codec.encode_message(23, (2, "label", " trailing \n"))
+        self.assertTrue(codec.is_message(msg))
+        self.assertFalse(codec.is_message("23|2|label"))
+        self.assertEquals(codec.message_code(msg), 23)
+        self.assertEquals(codec.decode_message(msg),
+            (23, (2, "label", " trailing \n")))
+
+    def test_binary_codec_normalizes(self):
+        handler = TestbedControllerServer.get_attribute_list
+        msg = BinaryCodec.make_message(handler._argtypes, handler._argencoders,
+            1, "get_attribute_list", "TestbedControllerServer", 5L, None, 0)
+        self.assertEquals(codec.decode_message(msg), (1, (5, None, False)))
+        self.assertRaises(ValueError, BinaryCodec.make_message,
+            handler._argtypes, handler._argencoders,
+            1, "get_attribute_list", "TestbedControllerServer", 5)
+        self.assertRaises(TypeError, BinaryCodec.make_message,
+            handler._argtypes, handler._argencoders,
+            1, "get_attribute_list", "TestbedControllerServer", "x", None, 0)
+
+class CodecBenchmarkTestCase(unittest.TestCase):
+    """
+    Compares the full round trip of a call (client encoding, server
+    decoding and reply encoding, client decoding) with both codecs,
+    for representative payloads.
+    """
+    REPEAT = 200
+
+    def make_payloads(self):
+        attribute_list = [ "attr%d" % i for i in xrange(15) ]
+        traces_info = dict([
+            (guid, dict([
+                (trace_id, dict(host = "node%d.example.org" % guid,
+                    user = "inria_nepi",
+                    filepath = "/home/inria_nepi/%d/%s" % (guid, trace_id),
+                    filesize = 12345 * guid))
+                for trace_id in ("stdout", "stderr", "pcap") ]))
+            for guid in xrange(100) ])
+        cross_data = dict([
+            (testbed_guid, dict([
+                (guid, dict([
+                    ("_guid", guid), ("_testbed_guid", testbed_guid),
+                    ("_testbed_id", "planetlab"), ("_testbed_version", "0.1"),
+                    ("hostname", "node%d.example.org" % guid),
+                    ("tun_addr", "192.168.%d.%d" % (testbed_guid, guid)),
+                    ("tun_port", 15000 + guid), ("tun_key", "x" * 32),
+                    ("up", True), ("mtu", 1500) ]))
+                for guid in xrange(50) ]))
+            for testbed_guid in (1, 2) ])
+        return [
+            ("get_attribute_list", TestbedControllerServer.get_attribute_list,
+                (5, None, False), attribute_list),
+            ("traces_info", ExperimentControllerServer.traces_info,
+                (), traces_info),
+            ("do_cross_connect_init", TestbedControllerServer.do_cross_connect_init,
+                (cross_data,), None),
+        ]
+
+    def text_roundtrip(self, handler, args, rv):
+        msg = MarshallingCodec.make_message(handler._argtypes,
+            handler._argencoders, 1, "meth", "Server", *args)
+        params = msg.split("|")
+        args = [ ctor(val) for ctor,val in zip(handler._argtypes, params[1:]) ]
+        if handler._retval is None:
+            reply = "%d|" % (OK,)
+        else:
+            encode, fmt = Marshalling._TYPE_ENCODERS.get(
+                handler._retval.__name__,
+                Marshalling._TYPE_ENCODERS[None])
+            reply = ("%d|" + fmt) % (OK, encode(rv))
+        MarshallingCodec.parse_reply(handler._retval, "meth", "Server", reply)
+        return len(msg) + len(reply)
+
+    def binary_roundtrip(self, handler, args, rv):
+        msg = BinaryCodec.make_message(handler._argtypes,
+            handler._argencoders, 1, "meth", "Server", *args)
+        code, args = codec.decode_message(msg)
+        reply = codec.encode_message(OK, Marshalling.normalize(handler._retval, rv))
+        BinaryCodec.parse_reply(handler._retval, "meth", "Server", reply)
+        return len(msg) + len(reply)
+
+    def test_binary_smaller(self):
+        for name, handler, args, rv in self.make_payloads():
+            text_size = self.text_roundtrip(handler, args, rv)
+            binary_size = self.binary_roundtrip(handler, args, rv)
+            self.assertTrue(binary_size < text_size, name)
+
+    @test_util.skipUnless(test_util.benchmarks_enabled(),
+            "Set NEPI_BENCHMARKS to run benchmarks")
+    def test_binary_faster(self):
+        for name, handler, args, rv in self.make_payloads():
+            times = []
+            for roundtrip in (self.text_roundtrip, self.binary_roundtrip):
+                # best of several runs, in CPU time, to filter out noise
+                best = None
+                for run in xrange(5):
+                    start = time.clock()
+                    for i in xrange(self.REPEAT):
+                        roundtrip(handler, args, rv)
+                    elapsed = time.clock() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                times.append(best)
+            text_time, binary_time = times
+            self.assertTrue(binary_time < text_time * 0.9, name)
+
+if __name__ == '__main__':
+    unittest.main()
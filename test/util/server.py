@@ -1,18 +1,35 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from nepi.util import server
+from nepi.util import server, defer
 from nepi.util.constants import DeploymentConfiguration as DC
 
 import getpass
+import hashlib
 import os
 import shutil
+import socket
+import StringIO
+import subprocess
 import sys
+import tarfile
 import tempfile
 import test_util
+import threading
 import unittest
 import time
 
+class SlowServer(server.Server):
+    def dispatch(self, msg, reply_to):
+        if msg == "slow":
+            self._slow = threading.Timer(1, reply_to, [self.reply_action(msg)])
+            self._slow.start()
+        else:
+            super(SlowServer, self).dispatch(msg, reply_to)
+
+    def sync(self):
+        self._slow.join()
+
 class ServerTestCase(unittest.TestCase):
     def setUp(self):
         self.root_dir = tempfile.mkdtemp()
@@ -66,7 +83,7 @@ class ServerTestCase(unittest.TestCase):
     def test_server_auto_reconnect(self):
         s = server.Server(self.root_dir)
         s.run()
-        c = server.Client(self.root_dir)
+        c = server.Client(self.root_dir, direct = False)
         
         c.send_msg("Hola")
         reply = c.read_reply()
@@ -86,6 +103,302 @@ class ServerTestCase(unittest.TestCase):
         reply = c.read_reply()
         self.assertEqual(reply, "Stopping server")
 
+    def test_server_direct_auto_reconnect(self):
+        s = server.Server(self.root_dir)
+        s.run()
+        c = server.Client(self.root_dir)
+        self.assertTrue(c._process is None)
+        
+        c.send_msg("Hola")
+        reply = c.read_reply()
+        self.assertEqual(reply, "Reply to: Hola")
+        
+        # purposedly break the connection
+        c._sock.shutdown(socket.SHUT_RDWR)
+        
+        # assert that the communication works (possible with auto-reconnection)
+        c.send_msg("Hola")
+        reply = c.read_reply()
+        self.assertEqual(reply, "Reply to: Hola")
+                
+        c.send_stop()
+        reply = c.read_reply()
+        self.assertEqual(reply, "Stopping server")
+
+    def test_server_forwarder(self):
+        s = server.Server(self.root_dir)
+        s.run()
+        c = server.Client(self.root_dir, direct = False)
+        self.assertTrue(c._process is not None)
+        self.assertEqual(c._proto, server.PROTOCOL_VERSION)
+        msg = "".join(map(chr, xrange(256))) * 64
+        c.send_msg(msg)
+        reply = c.read_reply()
+        self.assertEqual(reply, ("Reply to: "+msg))
+        c.send_stop()
+        reply = c.read_reply()
+        self.assertEqual(reply, "Stopping server")
+
+    def test_client_direct_startup(self):
+        s = server.Server(self.root_dir)
+        s.run()
+        
+        for direct in (True, False):
+            c = server.Client(self.root_dir, direct = direct)
+            c.send_msg("Hola")
+            self.assertEqual(c.read_reply(), "Reply to: Hola")
+            if direct:
+                # direct connections spare a forwarder process
+                self.assertTrue(c._process is None)
+                self.assertTrue(c._sock is not None)
+            else:
+                self.assertTrue(c._process is not None)
+                self.assertTrue(c._process.poll() is None)
+            c.close()
+        
+        c = server.Client(self.root_dir)
+        c.send_stop()
+        reply = c.read_reply()
+        self.assertEqual(reply, "Stopping server")
+
+    def test_zygote(self):
+        zygote = server.Zygote()
+        try:
+            out = zygote.spawn(
+                "from nepi.util import server;"
+                "s = server.Server(%r);"
+                "s.run()" % (self.root_dir,),
+                preload = ("nepi.util.proxy",))
+            self.assertTrue("SERVER_READY." in out.splitlines())
+            
+            c = server.Client(self.root_dir)
+            c.send_msg("Hola")
+            reply = c.read_reply()
+            self.assertEqual(reply, "Reply to: Hola")
+            c.send_stop()
+            reply = c.read_reply()
+            self.assertEqual(reply, "Stopping server")
+            
+            # launched code's errors are reported in its output
+            out = zygote.spawn("raise RuntimeError('boom')")
+            self.assertTrue("RuntimeError: boom" in out)
+            self.assertTrue(zygote.alive())
+        finally:
+            zygote.close()
+        self.assertFalse(zygote.alive())
+
+    def test_zygote_preload(self):
+        zygote = server.Zygote(preload = ("nepi.util.proxy",))
+        try:
+            out = zygote.spawn(
+                "import sys;"
+                "print 'nepi.util.proxy' in sys.modules")
+            self.assertEqual(out, "True\n")
+        finally:
+            zygote.close()
+
+    def test_zygote_launch(self):
+        python_code = ("import os, sys;"
+            "sys.stderr.write('PARENT %%d\\n' %% os.getppid());"
+            "sys.stderr.write('PRELOADED %%s\\n' %% ('mock.metadata' in sys.modules));"
+            "from nepi.util.proxy import TestbedControllerServer;"
+            "s = TestbedControllerServer(%r, 'Error', 'mock', '0.1', '', False);"
+            "s.run()")
+        
+        # zygotes keep the environment they were started with
+        environ = os.environ.copy()
+        os.environ["NEPI_TESTBEDS"] = "mock:mock"
+        zygote = server.Zygote()
+        try:
+            zygote_pid = zygote._process.pid
+            for i in xrange(2):
+                root_dir = os.path.join(self.root_dir, "zygote" + str(i))
+                out = zygote.spawn(python_code % (root_dir,), 
+                    preload = ("nepi.util.proxy", "nepi.core.execute", 
+                        "mock", "mock.metadata")).splitlines()
+                self.assertTrue("SERVER_READY." in out)
+                
+                # launches are forks of the same zygote, which imported 
+                # the preload modules before forking
+                self.assertTrue("PARENT %d" % (zygote_pid,) in out)
+                self.assertTrue("PRELOADED True" in out)
+                self.assertTrue(zygote.alive())
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            zygote.close()
+            for name in os.listdir(self.root_dir):
+                c = server.Client(os.path.join(self.root_dir, name))
+                c.send_stop()
+                c.read_reply()
+                c.close()
+
+    def test_communicate(self):
+        data = "".join([ "line %d\n" % i for i in xrange(100000) ])
+        lines = []
+        proc = subprocess.Popen(["cat"], 
+            stdin = subprocess.PIPE, 
+            stdout = subprocess.PIPE, 
+            stderr = subprocess.PIPE)
+        out, err = server._communicate(proc, data + "unterminated",
+            stdout_callback = lines.append,
+            spill = 4096)
+        self.assertEquals(out, data + "unterminated")
+        self.assertEquals(err, "")
+        self.assertEquals(len(lines), 100001)
+        self.assertEquals(lines[12345], "line 12345")
+        self.assertEquals(lines[-1], "unterminated")
+        self.assertEquals(proc.returncode, 0)
+
+    def test_communicate_spill(self):
+        spool = server.OutputSpool(spill = 10)
+        spool.write("0123456789")
+        self.assertFalse(spool.spilled)
+        spool.write("abc")
+        self.assertTrue(spool.spilled)
+        self.assertEquals(len(spool), 13)
+        self.assertEquals(spool.getvalue(), "0123456789abc")
+        f = spool.open()
+        self.assertEquals(f.read(4), "0123")
+        f.close()
+        self.assertEquals(spool.head(4), "0123")
+
+    def test_communicate_spooled(self):
+        proc = subprocess.Popen(["seq", "1", "10000"], 
+            stdout = subprocess.PIPE, 
+            stderr = subprocess.PIPE)
+        out, err = server._communicate(proc, None, spill = 1024, 
+            spooled = True)
+        self.assertTrue(out.spilled)
+        self.assertEquals(len(err), 0)
+        lines = list(out)
+        self.assertEquals(len(lines), 10000)
+        self.assertEquals(lines[-1], "10000\n")
+
+    def test_communicate_timeout(self):
+        proc = subprocess.Popen(["sh", "-c", "echo started; sleep 10"], 
+            stdout = subprocess.PIPE, 
+            stderr = subprocess.PIPE)
+        start = time.time()
+        out, err = server._communicate(proc, None, timeout = 0.5)
+        self.assertTrue(time.time() - start < 5)
+        self.assertEquals(out, "started\n")
+        self.assertNotEquals(proc.returncode, 0)
+
+    def test_communicator_many(self):
+        threads = threading.activeCount()
+        communicator = server.Communicator()
+        comms = []
+        errlines = []
+        for i in xrange(200):
+            proc = subprocess.Popen(["sh", "-c", 
+                    "seq 1 1000; echo %d done >&2; cat" % (i,)],
+                stdin = subprocess.PIPE, 
+                stdout = subprocess.PIPE, 
+                stderr = subprocess.PIPE)
+            comms.append(communicator.add(proc, "in%d" % (i,), timeout = 60,
+                stderr_callback = errlines.append, spill = 1024))
+        communicator.run()
+        self.assertEquals(threading.activeCount(), threads)
+        
+        expected = "".join([ "%d\n" % i for i in xrange(1, 1001) ])
+        for i, comm in enumerate(comms):
+            self.assertTrue(comm.done)
+            self.assertTrue(comm.stdout.spilled)
+            out, err = comm.result()
+            self.assertEquals(out, expected + "in%d" % (i,))
+            self.assertEquals(err, "%d done\n" % (i,))
+            self.assertEquals(comm.proc.returncode, 0)
+        self.assertEquals(sorted(errlines), 
+            sorted([ "%d done" % (i,) for i in xrange(200) ]))
+
+    def test_push_files(self):
+        src_dir = os.path.join(self.root_dir, "src")
+        os.mkdir(src_dir)
+        sources = []
+        for i in xrange(5):
+            path = os.path.join(src_dir, "file%d" % (i,))
+            f = open(path, "w")
+            f.write("contents %d\n" % (i,) * 1000)
+            f.close()
+            sources.append(path)
+        os.chmod(sources[0], 0755)
+        sources.append(("known_hosts", StringIO.StringIO("host key\n")))
+        
+        targets = [ os.path.join(self.root_dir, "dst%d" % (i,)) 
+                    for i in xrange(10) ]
+        stats = server.push_files(sources, targets, max_parallel = 4)
+        
+        self.assertEquals(sorted(stats.keys()), sorted(targets))
+        for target in targets:
+            self.assertEquals(stats[target]['files'], 6)
+            self.assertEquals(stats[target]['skipped'], 0)
+            self.assertTrue(stats[target]['bytes'] > 5000)
+            for i in xrange(5):
+                f = open(os.path.join(target, "file%d" % (i,)))
+                self.assertEquals(f.read(), "contents %d\n" % (i,) * 1000)
+                f.close()
+            self.assertTrue(os.access(os.path.join(target, "file0"), os.X_OK))
+            f = open(os.path.join(target, "known_hosts"))
+            self.assertEquals(f.read(), "host key\n")
+            f.close()
+        
+        # up to date files are skipped
+        f = open(os.path.join(targets[0], "file1"), "w")
+        f.write("changed")
+        f.close()
+        sources[-1] = ("known_hosts", StringIO.StringIO("host key\n"))
+        stats = server.push_files(sources, targets)
+        self.assertEquals(stats[targets[0]]['files'], 1)
+        self.assertEquals(stats[targets[0]]['skipped'], 5)
+        self.assertEquals(stats[targets[1]]['files'], 0)
+        self.assertEquals(stats[targets[1]]['bytes'], 0)
+        f = open(os.path.join(targets[0], "file1"))
+        self.assertEquals(f.read(), "contents 1\n" * 1000)
+        f.close()
+        
+        # failures are reported once all targets are done
+        blocker = os.path.join(self.root_dir, "blocker")
+        open(blocker, "w").close()
+        sources[-1] = ("known_hosts", StringIO.StringIO("host key\n"))
+        self.assertRaises(RuntimeError, server.push_files, sources, 
+            [blocker, os.path.join(self.root_dir, "dst10")])
+        self.assertTrue(os.path.exists(
+            os.path.join(self.root_dir, "dst10", "known_hosts")))
+
+    def test_pack_files(self):
+        path = os.path.join(self.root_dir, "big")
+        f = open(path, "w")
+        f.write("x" * 200000)
+        f.close()
+        archive = tempfile.TemporaryFile()
+        hashes = server.pack_files(
+            [path, ("small", StringIO.StringIO("small\n"))], archive)
+        self.assertEquals(hashes, {
+            "big" : hashlib.md5("x" * 200000).hexdigest(),
+            "small" : hashlib.md5("small\n").hexdigest() })
+        archive.seek(0)
+        tar = tarfile.open(fileobj = archive, mode = "r|")
+        contents = dict([ (info.name, tar.extractfile(info).read())
+                          for info in tar ])
+        self.assertEquals(contents, { "big" : "x" * 200000, 
+            "small" : "small\n" })
+
+    def test_ssh_push_files(self):
+        env = test_util.test_environment()
+        user = getpass.getuser()
+        source = os.path.join(self.root_dir, "source")
+        f = open(source, "w")
+        f.write("contents")
+        f.close()
+        target = "%s@localhost:%s" % (user, os.path.join(self.root_dir, "dst"))
+        stats = server.push_files([source], [target], port = env.port, 
+            agent = True)
+        self.assertEquals(stats[target]['files'], 1)
+        f = open(os.path.join(self.root_dir, "dst", "source"))
+        self.assertEquals(f.read(), "contents")
+        f.close()
+
     def test_server_long_message(self):
         s = server.Server(self.root_dir)
         s.run()
@@ -98,6 +411,136 @@ class ServerTestCase(unittest.TestCase):
         reply = c.read_reply()
         self.assertEqual(reply, "Stopping server")
 
+    def test_server_binary_message(self):
+        s = server.Server(self.root_dir)
+        s.run()
+        c = server.Client(self.root_dir)
+        self.assertEqual(c._proto, server.PROTOCOL_VERSION)
+        msg = "".join(map(chr, xrange(256))) * 8192
+        c.send_msg(msg)
+        reply = c.read_reply()
+        self.assertEqual(reply, ("Reply to: "+msg))
+        c.send_stop()
+        reply = c.read_reply()
+        self.assertEqual(reply, "Stopping server")
+
+    def test_server_framed_protocol(self):
+        s = server.Server(self.root_dir)
+        s.run()
+        c = server.Client(self.root_dir, protocol = server.PROTO_FRAMED)
+        self.assertEqual(c._proto, server.PROTO_FRAMED)
+        msg = "\n|".join(map(str, xrange(1000)))
+        c.send_msg(msg)
+        reply = c.read_reply()
+        self.assertEqual(reply, ("Reply to: "+msg))
+        c.send_stop()
+        reply = c.read_reply()
+        self.assertEqual(reply, "Stopping server")
+
+    def test_server_out_of_order_replies(self):
+        s = SlowServer(self.root_dir)
+        s.run()
+        c = server.Client(self.root_dir)
+        slow_tag = c.send_msg("slow")
+        fast_tag = c.send_msg("fast")
+        reply = c.read_reply(fast_tag)
+        self.assertEqual(reply, "Reply to: fast")
+        self.assertTrue(slow_tag not in c._replies)
+        reply = c.read_reply(slow_tag)
+        self.assertEqual(reply, "Reply to: slow")
+        c.send_stop()
+        reply = c.read_reply()
+        self.assertEqual(reply, "Stopping server")
+
+    def test_client_unread_replies(self):
+        s = server.Server(self.root_dir)
+        s.run()
+        c = server.Client(self.root_dir)
+        tags = [ c.send_msg("msg%d" % i) for i in xrange(4) ]
+        futures = [ c.defer_reply(tag) for tag in tags ]
+        reply = c.read_reply(c.send_msg("last"))
+        self.assertEqual(reply, "Reply to: last")
+        # replies are kept as long as someone may read them
+        self.assertEqual(c._replies.keys(), tags)
+        # but not those of dropped futures
+        del futures[0]
+        reply = c.read_reply(c.send_msg("last"))
+        self.assertEqual(c._replies.keys(), tags[1:])
+        self.assertEqual([ f._get() for f in futures ],
+            [ "Reply to: msg%d" % i for i in xrange(1, 4) ])
+        self.assertEqual(c._replies.keys(), [])
+        
+        # even if dropped before the reply comes
+        future = c.defer_reply(c.send_msg("dropped"))
+        del future
+        reply = c.read_reply(c.send_msg("last"))
+        self.assertEqual(reply, "Reply to: last")
+        self.assertEqual(c._replies.keys(), [])
+        self.assertEqual(c._futures, {})
+        c.send_stop()
+        reply = c.read_reply()
+        self.assertEqual(reply, "Stopping server")
+
+    def test_client_futures(self):
+        s = SlowServer(self.root_dir)
+        s.run()
+        c = server.Client(self.root_dir)
+        slow = c.defer_reply(c.send_msg("slow"))
+        fast = c.defer_reply(c.send_msg("fast"))
+        done, pending = defer.wait_any([slow, fast], timeout = 5)
+        self.assertEqual(done, [fast])
+        self.assertEqual(pending, [slow])
+        self.assertFalse(slow._done())
+        self.assertEqual(defer.wait_any([slow], timeout = 0.01), ([], [slow]))
+        
+        seen = []
+        slow._add_done_callback(lambda future : seen.append(future._result()))
+        chained = slow._then(len)
+        self.assertEqual(defer.gather([fast, slow, "plain"]),
+            ["Reply to: fast", "Reply to: slow", "plain"])
+        self.assertEqual(seen, ["Reply to: slow"])
+        self.assertEqual(chained._result(), len("Reply to: slow"))
+        
+        # errors stick, and gather raises them after resolving the rest
+        failed = defer.Future(lambda : 1/0)
+        ok = c.defer_reply(c.send_msg("fast"))
+        self.assertRaises(ZeroDivisionError, defer.gather, [failed, ok])
+        self.assertTrue(ok._resolved())
+        self.assertTrue(isinstance(failed._exception(), ZeroDivisionError))
+        rv = defer.gather([failed, defer.resolved(1)], return_exceptions = True)
+        self.assertTrue(isinstance(rv[0], ZeroDivisionError))
+        self.assertEqual(rv[1], 1)
+        
+        # the value's attributes aren't hidden by the future's own
+        f = c.defer_reply(c.send_msg("fast"), 
+            transform = lambda reply : tempfile.TemporaryFile())
+        self.assertEqual(f.fileno(), f._get().fileno())
+        f.close()
+        
+        # futures that can only be polled are waited upon until timeout
+        polled = defer.Future(lambda : 1, poll = lambda : False)
+        start = time.time()
+        self.assertEqual(defer.wait_any([polled], timeout = 0.3), 
+            ([], [polled]))
+        self.assertTrue(0.3 <= time.time() - start < 1)
+        
+        c.send_stop()
+        reply = c.read_reply()
+        self.assertEqual(reply, "Stopping server")
+
+    def test_server_line_protocol(self):
+        s = server.Server(self.root_dir)
+        s.run()
+        c = server.Client(self.root_dir, protocol = server.PROTO_LINE)
+        self.assertEqual(c._proto, server.PROTO_LINE)
+        msg = "1"*1145
+        c.send_msg(msg)
+        reply = c.read_reply()
+        self.assertEqual(reply, ("Reply to: "+msg))
+        c.send_stop()
+        reply = c.read_reply()
+        self.assertEqual(reply, "Stopping server")
+
     @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
     def test_sudo_server(self):
         env = test_util.test_environment()
@@ -142,6 +585,77 @@ class ServerTestCase(unittest.TestCase):
         reply = c.read_reply()
         self.assertEqual(reply, "Stopping server")
 
+    def test_ssh_session_pool(self):
+        env = test_util.test_environment()
+        user = getpass.getuser()
+        pool = server.SshSessionPool()
+        orig_pool, server.ssh_sessions = server.ssh_sessions, pool
+        try:
+            for i in xrange(3):
+                (out, err), proc = server.popen_ssh_command(
+                    "echo 'ALIVE'",
+                    host = "localhost",
+                    port = env.port,
+                    user = user,
+                    agent = True)
+                self.assertEquals(proc.wait(), 0)
+                self.assertEquals(out.strip(), "ALIVE")
+            
+            stats = pool.stats()
+            self.assertEquals(stats['misses'], 1)
+            self.assertEquals(stats['hits'], 2)
+            self.assertEquals(stats['setup_count'], 1)
+            self.assertEquals(stats['masters'], 1)
+            self.assertEquals(stats['sessions'], 0)
+            
+            pool.reap(0)
+            self.assertEquals(pool.stats()['masters'], 0)
+        finally:
+            server.ssh_sessions = orig_pool
+            pool.close()
+
+    def test_ssh_session_pool_unreachable(self):
+        user = getpass.getuser()
+        pool = server.SshSessionPool(max_sessions = 1)
+        port = test_util.get_free_port()
+        
+        # can't start a master, sessions go directly
+        path = pool.control_path("localhost", port, user, connect_timeout = 5)
+        self.assertEquals(path, None)
+        with pool.session("localhost", port, user, start = False) as args:
+            self.assertEquals(args, [])
+        stats = pool.stats()
+        self.assertEquals(stats['misses'], 1)
+        self.assertEquals(stats['failures'], 1)
+        self.assertEquals(stats['hits'], 0)
+        self.assertEquals(stats['masters'], 0)
+        
+        # the per-host limit holds back concurrent sessions
+        entered = threading.Event()
+        release = threading.Event()
+        def hold():
+            with pool.session("localhost", port, user, start = False):
+                entered.set()
+                release.wait()
+        def wait():
+            with pool.session("localhost", port, user, start = False):
+                pass
+        holder = threading.Thread(target = hold)
+        holder.start()
+        entered.wait()
+        waiter = threading.Thread(target = wait)
+        waiter.start()
+        for i in xrange(500):
+            if pool.stats()['waits']:
+                break
+            time.sleep(0.01)
+        self.assertEquals(pool.stats()['waits'], 1)
+        self.assertTrue(waiter.isAlive())
+        release.set()
+        holder.join()
+        waiter.join()
+        pool.close()
+
     def test_ssh_server_reconnect(self):
         env = test_util.test_environment()
         user = getpass.getuser()